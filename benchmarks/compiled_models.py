@@ -0,0 +1,91 @@
+import time
+import argparse
+import torch
+from torch.autograd import Variable
+from processing.utils import select_structures, load_dataset
+from processing.dataloader.dataloader import get_dataloader
+from processing.create_model.create_model import create_model
+from training.hyperparameters.default import get_default_cgcnn_hyperparameters, get_default_e3nn_hyperparameters
+from training.model_training.compilation import compile_model, executions
+
+
+def training_step(model, normalizer, model_type, d, optimizer, device):
+    if model_type == "CGCNN":
+        input_struct = d[0]
+        input_var = (Variable(input_struct[0].to(device)),
+                     Variable(input_struct[1].to(device)),
+                     input_struct[2].to(device),
+                     [crys_idx.to(device) for crys_idx in input_struct[3]])
+        output = model(*input_var).view(-1)
+        target = d[1].to(device)
+        loss = torch.nn.functional.l1_loss(normalizer.denorm(output).view(target.shape), target)
+    else:
+        d.to(device)
+        loss = torch.nn.functional.l1_loss(normalizer.denorm(model(d)), d.target)
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+
+
+def steps_per_second(model_type, data, prop, execution, steps, warmup, device):
+    # training steps per second after warmup steps (which include compilation)
+    hyperparameters = get_default_cgcnn_hyperparameters() if model_type == "CGCNN" else get_default_e3nn_hyperparameters()
+    torch.manual_seed(0)
+    loader = get_dataloader(data.copy(), prop, model_type, hyperparameters["batch_size"], interpolation=False)
+    model, normalizer = create_model(model_type, loader, False, prop, hyperparameters)
+    model.to(device)
+    compile_model(model, execution, model_type)
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=10**hyperparameters["log_lr"])
+
+    batches = []
+    while len(batches) < warmup + steps:
+        batches.extend(loader)
+    for d in batches[:warmup]:
+        training_step(model, normalizer, model_type, d, optimizer, device)
+
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.time()
+    for d in batches[warmup:warmup + steps]:
+        training_step(model, normalizer, model_type, d, optimizer, device)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return steps / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Training steps per second of eager, compiled and traced CGCNN and e3nn models')
+    parser.add_argument('--model', default = "e3nn", type=str, choices=["CGCNN", "e3nn"],
+                        help="model to benchmark (default: e3nn)")
+    parser.add_argument('--struct_type', default = 'unrelaxed', type=str, metavar='struct_type',
+                        help="structure representation (default: unrelaxed)")
+    parser.add_argument('--prop', default = 'dft_e_hull', type=str, metavar='prop',
+                        help="target property (default: dft_e_hull)")
+    parser.add_argument('--num', default = 500, type=int, metavar='N',
+                        help="number of structures to use (default: 500)")
+    parser.add_argument('--steps', default = 200, type=int, metavar='S',
+                        help="timed training steps (default: 200)")
+    parser.add_argument('--warmup', default = 20, type=int, metavar='W',
+                        help="untimed steps before timing, including compilation (default: 20)")
+    parser.add_argument('--executions', default = None, type=str, metavar='list',
+                        help="comma-separated execution modes to compare with eager (default: those available for the model and PyTorch version)")
+    parser.add_argument('--device', default = "cuda:0", type=str, metavar='device',
+                        help="device to run on (default: cuda:0)")
+    args = parser.parse_args()
+
+    data = select_structures(load_dataset("data/training_set.json", struct_type=args.struct_type).dropna(subset=[args.prop]).head(args.num), args.struct_type)
+    device = torch.device(args.device)
+
+    if args.executions is None:
+        # torch.compile needs PyTorch 2.0, traces are recorded for CGCNN only
+        compared = [execution for execution in executions[1:] if (execution != "compile" or hasattr(torch, "compile"))
+                    and (execution != "trace" or args.model == "CGCNN")]
+    else:
+        compared = args.executions.split(",")
+
+    results = {execution: steps_per_second(args.model, data, args.prop, execution, args.steps, args.warmup, device)
+               for execution in ["eager"] + compared}
+    print(f"{'execution':>10s} {'steps/s':>9s} {'speedup':>9s}")
+    for execution, rate in results.items():
+        print(f"{execution:>10s} {rate:9.2f} {rate / results['eager']:8.2f}x")
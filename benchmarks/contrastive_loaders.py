@@ -0,0 +1,63 @@
+import time
+import argparse
+import torch
+from processing.utils import select_structures, load_dataset
+from processing.dataloader.dataloader import get_dataloader
+from processing.create_model.create_model import create_model
+from training.hyperparameters.default import get_default_e3nn_hyperparameters
+from training.loss import contrastive_loss
+from training.evaluate import count_contastive_terms
+
+
+def pairwise_terms_per_second(data, prop, loader_options, epochs, device):
+    # contrastive training epochs with the given loader; pairwise ordering terms delivered per second
+    hyperparameters = get_default_e3nn_hyperparameters()
+    torch.manual_seed(0)
+    loader = get_dataloader(data.copy(), prop, "e3nn_contrastive", hyperparameters["batch_size"], interpolation=False, loader_options=loader_options)
+    model, normalizer = create_model("e3nn_contrastive", loader, False, prop, hyperparameters)
+    model.to(device)
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=10**hyperparameters["log_lr"])
+
+    terms = 0
+    start = time.time()
+    for _ in range(epochs):
+        for d in loader:
+            d.to(device)
+            loss, _, _ = contrastive_loss(normalizer.denorm(model(d)), d.target, d.group_ptr, 1.0)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            terms += count_contastive_terms(d.group_ptr)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return terms / epochs, terms / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pairwise contrastive terms per second of fixed-size and composition-group batches')
+    parser.add_argument('--struct_type', default = 'unrelaxed', type=str, metavar='struct_type',
+                        help="structure representation (default: unrelaxed)")
+    parser.add_argument('--prop', default = 'dft_e_hull', type=str, metavar='prop',
+                        help="target property (default: dft_e_hull)")
+    parser.add_argument('--num', default = 1000, type=int, metavar='N',
+                        help="number of training structures (default: 1000)")
+    parser.add_argument('--atom_budget', default = 2000, type=int, metavar='atoms',
+                        help="atoms per composition-group batch (default: 2000)")
+    parser.add_argument('--segments', default = "composition", type=str, choices=["composition", "group"],
+                        help="contrastive loss segments of both loaders (default: composition)")
+    parser.add_argument('--epochs', default = 2, type=int, metavar='E',
+                        help="training epochs per loader (default: 2)")
+    parser.add_argument('--device', default = "cuda:0", type=str, metavar='device',
+                        help="device to run on (default: cuda:0)")
+    args = parser.parse_args()
+
+    data = select_structures(load_dataset("data/training_set.json", struct_type=args.struct_type).dropna(subset=[args.prop]).head(args.num), args.struct_type)
+    device = torch.device(args.device)
+
+    results = {"fixed": pairwise_terms_per_second(data, args.prop, {"contrastive_segments": args.segments}, args.epochs, device),
+               "groups": pairwise_terms_per_second(data, args.prop, {"contrastive_segments": args.segments, "contrastive_atom_budget": args.atom_budget},
+                                                   args.epochs, device)}
+    print(f"{'loader':>8s} {'terms/epoch':>12s} {'terms/s':>12s} {'speedup':>9s}")
+    for name, (terms, rate) in results.items():
+        print(f"{name:>8s} {terms:12.0f} {rate:12.0f} {rate / results['fixed'][1]:8.2f}x")
@@ -0,0 +1,71 @@
+import time
+import argparse
+import torch
+from training.loss import pairwise_energies, pairwise_probs, segment_pairwise_energies, segment_pairwise_probs, sorted_pairwise_energies
+
+
+def looped_pairwise(pairwise, output, target, group_ptr):
+    # the per-group loop that contrastive_loss used before it was vectorised
+    ordering = 0
+    group_ptr = group_ptr.tolist()
+    for start, end in zip(group_ptr[:-1], group_ptr[1:]):
+        ordering += pairwise(output[start:end], target[start:end])
+    return ordering
+
+
+def random_batch(num_groups, max_group_size, device):
+    sizes = torch.randint(1, max_group_size + 1, (num_groups,))
+    group_ptr = torch.cat([torch.zeros(1, dtype=torch.long), torch.cumsum(sizes, 0)]).to(device)
+    target = 0.05 * torch.randn(int(sizes.sum()), dtype=torch.float64, device=device)
+    output = (target + 0.01 * torch.randn_like(target)).requires_grad_()
+    return output, target, group_ptr
+
+
+def time_pairwise(fn, output, target, group_ptr, repeats):
+    start = time.time()
+    for _ in range(repeats):
+        output.grad = None
+        fn(output, target, group_ptr).backward()
+    if output.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeats
+
+
+def compare_contrastive_loss(num_groups=64, max_group_size=6, repeats=100, device="cpu"):
+    """Values, gradients and time per step of the looped, vectorised and sort-based pairwise terms"""
+    output, target, group_ptr = random_batch(num_groups, max_group_size, device)
+    results = {"num_structures": output.shape[0], "num_groups": num_groups}
+
+    for name, reference, vectorised in (("energies", pairwise_energies, segment_pairwise_energies),
+                                        ("probs", pairwise_probs, segment_pairwise_probs),
+                                        ("sorted", pairwise_energies, sorted_pairwise_energies)):
+        looped = lambda o, t, p: looped_pairwise(reference, o, t, p)
+
+        looped_value = looped(output, target, group_ptr)
+        looped_grad = torch.autograd.grad(looped_value, output)[0]
+        vectorised_value = vectorised(output, target, group_ptr)
+        vectorised_grad = torch.autograd.grad(vectorised_value, output)[0]
+
+        results[name + "_value_difference"] = abs(looped_value.item() - vectorised_value.item())
+        results[name + "_max_grad_difference"] = (looped_grad - vectorised_grad).abs().max().item()
+        results[name + "_looped_seconds"] = time_pairwise(looped, output, target, group_ptr, repeats)
+        results[name + "_vectorised_seconds"] = time_pairwise(vectorised, output, target, group_ptr, repeats)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Agreement and speed of the vectorised and sort-based contrastive losses')
+    parser.add_argument('--num_groups', default = 64, type=int, metavar='G',
+                        help="composition groups per batch (default: 64)")
+    parser.add_argument('--max_group_size', default = 6, type=int, metavar='N',
+                        help="largest group size, e.g. several hundred for whole compositions (default: 6)")
+    parser.add_argument('--repeats', default = 100, type=int, metavar='R',
+                        help="timed forward and backward passes (default: 100)")
+    parser.add_argument('--device', default = "cpu", type=str, metavar='device',
+                        help="device to run on (default: cpu)")
+    args = parser.parse_args()
+
+    results = compare_contrastive_loss(args.num_groups, args.max_group_size, args.repeats, args.device)
+    for key, value in results.items():
+        print(f"{key:>32s} : {value}")
@@ -0,0 +1,62 @@
+import os
+import time
+import argparse
+import torch
+from processing.utils import select_structures, load_dataset
+from processing.dataloader.dataloader import get_dataloader
+from processing.create_model.create_model import create_model
+from training.hyperparameters.default import get_default_cgcnn_hyperparameters, get_default_e3nn_hyperparameters
+from training.model_training.device import configure_cpu
+from inference.test_model_prediction import evaluate_model_with_tracked_ids
+
+
+def structures_per_second(model, normalizer, model_type, loader, num_structures, num_threads, cpu_workers, repeats):
+    # CPU inference throughput with num_threads intra-op threads shared by cpu_workers processes
+    configure_cpu(num_threads)
+    model_params = {"model_type": model_type}
+    evaluate_model_with_tracked_ids(model, normalizer, -1, loader, model_params, cpu_workers=cpu_workers)
+    start = time.time()
+    for _ in range(repeats):
+        evaluate_model_with_tracked_ids(model, normalizer, -1, loader, model_params, cpu_workers=cpu_workers)
+    return repeats * num_structures / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CPU inference throughput per thread count and number of data-parallel workers')
+    parser.add_argument('--model', default = "CGCNN", type=str, choices=["CGCNN", "e3nn"],
+                        help="model to benchmark (default: CGCNN)")
+    parser.add_argument('--struct_type', default = 'unrelaxed', type=str, metavar='struct_type',
+                        help="structure representation (default: unrelaxed)")
+    parser.add_argument('--prop', default = 'dft_e_hull', type=str, metavar='prop',
+                        help="target property (default: dft_e_hull)")
+    parser.add_argument('--num', default = 500, type=int, metavar='N',
+                        help="number of structures to predict (default: 500)")
+    parser.add_argument('--batch_size', default = 32, type=int, metavar='size',
+                        help="inference batch size (default: 32)")
+    parser.add_argument('--threads', default = None, type=str, metavar='list',
+                        help="comma-separated thread counts (default: powers of two up to the available cores)")
+    parser.add_argument('--workers', default = "1,2,4", type=str, metavar='list',
+                        help="comma-separated numbers of data-parallel workers (default: 1,2,4)")
+    parser.add_argument('--repeats', default = 3, type=int, metavar='R',
+                        help="timed passes over the structures (default: 3)")
+    args = parser.parse_args()
+
+    if args.threads is None:
+        cores = len(os.sched_getaffinity(0))
+        thread_counts = [2**i for i in range(cores.bit_length()) if 2**i <= cores]
+    else:
+        thread_counts = [int(n) for n in args.threads.split(",")]
+
+    data = select_structures(load_dataset("data/training_set.json", struct_type=args.struct_type).dropna(subset=[args.prop]).head(args.num), args.struct_type)
+    hyperparameters = get_default_cgcnn_hyperparameters() if args.model == "CGCNN" else get_default_e3nn_hyperparameters()
+    torch.manual_seed(0)
+    loader = get_dataloader(data.copy(), args.prop, args.model, args.batch_size, interpolation=False)
+    model, normalizer = create_model(args.model, loader, False, args.prop, hyperparameters)
+
+    print(f"{'threads':>8s} {'workers':>8s} {'structures/s':>14s}")
+    for num_threads in thread_counts:
+        for cpu_workers in [int(n) for n in args.workers.split(",")]:
+            if cpu_workers > num_threads:
+                continue
+            rate = structures_per_second(model, normalizer, args.model, loader, len(data), num_threads, cpu_workers, args.repeats)
+            print(f"{num_threads:8d} {cpu_workers:8d} {rate:14.1f}")
@@ -0,0 +1,95 @@
+import os
+import time
+import json
+import argparse
+import tempfile
+import torch
+import torch.multiprocessing as mp
+from processing.utils import select_structures, load_dataset
+from processing.dataloader.dataloader import get_dataloader
+from processing.dataloader.distributed import distribute_loader, shard_eval_loader
+from processing.create_model.create_model import create_model
+from training.hyperparameters.default import get_default_cgcnn_hyperparameters, get_default_e3nn_hyperparameters, get_default_painn_hyperparameters
+from training.model_training.trainer import train_CGCNN_e3nn, train_painn
+from training.model_training.device import configure_cpu
+from training.model_training.distributed import init_distributed, cleanup_distributed, get_local_cores
+
+
+def train_rank(rank, world_size, model_type, train_data, val_data, prop, epochs, port, outdir):
+    # one rank of a short CPU training run; rank 0 writes the mean time per epoch
+    init_distributed(rank, world_size, init_method="tcp://127.0.0.1:" + str(port))
+    configure_cpu(cores=get_local_cores(rank, world_size))
+
+    if model_type == "Painn":
+        hyperparameters = get_default_painn_hyperparameters()
+    elif model_type == "CGCNN":
+        hyperparameters = get_default_cgcnn_hyperparameters()
+    else:
+        hyperparameters = get_default_e3nn_hyperparameters()
+    hyperparameters["MaxEpochs"] = epochs
+    torch.manual_seed(0)
+    train_loader = get_dataloader(train_data.copy(), prop, model_type, hyperparameters["batch_size"], interpolation=False)
+    val_loader = get_dataloader(val_data.copy(), prop, model_type, 1, interpolation=False)
+    model, normalizer = create_model(model_type, train_loader, False, prop, hyperparameters)
+    train_loader = distribute_loader(train_loader, rank, world_size)
+
+    if model_type == "Painn":
+        # nff's Trainer validates every rank on the whole validation set, which is included in the epoch time
+        start = time.time()
+        train_painn(model, train_loader, val_loader, hyperparameters, outdir, -1)
+        seconds = (time.time() - start) / epochs
+    else:
+        val_loader = shard_eval_loader(val_loader, rank, world_size)
+        train_CGCNN_e3nn(model, normalizer, model_type, torch.nn.L1Loss(), None, train_loader, val_loader, hyperparameters,
+                         outdir, -1, None, 1.0)
+        if rank == 0:
+            history = torch.load(os.path.join(outdir, "final_model.torch"))["history"]
+            seconds = sum(epoch["wall"] for epoch in history) / len(history)
+    if rank == 0:
+        with open(os.path.join(outdir, "epoch_time.json"), "w") as f:
+            json.dump(seconds, f)
+    cleanup_distributed()
+
+
+def epoch_time(model_type, train_data, val_data, prop, epochs, world_size, port):
+    with tempfile.TemporaryDirectory() as outdir:
+        mp.spawn(train_rank, args=(world_size, model_type, train_data, val_data, prop, epochs, port, outdir), nprocs=world_size)
+        with open(os.path.join(outdir, "epoch_time.json")) as f:
+            return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Training time per epoch of data-parallel CPU training against the number of processes')
+    parser.add_argument('--model', default = "CGCNN", type=str, choices=["CGCNN", "e3nn", "Painn"],
+                        help="model to train (default: CGCNN)")
+    parser.add_argument('--struct_type', default = 'unrelaxed', type=str, metavar='struct_type',
+                        help="structure representation (default: unrelaxed)")
+    parser.add_argument('--prop', default = 'dft_e_hull', type=str, metavar='prop',
+                        help="target property (default: dft_e_hull)")
+    parser.add_argument('--num', default = 1000, type=int, metavar='N',
+                        help="number of training structures (default: 1000)")
+    parser.add_argument('--epochs', default = 3, type=int, metavar='E',
+                        help="training epochs per run (default: 3)")
+    parser.add_argument('--world_sizes', default = None, type=str, metavar='list',
+                        help="comma-separated numbers of processes (default: powers of two up to the available cores)")
+    parser.add_argument('--port', default = 29511, type=int, metavar='port',
+                        help="port of the rendezvous on 127.0.0.1 (default: 29511)")
+    args = parser.parse_args()
+
+    if args.world_sizes is None:
+        cores = len(os.sched_getaffinity(0))
+        world_sizes = [2**i for i in range(cores.bit_length()) if 2**i <= cores]
+    else:
+        world_sizes = [int(n) for n in args.world_sizes.split(",")]
+
+    train_data = select_structures(load_dataset("data/training_set.json", struct_type=args.struct_type).dropna(subset=[args.prop]).head(args.num), args.struct_type)
+    val_data = select_structures(load_dataset("data/validation_set.json", struct_type=args.struct_type).dropna(subset=[args.prop]), args.struct_type)
+
+    print(f"{'processes':>10s} {'epoch time (s)':>15s} {'speedup':>9s} {'efficiency':>11s}")
+    # speedup and parallel efficiency relative to the first world size (a single process by default)
+    reference = None
+    for world_size in world_sizes:
+        seconds = epoch_time(args.model, train_data, val_data, args.prop, args.epochs, world_size, args.port)
+        reference = (world_size, seconds) if reference is None else reference
+        speedup = reference[1] / seconds
+        print(f"{world_size:10d} {seconds:15.2f} {speedup:8.2f}x {speedup * reference[0] / world_size:11.1%}")
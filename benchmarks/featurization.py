@@ -0,0 +1,50 @@
+import time
+import argparse
+import torch
+from processing.utils import select_structures, load_dataset, to_ase_atoms
+from processing.dataloader.build_data import build_e3nn_dataset
+
+
+def same_graphs(graphs, reference):
+    # the parallel path must reproduce the serial graphs exactly, in the same order
+    for data, expected in zip(graphs, reference):
+        for key in expected.keys:
+            if not torch.equal(data[key], expected[key]):
+                return False
+    return len(graphs) == len(reference)
+
+
+def featurize(data, prop, num_workers, chunksize, neighbor_engine):
+    start = time.time()
+    graphs = build_e3nn_dataset(data, prop, r_max=5.0, num_workers=num_workers, chunksize=chunksize, neighbor_engine=neighbor_engine)
+    return graphs, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput of e3nn graph construction against the number of featurisation workers')
+    parser.add_argument('--struct_type', default = 'unrelaxed', type=str, metavar='struct_type',
+                        help="structure representation (default: unrelaxed)")
+    parser.add_argument('--prop', default = 'dft_e_hull', type=str, metavar='prop',
+                        help="target property (default: dft_e_hull)")
+    parser.add_argument('--num', default = 4000, type=int, metavar='N',
+                        help="number of structures to featurise (default: 4000)")
+    parser.add_argument('--chunksize', default = 64, type=int, metavar='chunk',
+                        help="structures dispatched to a worker at a time (default: 64)")
+    parser.add_argument('--neighbor_engine', default = 'ase', type=str, choices=["ase", "batched"],
+                        help="neighbor list engine (default: ase)")
+    parser.add_argument('--workers', default = "2,4,8,16", type=str, metavar='list',
+                        help="comma-separated numbers of workers to compare with the serial path (default: 2,4,8,16)")
+    args = parser.parse_args()
+
+    data = select_structures(load_dataset("data/training_set.json", struct_type=args.struct_type).dropna(subset=[args.prop]).head(args.num), args.struct_type)
+    data['ase_structure'] = [to_ase_atoms(structure) for structure in data['structure']]
+    data['idx'] = data.index
+
+    reference, serial_time = featurize(data, args.prop, 0, args.chunksize, args.neighbor_engine)
+    print(f"{'workers':>8s} {'structures/s':>13s} {'speedup':>9s} {'efficiency':>11s} {'identical':>10s}")
+    print(f"{'serial':>8s} {len(data) / serial_time:13.1f} {1.0:8.2f}x {1.0:11.1%} {'yes':>10s}")
+    for num_workers in [int(n) for n in args.workers.split(",")]:
+        graphs, seconds = featurize(data, args.prop, num_workers, args.chunksize, args.neighbor_engine)
+        speedup = serial_time / seconds
+        print(f"{num_workers:8d} {len(data) / seconds:13.1f} {speedup:8.2f}x {speedup / num_workers:11.1%} "
+              f"{'yes' if same_graphs(graphs, reference) else 'no':>10s}")
@@ -0,0 +1,79 @@
+import time
+import pickle
+import argparse
+import numpy as np
+import torch
+from torch_geometric.loader.dataloader import Collater
+from processing.utils import select_structures, load_dataset, to_ase_atoms
+from processing.dataloader.build_data import build_e3nn_dataset, CompactGraphCollater
+
+
+def graph_nbytes(data):
+    nbytes = 0
+    for value in data.to_dict().values():
+        if isinstance(value, torch.Tensor):
+            nbytes += value.element_size() * value.nelement()
+        elif isinstance(value, np.ndarray):
+            nbytes += value.nbytes
+    return nbytes
+
+
+def time_collate(collate_fn, data_list, batch_size, repeats=3):
+    start = time.time()
+    for _ in range(repeats):
+        for i in range(0, len(data_list), batch_size):
+            collate_fn(data_list[i:i + batch_size])
+    return (time.time() - start) / repeats
+
+
+def compare_graph_schemas(df, prop, r_max=5.0, batch_size=32):
+    """Size and collate time of the default and compact e3nn graphs, and a check that the model inputs agree"""
+    default_graphs = build_e3nn_dataset(df, prop, r_max)
+    compact_graphs = build_e3nn_dataset(df, prop, r_max, compact=True)
+
+    default_collate = Collater(None, None)
+    compact_collate = CompactGraphCollater(Collater(None, None))
+
+    mismatches = 0
+    for i in range(0, len(df), batch_size):
+        a = default_collate(default_graphs[i:i + batch_size])
+        b = compact_collate(compact_graphs[i:i + batch_size])
+        for key in ("x", "z", "pos", "edge_index", "edge_vec", "batch", "target"):
+            if not torch.equal(a[key], b[key]):
+                mismatches += 1
+        if not torch.equal(a.idx.view(-1), b.idx):
+            mismatches += 1
+
+    return {
+        "num_graphs": len(df),
+        "default_bytes_per_graph": np.mean([graph_nbytes(data) for data in default_graphs]),
+        "compact_bytes_per_graph": np.mean([graph_nbytes(data) for data in compact_graphs]),
+        "default_pickled_bytes_per_graph": len(pickle.dumps(default_graphs)) / len(df),
+        "compact_pickled_bytes_per_graph": len(pickle.dumps(compact_graphs)) / len(df),
+        "default_collate_seconds": time_collate(default_collate, default_graphs, batch_size),
+        "compact_collate_seconds": time_collate(compact_collate, compact_graphs, batch_size),
+        "mismatched_batch_fields": mismatches,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory and collate time of the default and compact e3nn graph schemas')
+    parser.add_argument('--data', default = "data/validation_set.json", type=str, metavar='path',
+                        help="json dataset to take structures from (default: data/validation_set.json)")
+    parser.add_argument('--struct_type', default = 'unrelaxed', type=str, metavar='struct_type',
+                        help="structure representation (default: unrelaxed)")
+    parser.add_argument('--prop', default = 'dft_e_hull', type=str, metavar='prop',
+                        help="target property (default: dft_e_hull)")
+    parser.add_argument('--num', default = 1000, type=int, metavar='N',
+                        help="number of structures to use (default: 1000)")
+    parser.add_argument('--batch_size', default = 32, type=int, metavar='B',
+                        help="batch size used for collation (default: 32)")
+    args = parser.parse_args()
+
+    data = select_structures(load_dataset(args.data, struct_type=args.struct_type).dropna(subset=[args.prop]).head(args.num), args.struct_type)
+    data['ase_structure'] = [to_ase_atoms(structure) for structure in data["structure"]]
+    data['idx'] = data.index
+
+    results = compare_graph_schemas(data, args.prop, batch_size=args.batch_size)
+    for key, value in results.items():
+        print(f"{key:>32s} : {value}")
@@ -0,0 +1,71 @@
+import os
+import time
+import argparse
+import tempfile
+import torch
+from processing.utils import select_structures, load_dataset
+from processing.dataloader.dataloader import get_dataloader
+from processing.create_model.create_model import create_model
+from training.hyperparameters.default import get_default_cgcnn_hyperparameters, get_default_e3nn_hyperparameters, get_default_painn_hyperparameters
+from training.model_training.trainer import train_CGCNN_e3nn, train_painn
+from training.evaluate import evaluate_model
+
+
+def train_with_precision(model_type, train_data, val_data, prop, precision, epochs, gpu_num):
+    # a short training run; returns the training throughput and the float32 validation MAE of the best model
+    if model_type == "Painn":
+        hyperparameters = get_default_painn_hyperparameters()
+    elif model_type == "CGCNN":
+        hyperparameters = get_default_cgcnn_hyperparameters()
+    else:
+        hyperparameters = get_default_e3nn_hyperparameters()
+    hyperparameters["MaxEpochs"] = epochs
+
+    torch.manual_seed(0)
+    train_loader = get_dataloader(train_data.copy(), prop, model_type, hyperparameters["batch_size"], interpolation=False)
+    val_loader = get_dataloader(val_data.copy(), prop, model_type, 1, interpolation=False)
+    model, normalizer = create_model(model_type, train_loader, False, prop, hyperparameters)
+
+    with tempfile.TemporaryDirectory() as outdir:
+        start = time.time()
+        if model_type == "Painn":
+            best_model = train_painn(model, train_loader, val_loader, hyperparameters, outdir, gpu_num, precision=precision)
+            throughput = epochs * len(train_data) / (time.time() - start)
+        else:
+            best_model = train_CGCNN_e3nn(model, normalizer, model_type, torch.nn.L1Loss(), None, train_loader, val_loader, hyperparameters,
+                                          outdir, gpu_num, None, 1.0, precision=precision)
+            history = torch.load(os.path.join(outdir, "final_model.torch"))["history"]
+            throughput = sum(epoch["structures_per_second"] for epoch in history) / len(history)
+
+    _, _, val_loss = evaluate_model(best_model, normalizer, model_type, val_loader, torch.nn.L1Loss(), gpu_num)
+    return throughput, val_loss if model_type == "Painn" else val_loss[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Training throughput and validation MAE of float32 and mixed precision')
+    parser.add_argument('--model', default = "CGCNN", type=str, choices=["CGCNN", "e3nn", "Painn"],
+                        help="model to train (default: CGCNN)")
+    parser.add_argument('--precisions', default = "fp32,bf16", type=str, metavar='list',
+                        help="comma-separated precisions to compare (default: fp32,bf16)")
+    parser.add_argument('--struct_type', default = 'unrelaxed', type=str, metavar='struct_type',
+                        help="structure representation (default: unrelaxed)")
+    parser.add_argument('--prop', default = 'dft_e_hull', type=str, metavar='prop',
+                        help="target property (default: dft_e_hull)")
+    parser.add_argument('--num', default = 1000, type=int, metavar='N',
+                        help="number of training structures (default: 1000)")
+    parser.add_argument('--epochs', default = 5, type=int, metavar='E',
+                        help="training epochs per precision (default: 5)")
+    parser.add_argument('--gpu', default = 0, type=int, metavar='device',
+                        help="the gpu to use (default: 0)")
+    args = parser.parse_args()
+
+    train_data = select_structures(load_dataset("data/training_set.json", struct_type=args.struct_type).dropna(subset=[args.prop]).head(args.num), args.struct_type)
+    val_data = select_structures(load_dataset("data/validation_set.json", struct_type=args.struct_type).dropna(subset=[args.prop]), args.struct_type)
+
+    # throughput and float32 validation MAE of every precision, relative to the first one (fp32 by default)
+    print(f"{'precision':>10s} {'structures/s':>14s} {'speedup':>9s} {'val MAE':>12s} {'MAE change':>12s}")
+    reference = None
+    for precision in args.precisions.split(","):
+        throughput, val_mae = train_with_precision(args.model, train_data, val_data, args.prop, precision, args.epochs, args.gpu)
+        reference = (throughput, val_mae) if reference is None else reference
+        print(f"{precision:>10s} {throughput:14.1f} {throughput / reference[0]:8.2f}x {val_mae:12.6f} {val_mae - reference[1]:+12.6f}")
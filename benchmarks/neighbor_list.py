@@ -0,0 +1,54 @@
+import time
+import argparse
+from ase.neighborlist import neighbor_list
+from processing.utils import select_structures, load_dataset, to_ase_atoms
+from processing.dataloader.neighbor_list import batched_neighbor_lists
+
+
+def edge_set(edge_src, edge_dst, edge_shift):
+    return set(zip(edge_src.tolist(), edge_dst.tolist(), map(tuple, edge_shift.tolist())))
+
+
+def compare_neighbor_lists(atoms_list, r_max=5.0):
+    """Time ase's per-structure neighbor_list against the batched engine and check that the edge sets agree"""
+    start = time.time()
+    ase_lists = [neighbor_list("ijS", a=atoms, cutoff=r_max, self_interaction=True) for atoms in atoms_list]
+    ase_time = time.time() - start
+
+    start = time.time()
+    batched_lists = batched_neighbor_lists(atoms_list, r_max)
+    batched_time = time.time() - start
+
+    mismatches = 0
+    for ase_edges, batched_edges in zip(ase_lists, batched_lists):
+        if edge_set(*ase_edges) != edge_set(*batched_edges):
+            mismatches += 1
+
+    return {
+        "num_structures": len(atoms_list),
+        "num_edges": sum(len(edges[0]) for edges in ase_lists),
+        "ase_structures_per_second": len(atoms_list) / ase_time,
+        "batched_structures_per_second": len(atoms_list) / batched_time,
+        "speedup": ase_time / batched_time,
+        "mismatched_structures": mismatches,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput of the ase and batched periodic neighbor lists')
+    parser.add_argument('--data', default = "data/validation_set.json", type=str, metavar='path',
+                        help="json dataset to take structures from (default: data/validation_set.json)")
+    parser.add_argument('--struct_type', default = 'unrelaxed', type=str, metavar='struct_type',
+                        help="structure representation (default: unrelaxed)")
+    parser.add_argument('--num', default = 1000, type=int, metavar='N',
+                        help="number of structures to use (default: 1000)")
+    parser.add_argument('--r_max', default = 5.0, type=float, metavar='cutoff',
+                        help="cutoff radius (default: 5.0)")
+    args = parser.parse_args()
+
+    data = select_structures(load_dataset(args.data, struct_type=args.struct_type).head(args.num), args.struct_type)
+    atoms_list = [to_ase_atoms(structure) for structure in data["structure"]]
+
+    results = compare_neighbor_lists(atoms_list, r_max=args.r_max)
+    for key, value in results.items():
+        print(f"{key:>32s} : {value}")
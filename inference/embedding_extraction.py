@@ -4,13 +4,14 @@ import pandas as pd
 import numpy as np
 import random
 from processing.dataloader.dataloader import get_dataloader
-from processing.utils import filter_data_by_properties,select_structures
+from processing.utils import filter_data_by_properties,select_structures,load_dataset,restore_structure_dicts
 from processing.interpolation.Interpolation import *
 # from training.sigopt_utils import build_sigopt_name  # Original SigOpt utils (commented out)
 from training.wandb_utils import build_wandb_name  # Wandb utils (active)
 from processing.create_model.create_model import create_model
 from inference.select_best_models import get_experiment_id
 from inference.test_model_prediction import evaluate_model_with_tracked_ids, load_model
+from training.model_training.device import get_device
 from nff.train.loss import build_mae_loss
 from nff.train.evaluate import evaluate
 from torch.autograd import Variable
@@ -34,9 +35,7 @@ def get_model_embedding(test_set_type, model_params, gpu_num, num_best_models, t
         print("Embeddings not implemented for Painn.")
         return None
 
-    device_name = "cuda:" + str(gpu_num)
-    device = torch.device(device_name)
-    torch.cuda.set_device(device)
+    device = get_device(gpu_num)
 
     interpolation = model_params["interpolation"]
     model_type = model_params["model_type"]
@@ -45,18 +44,18 @@ def get_model_embedding(test_set_type, model_params, gpu_num, num_best_models, t
     
     if data_name == "data/":
 
-        training_data = pd.read_json(data_name + 'training_set.json')
+        training_data = load_dataset(data_name + 'training_set.json')
         training_data = training_data.sample(frac=model_params["training_fraction"],replace=False,random_state=0)
-        test_data = pd.read_json(data_name + test_set_type + '.json')
-        edge_data = pd.read_json(data_name + 'edge_dataset.json')
+        test_data = load_dataset(data_name + test_set_type + '.json')
+        edge_data = load_dataset(data_name + 'edge_dataset.json')
 
         if not interpolation:
             training_data = pd.concat((training_data,edge_data))
 
     elif data_name == "pretrain_data/":
 
-        training_data = pd.read_json(data_name + 'training_set.json')
-        test_data = pd.read_json(data_name + 'test_set.json')
+        training_data = load_dataset(data_name + 'training_set.json')
+        test_data = load_dataset(data_name + 'test_set.json')
 
     else:
         print("Specified Data Directory Does Not Exist!")
@@ -85,8 +84,9 @@ def get_model_embedding(test_set_type, model_params, gpu_num, num_best_models, t
     train_data = processed_data[0]
     test_data = processed_data[1]
 
-    train_loader = get_dataloader(train_data,target_prop,model_type,1,interpolation)
-    test_loader = get_dataloader(test_data,target_prop,model_type,1,interpolation)       
+    loader_options = model_params.get("loader_options")
+    train_loader = get_dataloader(train_data,target_prop,model_type,1,interpolation,loader_options=loader_options)
+    test_loader = get_dataloader(test_data,target_prop,model_type,1,interpolation,loader_options=loader_options)       
 
     # Original SigOpt name building (commented out)
     # sigopt_name = build_sigopt_name(model_params["data"], target_prop, model_params["struct_type"], model_params["interpolation"], model_params["model_type"],contrastive_weight=model_params["contrastive_weight"],training_fraction=model_params["training_fraction"])
@@ -110,11 +110,12 @@ def get_model_embedding(test_set_type, model_params, gpu_num, num_best_models, t
                 activation["embedding"].append(input[0].detach())
 
         model_layer = get_model_layer(model,model_params["model_type"],depth)
+        # the forward hook collects embeddings in this process, so the prediction runs without CPU workers
         model_layer.register_forward_hook(hook)
-        prediction,ids = evaluate_model_with_tracked_ids(model, normalizer, gpu_num, test_loader, model_params, return_ids=True)
+        prediction,ids = evaluate_model_with_tracked_ids(model, normalizer, gpu_num, test_loader, model_params, return_ids=True, cpu_workers=1)
         embeddings = activation['embedding']
         sorted_embeddings = []
-        infer_embedding = test_data.copy()
+        infer_embedding = restore_structure_dicts(test_data)
         infer_embedding.drop(columns=['structure', 'ase_structure'], inplace=True)
         if model_params["model_type"] == "e3nn":
             infer_embedding.drop(columns=['datapoint'], inplace=True)
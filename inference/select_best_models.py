@@ -9,13 +9,14 @@ import numpy as np
 import pandas as pd
 import wandb  # Wandb import (active)
 from processing.dataloader.dataloader import get_dataloader
-from processing.utils import filter_data_by_properties,select_structures
+from processing.utils import filter_data_by_properties,select_structures,load_dataset
 from training.evaluate import evaluate_model
 from processing.interpolation.Interpolation import *
 from training.loss import contrastive_loss
 # from training.sigopt_utils import build_sigopt_name  # Original SigOpt utils (commented out)
 from training.wandb_utils import build_wandb_name  # Wandb utils (active)
 from processing.create_model.create_model import create_model
+from training.model_training.device import get_device
 
 saved_models_path = "./saved_models/"
 
@@ -57,8 +58,7 @@ def load_model(gpu_num, train_loader, target_prop, model_params, observ_folder_n
     """
     Load model - equivalent to SigOpt version but uses wandb naming
     """
-    device_name = "cuda:" + str(gpu_num)
-    device = torch.device(device_name)
+    device = get_device(gpu_num)
     
     # Wandb name building (active)
     wandb_name = build_wandb_name(model_params["data"], target_prop, model_params["struct_type"], model_params["interpolation"], model_params["model_type"],contrastive_weight=model_params["contrastive_weight"],training_fraction=model_params["training_fraction"],long_range=model_params["long_range"])
@@ -88,9 +88,7 @@ def reverify_wandb_models(model_params, gpu_num, target_prop="dft_e_hull"):
     model_params["contrastive_weight"] = 1.0
     model_params["long_range"] = False
 
-    device_name = "cuda:" + str(gpu_num)
-    device = torch.device(device_name)
-    torch.cuda.set_device(device)
+    device = get_device(gpu_num)
     
     interpolation = model_params["interpolation"]
     model_type = model_params["model_type"]    
@@ -98,10 +96,10 @@ def reverify_wandb_models(model_params, gpu_num, target_prop="dft_e_hull"):
     struct_type = model_params["struct_type"]
 
     if data_name == "data/":
-        training_data = pd.read_json(data_name + 'training_set.json')
+        training_data = load_dataset(data_name + 'training_set.json', struct_type=struct_type)
         training_data = training_data.sample(frac=model_params["training_fraction"],replace=False,random_state=0)
-        validation_data = pd.read_json(data_name + 'validation_set.json')
-        edge_data = pd.read_json(data_name + 'edge_dataset.json')
+        validation_data = load_dataset(data_name + 'validation_set.json', struct_type=struct_type)
+        edge_data = load_dataset(data_name + 'edge_dataset.json', struct_type=struct_type)
 
         if not interpolation:
             training_data = pd.concat((training_data,edge_data))
@@ -133,8 +131,9 @@ def reverify_wandb_models(model_params, gpu_num, target_prop="dft_e_hull"):
     if "per_site" in target_prop:
         per_site = True
 
-    train_loader = get_dataloader(train_data,target_prop,model_type,1,interpolation,per_site=per_site,long_range=model_params["long_range"])
-    val_loader = get_dataloader(validation_data,target_prop,model_type,1,interpolation,per_site=per_site,long_range=model_params["long_range"])       
+    loader_options = model_params.get("loader_options")
+    train_loader = get_dataloader(train_data,target_prop,model_type,1,interpolation,per_site=per_site,long_range=model_params["long_range"],loader_options=loader_options)
+    val_loader = get_dataloader(validation_data,target_prop,model_type,1,interpolation,per_site=per_site,long_range=model_params["long_range"],loader_options=loader_options)       
 
     reverify_wandb_models_results = pd.DataFrame(columns=['observ_folder', 'reverified_loss'])
 
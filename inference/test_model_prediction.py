@@ -4,8 +4,9 @@ import pandas as pd
 import numpy as np
 import random
 import time
+from queue import Empty, Full
 from processing.dataloader.dataloader import get_dataloader
-from processing.utils import filter_data_by_properties,select_structures
+from processing.utils import filter_data_by_properties,select_structures,load_dataset,restore_structure_dicts
 from processing.interpolation.Interpolation import *
 # from training.sigopt_utils import build_sigopt_name  # Original SigOpt utils (commented out)
 from training.wandb_utils import build_wandb_name  # Wandb utils (active)
@@ -14,6 +15,8 @@ from inference.select_best_models import get_experiment_id
 from nff.train.loss import build_mae_loss
 from nff.train.evaluate import evaluate
 from torch.autograd import Variable
+from training.model_training.compilation import compile_model
+from training.model_training.device import get_device, get_nff_device, to_device
 
 
 def get_all_model_predictions(model_params, gpu_num, target_prop="dft_e_hull", num_best_models=3):
@@ -29,9 +32,7 @@ def get_all_model_predictions(model_params, gpu_num, target_prop="dft_e_hull", n
 
 
 def get_model_prediction(test_set_type, model_params, gpu_num, target_prop, num_best_models):
-    device_name = "cuda:" + str(gpu_num)
-    device = torch.device(device_name)
-    torch.cuda.set_device(device)
+    device = get_device(gpu_num)
     
     start = time.time()
 
@@ -42,10 +43,10 @@ def get_model_prediction(test_set_type, model_params, gpu_num, target_prop, num_
     
     if data_name == "data/":
 
-        training_data = pd.read_json(data_name + 'training_set.json')
+        training_data = load_dataset(data_name + 'training_set.json')
         training_data = training_data.sample(frac=model_params["training_fraction"],replace=False,random_state=0)
-        test_data = pd.read_json(data_name + test_set_type + '.json')
-        edge_data = pd.read_json(data_name + 'edge_dataset.json')
+        test_data = load_dataset(data_name + test_set_type + '.json')
+        edge_data = load_dataset(data_name + 'edge_dataset.json')
 
         if not interpolation:
             training_data = pd.concat((training_data,edge_data))
@@ -95,10 +96,11 @@ def get_model_prediction(test_set_type, model_params, gpu_num, target_prop, num_
     if "per_site" in target_prop:
         per_site = True
 
-    train_loader = get_dataloader(train_data,target_prop,model_type,1,interpolation,per_site=per_site,long_range=model_params["long_range"])
+    loader_options = model_params.get("loader_options")
+    train_loader = get_dataloader(train_data,target_prop,model_type,1,interpolation,per_site=per_site,long_range=model_params["long_range"],loader_options=loader_options)
     
     start_2 = time.time()
-    test_loader = get_dataloader(test_data,target_prop,model_type,1,interpolation,per_site=per_site,long_range=model_params["long_range"])       
+    test_loader = get_dataloader(test_data,target_prop,model_type,1,interpolation,per_site=per_site,long_range=model_params["long_range"],loader_options=loader_options)       
     end_2 = time.time()
     
     # Original SigOpt name building (commented out)
@@ -121,7 +123,7 @@ def get_model_prediction(test_set_type, model_params, gpu_num, target_prop, num_
         print(end_3-start_3 + (end_2-start_2))
 
         sorted_prediction = []
-        infer_data = test_data.copy()
+        infer_data = restore_structure_dicts(test_data)
         infer_data.drop(columns=['structure', 'ase_structure'], inplace=True)
         if model_params["model_type"] == "e3nn":
             infer_data.drop(columns=['datapoint'], inplace=True)
@@ -139,8 +141,7 @@ def get_model_prediction(test_set_type, model_params, gpu_num, target_prop, num_
 
         
 def load_model(gpu_num, train_loader, model_params, directory, target_prop,per_site):
-    device_name = "cuda:" + str(gpu_num)
-    device = torch.device(device_name)
+    device = get_device(gpu_num)
 
     if model_params["model_type"] == "Painn":
         model = torch.load(directory + "/best_model", map_location=device)
@@ -155,9 +156,8 @@ def load_model(gpu_num, train_loader, model_params, directory, target_prop,per_s
     return model, normalizer
 
 
-def evaluate_model_with_tracked_ids(model, normalizer, gpu_num, test_loader, model_params,return_ids = False):
-    device_name = "cuda:" + str(gpu_num)
-    device = torch.device(device_name)
+def evaluate_model_with_tracked_ids(model, normalizer, gpu_num, test_loader, model_params,return_ids = False,cpu_workers=None):
+    device = get_device(gpu_num)
     predictions = {}
 
     if model_params["model_type"] == "Painn":
@@ -166,7 +166,7 @@ def evaluate_model_with_tracked_ids(model, normalizer, gpu_num, test_loader, mod
         results, targets, _ = evaluate(model, 
                                           test_loader, 
                                           loss_fn_painn, 
-                                          device=gpu_num)
+                                          device=get_nff_device(device))
         
         prop_name = prop_names[0]
         out = [float(entry) for entry in results[prop_name]]
@@ -180,34 +180,124 @@ def evaluate_model_with_tracked_ids(model, normalizer, gpu_num, test_loader, mod
 
     else:
         model.eval()    
-        all_crys_ids = []
-        with torch.no_grad():
-            for j, d in enumerate(test_loader):
-                if model_params["model_type"] == "CGCNN":
-                    input_struct = d[0]
-                    target = d[1]
-                    input_var = (Variable(input_struct[0].cuda(non_blocking=True)),
-                                 Variable(input_struct[1].cuda(non_blocking=True)),
-                                 input_struct[2].cuda(non_blocking=True),
-                                 [crys_idx.cuda(non_blocking=True) for crys_idx in input_struct[3]])
-                    output = model(*input_var).view(-1)
-                    target = Variable(target.cuda(non_blocking=True))
-                    crys_idx = d[2]
-                else:
-                    d.to(device)
-                    output = model(d)
-                    crys_idx = d.idx
-                    
-                try:
-                    crys_idx = crys_idx.detach().cpu().numpy().reshape(-1)
-                except:
-                    crys_idx = np.array(crys_idx)
-
-                predictions_iter = normalizer.denorm(output).detach().cpu().numpy().reshape(crys_idx.shape[0],-1)
-                
-                for i in range(len(crys_idx)):
-                    predictions[crys_idx[i]] = predictions_iter[i]
+        execution = model_params.get("execution", "eager")
+        if cpu_workers is None:
+            cpu_workers = model_params.get("cpu_workers", 1)
+
+        if device.type == "cpu" and cpu_workers > 1:
+            # the workers compile their own copies of the model
+            predictions = parallel_cpu_predictions(model, normalizer, model_params["model_type"], test_loader, cpu_workers, execution)
+        else:
+            compile_model(model, execution, model_params["model_type"])
+            with torch.no_grad():
+                for j, d in enumerate(test_loader):
+                    crys_idx, predictions_iter = predict_batch(model, normalizer, model_params["model_type"], d, device)
+                    for i in range(len(crys_idx)):
+                        predictions[crys_idx[i]] = predictions_iter[i]
 
         if return_ids:
             return predictions, list(predictions.keys())
         return predictions
+
+
+def predict_batch(model, normalizer, model_type, d, device):
+    if model_type == "CGCNN":
+        input_struct = d[0]
+        input_var = (Variable(to_device(input_struct[0], device)),
+                     Variable(to_device(input_struct[1], device)),
+                     to_device(input_struct[2], device),
+                     [to_device(crys_idx, device) for crys_idx in input_struct[3]])
+        output = model(*input_var).view(-1)
+        crys_idx = d[2]
+    else:
+        d.to(device)
+        output = model(d)
+        crys_idx = d.idx
+
+    try:
+        crys_idx = crys_idx.detach().cpu().numpy().reshape(-1)
+    except:
+        crys_idx = np.array(crys_idx)
+
+    predictions_iter = normalizer.denorm(output).detach().cpu().numpy().reshape(crys_idx.shape[0],-1)
+    return crys_idx, predictions_iter
+
+
+### Data-parallel CPU inference: worker processes are started with spawn, so that none inherits the
+### OpenMP/MKL thread pools of this process, and each runs with an equal share of the intra-op threads.
+### The model's parameters are moved to shared memory instead of being copied into every worker. The
+### batches are streamed to the workers through a bounded queue as the loader produces them, and the
+### predictions are merged in batch order, which keeps the order of the sequential loop.
+
+
+def prediction_worker(model, normalizer, model_type, execution, num_threads, batch_queue, result_queue):
+    torch.set_num_threads(num_threads)
+    compile_model(model, execution, model_type)
+    model.eval()
+    with torch.no_grad():
+        for j, d in iter(batch_queue.get, None):
+            crys_idx, predictions_iter = predict_batch(model, normalizer, model_type, d, torch.device("cpu"))
+            result_queue.put((j, crys_idx, predictions_iter))
+
+
+def parallel_cpu_predictions(model, normalizer, model_type, test_loader, cpu_workers, execution="eager"):
+    context = torch.multiprocessing.get_context("spawn")
+    threads_per_worker = max(1, torch.get_num_threads() // cpu_workers)
+    model.share_memory()
+    batch_queue = context.Queue(maxsize=2 * cpu_workers)
+    result_queue = context.Queue()
+    workers = [context.Process(target=prediction_worker, args=(model, normalizer, model_type, execution, threads_per_worker, batch_queue, result_queue), daemon=True)
+               for _ in range(cpu_workers)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        num_batches = 0
+        for j, d in enumerate(test_loader):
+            put_checked(batch_queue, (j, d), workers)
+            num_batches += 1
+        for _ in workers:
+            put_checked(batch_queue, None, workers)
+
+        batch_predictions = {}
+        while len(batch_predictions) < num_batches:
+            j, crys_idx, predictions_iter = get_checked(result_queue, workers)
+            batch_predictions[j] = (crys_idx, predictions_iter)
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    predictions = {}
+    for j in range(num_batches):
+        crys_idx, predictions_iter = batch_predictions[j]
+        for i in range(len(crys_idx)):
+            predictions[crys_idx[i]] = predictions_iter[i]
+    return predictions
+
+
+def put_checked(queue, item, workers):
+    # a worker that died would otherwise leave this process waiting forever
+    while True:
+        check_workers(workers)
+        try:
+            return queue.put(item, timeout=1.0)
+        except Full:
+            pass
+
+
+def get_checked(queue, workers):
+    while True:
+        check_workers(workers)
+        try:
+            return queue.get(timeout=1.0)
+        except Empty:
+            pass
+
+
+def check_workers(workers):
+    for worker in workers:
+        if worker.exitcode not in (None, 0):
+            raise RuntimeError("CPU prediction worker exited with code " + str(worker.exitcode))
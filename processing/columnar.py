@@ -0,0 +1,243 @@
+import os
+import sys
+import json
+import numpy as np
+import pandas as pd
+from ase import Atoms
+from ase.data import atomic_numbers
+from pymatgen.core import Structure, Lattice, Species, Element
+
+
+### Columnar dataset layout: one directory per dataset (e.g. data/training_set.cols/) holding
+###   manifest.json                   row count, index kind and the kind of every column
+###   index.npy / index.json          the DataFrame index
+###   <column>.npy                    numeric columns
+###   <column>.json                   any other column (strings, nested dicts, per-site lists)
+###   <column>.{numbers,frac_coords,lattice,ptr,valid}.npy
+###                                   structure columns, packed into flat arrays with row offsets
+###   <column>.extras.json            oxidation states, site properties and charge of the structures that
+###                                   have any (only written when one does), so that as_dict gives them back
+
+manifest_name = "manifest.json"
+
+
+class PackedStructure():
+    """
+    Ordered periodic structure stored as atomic numbers, fractional coordinates and a lattice matrix,
+    with the oxidation states, site properties and charge of the serialised Structure in extras (if any)
+    """
+
+    __slots__ = ("numbers", "frac_coords", "lattice", "extras")
+
+    def __init__(self, numbers, frac_coords, lattice, extras=None):
+        self.numbers = numbers
+        self.frac_coords = frac_coords
+        self.lattice = lattice
+        self.extras = extras
+
+    def __len__(self):
+        return len(self.numbers)
+
+    @property
+    def cart_coords(self):
+        return np.dot(self.frac_coords, self.lattice)
+
+    def to_structure(self):
+        extras = self.extras or {}
+        species = self.numbers.tolist()
+        if "oxidation_states" in extras:
+            species = [z if oxi is None else Species(Element.from_Z(z).symbol, oxi)
+                       for z, oxi in zip(species, extras["oxidation_states"])]
+        structure = Structure(Lattice(self.lattice), species, self.frac_coords, charge=extras.get("charge"))
+        for site, properties in zip(structure, extras.get("site_properties", [])):
+            site.properties.update(properties)
+        return structure
+
+    def to_ase_atoms(self):
+        return Atoms(numbers=self.numbers, positions=self.cart_coords, cell=self.lattice, pbc=True)
+
+    def as_dict(self):
+        return self.to_structure().as_dict()
+
+
+def pack_structure_dict(struct_dict):
+    # the serialised pymatgen Structure stored in the json datasets
+    lattice = np.array(struct_dict["lattice"]["matrix"], dtype=np.float64)
+    numbers = []
+    frac_coords = []
+    oxidation_states = []
+    site_properties = []
+    for site in struct_dict["sites"]:
+        species = site["species"]
+        if len(species) != 1 or species[0].get("occu", 1) != 1:
+            raise ValueError("Only ordered structures can be packed")
+        numbers.append(atomic_numbers[species[0]["element"]])
+        frac_coords.append(site["abc"])
+        oxidation_states.append(species[0].get("oxidation_state"))
+        site_properties.append(site.get("properties") or {})
+
+    extras = {}
+    if any(oxi is not None for oxi in oxidation_states):
+        extras["oxidation_states"] = oxidation_states
+    if any(site_properties):
+        extras["site_properties"] = site_properties
+    if struct_dict.get("charge"):
+        extras["charge"] = struct_dict["charge"]
+    return PackedStructure(np.array(numbers, dtype=np.int16), np.array(frac_coords, dtype=np.float64).reshape(-1, 3), lattice,
+                           extras or None)
+
+
+def is_structure_dict(value):
+    return isinstance(value, dict) and "lattice" in value and "sites" in value
+
+
+def is_missing(value):
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+
+def to_object_array(items):
+    # fill element-wise so that numpy does not try to unpack nested lists
+    values = np.empty(len(items), dtype=object)
+    for i, item in enumerate(items):
+        values[i] = item
+    return values
+
+
+def columnar_path(json_path):
+    root, _ = os.path.splitext(json_path)
+    return root + ".cols"
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError("Object of type " + type(value).__name__ + " is not JSON serializable")
+
+
+def _write_structure_column(values, out_dir, column):
+    numbers, frac_coords, lattices, counts, valid, extras = [], [], [], [], [], []
+    for value in values:
+        if is_missing(value):
+            counts.append(0)
+            lattices.append(np.full((3, 3), np.nan))
+            valid.append(False)
+            extras.append(None)
+            continue
+        packed = value if isinstance(value, PackedStructure) else pack_structure_dict(value)
+        numbers.append(packed.numbers)
+        frac_coords.append(packed.frac_coords)
+        lattices.append(packed.lattice)
+        counts.append(len(packed))
+        valid.append(True)
+        extras.append(packed.extras)
+
+    ptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    np.save(os.path.join(out_dir, column + ".numbers.npy"), np.concatenate(numbers) if numbers else np.zeros(0, dtype=np.int16))
+    np.save(os.path.join(out_dir, column + ".frac_coords.npy"), np.concatenate(frac_coords) if frac_coords else np.zeros((0, 3)))
+    np.save(os.path.join(out_dir, column + ".lattice.npy"), np.array(lattices, dtype=np.float64).reshape(-1, 3, 3))
+    np.save(os.path.join(out_dir, column + ".ptr.npy"), ptr)
+    np.save(os.path.join(out_dir, column + ".valid.npy"), np.array(valid, dtype=bool))
+    extras_path = os.path.join(out_dir, column + ".extras.json")
+    if any(extra is not None for extra in extras):
+        with open(extras_path, "w") as f:
+            json.dump(extras, f, default=_json_default)
+    elif os.path.exists(extras_path):
+        os.remove(extras_path)
+
+
+def _read_structure_column(in_dir, column):
+    numbers = np.load(os.path.join(in_dir, column + ".numbers.npy"))
+    frac_coords = np.load(os.path.join(in_dir, column + ".frac_coords.npy"))
+    lattices = np.load(os.path.join(in_dir, column + ".lattice.npy"))
+    ptr = np.load(os.path.join(in_dir, column + ".ptr.npy"))
+    valid = np.load(os.path.join(in_dir, column + ".valid.npy"))
+    extras_path = os.path.join(in_dir, column + ".extras.json")
+    if os.path.exists(extras_path):
+        with open(extras_path) as f:
+            extras = json.load(f)
+    else:
+        extras = [None] * len(valid)
+
+    values = np.full(len(valid), np.nan, dtype=object)
+    for i in np.flatnonzero(valid):
+        values[i] = PackedStructure(numbers[ptr[i]:ptr[i + 1]], frac_coords[ptr[i]:ptr[i + 1]], lattices[i], extras[i])
+    return values
+
+
+def write_columnar(df, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {"num_rows": len(df), "columns": {}}
+
+    if pd.api.types.is_integer_dtype(df.index):
+        np.save(os.path.join(out_dir, "index.npy"), df.index.values)
+        manifest["index"] = "numeric"
+    else:
+        with open(os.path.join(out_dir, "index.json"), "w") as f:
+            json.dump(df.index.tolist(), f, default=_json_default)
+        manifest["index"] = "object"
+
+    for column in df.columns:
+        values = df[column]
+        non_missing = [value for value in values.head(100) if not is_missing(value)]
+
+        if len(non_missing) > 0 and all(is_structure_dict(value) or isinstance(value, PackedStructure) for value in non_missing):
+            _write_structure_column(values.values, out_dir, column)
+            manifest["columns"][column] = "structure"
+        elif pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            np.save(os.path.join(out_dir, column + ".npy"), values.values)
+            manifest["columns"][column] = "numeric"
+        else:
+            with open(os.path.join(out_dir, column + ".json"), "w") as f:
+                json.dump(values.tolist(), f, default=_json_default)
+            manifest["columns"][column] = "object"
+
+    with open(os.path.join(out_dir, manifest_name), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def get_columnar_columns(in_dir):
+    with open(os.path.join(in_dir, manifest_name)) as f:
+        manifest = json.load(f)
+    return list(manifest["columns"].keys())
+
+
+def read_columnar(in_dir, columns=None):
+    with open(os.path.join(in_dir, manifest_name)) as f:
+        manifest = json.load(f)
+
+    if manifest["index"] == "numeric":
+        index = pd.Index(np.load(os.path.join(in_dir, "index.npy")))
+    else:
+        with open(os.path.join(in_dir, "index.json")) as f:
+            index = pd.Index(json.load(f))
+
+    if columns is None:
+        columns = list(manifest["columns"].keys())
+
+    data = {}
+    for column in columns:
+        kind = manifest["columns"][column]
+        if kind == "structure":
+            data[column] = _read_structure_column(in_dir, column)
+        elif kind == "numeric":
+            data[column] = np.load(os.path.join(in_dir, column + ".npy"))
+        else:
+            with open(os.path.join(in_dir, column + ".json")) as f:
+                data[column] = to_object_array(json.load(f))
+
+    return pd.DataFrame(data, index=index, columns=columns)
+
+
+def convert_json_to_columnar(json_path, out_dir=None):
+    if out_dir is None:
+        out_dir = columnar_path(json_path)
+    write_columnar(pd.read_json(json_path), out_dir)
+    return out_dir
+
+
+if __name__ == '__main__':
+    # e.g. python -m processing.columnar data/training_set.json data/validation_set.json data/edge_dataset.json
+    for json_path in sys.argv[1:]:
+        print("Converted " + json_path + " to " + convert_json_to_columnar(json_path))
@@ -1,5 +1,6 @@
 from models.PerovskiteOrderingGCNNs_cgcnn.cgcnn.model import CrystalGraphConvNet, PerSiteCGCNet, Normalizer
 from training.hyperparameters.default import get_default_cgcnn_hyperparameters
+from processing.dataloader.dataset_stats import get_dataset_stats
 import numpy as np
 from tqdm import tqdm
 import torch
@@ -9,13 +10,19 @@ def get_cgcnn_model(hyperparameters,train_loader,per_site=False):
     if hyperparameters == "default":
         hyperparameters = get_default_cgcnn_hyperparameters()
 
-    training_labels = []
-    
-    for i, (struct, target, _) in enumerate(tqdm(train_loader)):
-        training_labels.append(target.view(-1,1))
-        
-    training_labels = np.concatenate(training_labels).ravel()
-    normalizer = Normalizer(torch.tensor(training_labels))
+    stats = get_dataset_stats(train_loader)
+    if stats is not None:
+        # the label statistics were published with the loader; one structure gives the feature lengths
+        normalizer = get_normalizer_from_stats(stats)
+        struct, _, _ = train_loader.dataset[0]
+    else:
+        training_labels = []
+
+        for i, (struct, target, _) in enumerate(tqdm(train_loader)):
+            training_labels.append(target.view(-1,1))
+
+        training_labels = np.concatenate(training_labels).ravel()
+        normalizer = Normalizer(torch.tensor(training_labels))
     
     orig_atom_fea_len = struct[0].shape[-1]
     nbr_fea_len = struct[1].shape[-1]
@@ -35,4 +42,15 @@ def get_cgcnn_model(hyperparameters,train_loader,per_site=False):
                                     n_h=hyperparameters["n_h"],
                                     classification=False)
 
-    return CGC_model, normalizer
\ No newline at end of file
+    return CGC_model, normalizer
+
+
+def get_normalizer_from_stats(stats):
+    # the same mean and (unbiased) std as Normalizer computes from the full label tensor (NaN if any label
+    # is NaN); the labels are tensors of the default dtype (float32), so the statistics, accumulated in
+    # float64, are rounded to it
+    dtype = torch.get_default_dtype()
+    normalizer = Normalizer(torch.zeros(2, dtype=dtype))
+    normalizer.load_state_dict({"mean": torch.tensor(stats["target"]["mean"], dtype=dtype),
+                                "std": torch.tensor(stats["target"]["std"], dtype=dtype)})
+    return normalizer
@@ -2,6 +2,8 @@ from typing import Union, Dict
 from models.PerovskiteOrderingGCNNs_cgcnn.cgcnn.model import Normalizer
 from models.PerovskiteOrderingGCNNs_e3nn.utils.utils_model import Network
 from training.hyperparameters.default import get_default_e3nn_hyperparameters
+from processing.dataloader.dataset_stats import get_dataset_stats
+from processing.create_model.create_cgcnn_model import get_normalizer_from_stats
 import torch_scatter
 import torch
 import torch.nn.functional as F
@@ -21,6 +23,9 @@ class PeriodicNetwork(Network):
             
         super().__init__(**kwargs)
 
+        # fixed at construction, so that forward branches on plain attributes (which compilers can specialise on)
+        self.num_hidden_layers = n_hid
+
         # embed the mass-weighted one-hot encoding
         self.em = nn.Linear(in_dim, em_dim)
 
@@ -47,10 +52,10 @@ class PeriodicNetwork(Network):
         else:
             crys_fea = torch_scatter.scatter_mean(atom_fea, data.batch, dim=0)       
                
-        if hasattr(self, 'conv_to_fc') and hasattr(self, 'conv_to_fc_relu'):
+        if self.num_hidden_layers > 0:
             crys_fea = self.conv_to_fc_relu(self.conv_to_fc(crys_fea))
             
-            if hasattr(self, 'fcs') and hasattr(self, 'relus'):
+            if self.num_hidden_layers > 1:
                 for fc, relu in zip(self.fcs, self.relus):
                     crys_fea = relu(fc(crys_fea))        
         
@@ -72,6 +77,7 @@ def get_e3nn_model(hyperparameters, train_loader, per_site = False):
     em_dim = hyperparameters['len_embedding_feature_vector']
     out_dim = hyperparameters['num_hidden_feature']
 
+    stats = get_dataset_stats(train_loader)
     n_train_mean = get_neighbors(train_loader)
     
     model = PeriodicNetwork(
@@ -94,11 +100,14 @@ def get_e3nn_model(hyperparameters, train_loader, per_site = False):
         reduce_output=True                                   # whether or not to aggregate features of all atoms at the end
     )
 
-    sample_target = []
-    for i, temp in enumerate(train_loader):
-        sample_target.append(temp.target.view(-1))
-    sample_target = np.concatenate(sample_target).ravel()
-    normalizer = Normalizer(torch.tensor(sample_target))
+    if stats is not None:
+        normalizer = get_normalizer_from_stats(stats)
+    else:
+        sample_target = []
+        for i, temp in enumerate(train_loader):
+            sample_target.append(temp.target.view(-1))
+        sample_target = np.concatenate(sample_target).ravel()
+        normalizer = Normalizer(torch.tensor(sample_target))
 
     model.pool = True
     return model, normalizer
@@ -106,11 +115,18 @@ def get_e3nn_model(hyperparameters, train_loader, per_site = False):
 
 def get_neighbors(train_loader):
     # https://github.com/ninarina12/phononDoS_tutorial/blob/main/phononDoS.ipynb
+    # mean number of edges leaving each atom; cached in the loader's statistics manifest once computed
+    stats = get_dataset_stats(train_loader)
+    if stats is not None and stats["mean_neighbor_count"] is not None:
+        return stats["mean_neighbor_count"]
+
     n = []
 
     for i, batch in enumerate(train_loader):
         N = batch.pos.shape[0]
-        for i in range(N):
-            n.append(len((batch.edge_index[0] == i).nonzero()))
+        n.append(torch.bincount(batch.edge_index[0], minlength=N).cpu().numpy())
 
-    return np.array(n).mean()
\ No newline at end of file
+    n_mean = np.concatenate(n).mean()
+    if stats is not None:
+        stats["mean_neighbor_count"] = float(n_mean)
+    return n_mean
@@ -1,5 +1,6 @@
 from models.PerovskiteOrderingGCNNs_painn.nff.train import get_model
 from training.hyperparameters.default import get_default_painn_hyperparameters
+from processing.dataloader.dataset_stats import get_dataset_stats
 import numpy as np
 
 def get_painn_model(hyperparameters,train_loader, interpolation, prop):
@@ -12,13 +13,22 @@ def get_painn_model(hyperparameters,train_loader, interpolation, prop):
     else:
         prop_name = prop
 
-    training_labels = []
-    
-    for i, data in enumerate(train_loader):
-        
-        training_labels.append(data[prop_name])
+    stats = get_dataset_stats(train_loader)
+    if stats is not None:
+        # np.nanmean and np.nanstd of the labels, published with the loader and rounded to float32 like
+        # the statistics of the float32 label tensors
+        target_mean = np.float32(stats["target"]["nanmean"]).item()
+        target_std = np.float32(stats["target"]["nanstd"]).item()
+    else:
+        training_labels = []
+
+        for i, data in enumerate(train_loader):
+
+            training_labels.append(data[prop_name])
 
-    training_data = np.concatenate(training_labels).ravel()
+        training_data = np.concatenate(training_labels).ravel()
+        target_mean = np.nanmean(training_data).item()
+        target_std = np.nanstd(training_data).item()
 
     modelparams = {"feat_dim": 2**hyperparameters["log2_feat_dim"], 
                    "activation": hyperparameters["activation"], 
@@ -31,8 +41,8 @@ def get_painn_model(hyperparameters,train_loader, interpolation, prop):
                    "learnable_k": False, 
                    "conv_dropout": 0.0, 
                    "readout_dropout": 0.0, 
-                   "means": {prop_name: np.nanmean(training_data).item()}, 
-                   "stddevs": {prop_name: np.nanstd(training_data).item()}
+                   "means": {prop_name: target_mean}, 
+                   "stddevs": {prop_name: target_std}
                   }
 
         
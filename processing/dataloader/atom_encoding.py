@@ -0,0 +1,42 @@
+import os
+import json
+import numpy as np
+import torch
+
+
+atom_init_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "atom_init.json")
+
+_atom_encoding = None
+
+
+class AtomEncoding():
+    """
+    Process-wide atom encoding tables, built once from atom_init.json.
+    The CGCNN-type embedding table is indexed directly by atomic number (row 0 is padding),
+    so node features of a structure are a single fancy-index over its atomic numbers.
+    """
+
+    def __init__(self, path=atom_init_path):
+        with open(path) as f:
+            atom_inits = json.load(f)
+
+        # {"Z": np.float32 array}, the format expected by nff/CGCNN initializers
+        self.atom_inits = {}
+        for key, value in atom_inits.items():
+            self.atom_inits[key] = np.array(value, dtype=np.float32)
+
+        # CGCNN-type embedding for Z = 1, ..., 100
+        cgcnn_table = np.zeros((101, len(self.atom_inits["1"])), dtype=np.float32)
+        for Z in range(1, 101):
+            cgcnn_table[Z] = self.atom_inits[str(Z)]
+        self.cgcnn_table = torch.from_numpy(cgcnn_table)
+
+    def cgcnn_features(self, numbers):
+        return self.cgcnn_table[torch.as_tensor(np.asarray(numbers), dtype=torch.long)]
+
+
+def get_atom_encoding_registry():
+    global _atom_encoding
+    if _atom_encoding is None:
+        _atom_encoding = AtomEncoding()
+    return _atom_encoding
@@ -0,0 +1,186 @@
+import time
+import numpy as np
+from torch.utils.data import Sampler
+
+from processing.dataloader.packed_store import PackedGraphDataset
+
+
+### Dynamic batching: instead of a fixed number of structures, each batch holds as many structures as
+### fit into a budget of atoms (nodes) or edges. Every epoch the dataset is shuffled and cut into pools;
+### the structures of a pool are sorted by size and packed greedily, so that batches are filled evenly,
+### and the batches of all pools are shuffled together.
+
+
+class BudgetBatchSampler(Sampler):
+    """
+    Batch sampler packing items of the given sizes into batches of at most max_budget in total
+    (an item larger than the budget forms a batch of its own). pool_batches sets how many batches'
+    worth of items are sorted together: larger pools pack more tightly but mix sizes less.
+    The batches of the next epoch are planned in advance, so that len() is exact.
+    """
+
+    def __init__(self, sizes, max_budget, shuffle=True, pool_batches=50, seed=None):
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        if len(self.sizes) == 0:
+            raise ValueError("Cannot batch an empty dataset")
+        if max_budget <= 0:
+            raise ValueError("max_budget must be positive")
+        self.max_budget = max_budget
+        self.shuffle = shuffle
+        self.pool_size = max(1, int(pool_batches * max_budget / max(1.0, self.sizes.mean())))
+        self.rng = np.random.default_rng(seed)
+        self.last_epoch_stats = None
+        self._batches = self._plan()
+
+    def _plan(self):
+        order = self.rng.permutation(len(self.sizes)) if self.shuffle else np.arange(len(self.sizes))
+        batches = []
+        for start in range(0, len(order), self.pool_size):
+            pool = order[start:start + self.pool_size]
+            # stable sort, so that equal sizes keep their random order
+            pool = pool[np.argsort(self.sizes[pool], kind="stable")]
+            batch = []
+            total = 0
+            for i in pool:
+                if batch and total + self.sizes[i] > self.max_budget:
+                    batches.append(batch)
+                    batch = []
+                    total = 0
+                batch.append(int(i))
+                total += self.sizes[i]
+            if batch:
+                batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in self.rng.permutation(len(batches))]
+        return batches
+
+    def reseed(self, seed):
+        # restart the sequence of epochs from seed, e.g. to plan the same batches on every rank
+        self.rng = np.random.default_rng(seed)
+        self._batches = self._plan()
+
+    def packing_stats(self, batches=None):
+        # fill of the budget, averaged over batches, and the spread of batch sizes
+        batches = self._batches if batches is None else batches
+        totals = np.array([self.sizes[batch].sum() for batch in batches])
+        counts = np.array([len(batch) for batch in batches])
+        return {"num_batches": len(batches),
+                "packing_efficiency": float(np.minimum(totals, self.max_budget).sum() / (len(batches) * self.max_budget)),
+                "max_batch_budget": int(totals.max()),
+                "mean_structures_per_batch": float(counts.mean()),
+                "min_structures_per_batch": int(counts.min()),
+                "max_structures_per_batch": int(counts.max())}
+
+    def __iter__(self):
+        batches = self._batches
+        self.last_epoch_stats = self.packing_stats(batches)
+        self._batches = self._plan()
+        return iter(batches)
+
+    def __len__(self):
+        return len(self._batches)
+
+
+def get_graph_budget_sizes(dataset, unit):
+    # number of atoms or edges of every e3nn graph (list of Data or packed store)
+    if isinstance(dataset, PackedGraphDataset):
+        key = "pos" if unit == "nodes" else "edge_index"
+        if key not in dataset.fields:
+            raise ValueError("Edge budgets need stored edges (not available with neighbor_engine='on_the_fly')")
+        shapes = dataset.fields[key][3]
+        return shapes[:, 0] if unit == "nodes" else shapes[:, 1]
+
+    sizes = []
+    for data in dataset:
+        if unit == "nodes":
+            sizes.append(data.pos.shape[0])
+        elif "edge_index" in data:
+            sizes.append(data.edge_index.shape[1])
+        else:
+            raise ValueError("Edge budgets need stored edges (not available with neighbor_engine='on_the_fly')")
+    return np.array(sizes, dtype=np.int64)
+
+
+def get_painn_budget_sizes(dataset, unit):
+    # number of atoms or neighbor pairs of every structure of an nff Dataset
+    if unit == "nodes":
+        return np.array([len(nxyz) for nxyz in dataset.props['nxyz']], dtype=np.int64)
+    return np.array([len(nbrs) for nbrs in dataset.props['nbr_list']], dtype=np.int64)
+
+
+def report_packing(sampler):
+    stats = sampler.packing_stats()
+    print("Budget batching: " + str(stats["num_batches"]) + " batches, " + "{:.1%}".format(stats["packing_efficiency"])
+          + " of the budget filled, " + "{:.1f}".format(stats["mean_structures_per_batch"]) + " structures per batch")
+
+
+class CompositionGroupSampler(BudgetBatchSampler):
+    """
+    BudgetBatchSampler over the CompData groups of a contrastive dataset, packing whole groups up to an
+    atom budget. A group is never split across batches. With group_formulas, the pairwise terms are
+    counted as contrastive_loss forms its segments by default (CompBatch.group_ptr): one per run of equal
+    compositions, so neighbouring groups of one formula merge. Without, every group is its own segment
+    (contrastive_segments="group") and the terms of an epoch are those of the fixed-size loader. Each
+    epoch records the terms it delivered and how many per second the loader consumed.
+    """
+
+    def __init__(self, sizes, group_lengths, max_budget, group_formulas=None, shuffle=True, pool_batches=50, seed=None):
+        self.group_lengths = np.asarray(group_lengths, dtype=np.int64)
+        self.group_formulas = None if group_formulas is None else list(group_formulas)
+        super().__init__(sizes, max_budget, shuffle=shuffle, pool_batches=pool_batches, seed=seed)
+
+    def pairwise_terms(self, batch):
+        if self.group_formulas is None:
+            lengths = self.group_lengths[batch]
+            return int((lengths**2 - lengths).sum())
+
+        terms = 0
+        run = 0
+        for position, i in enumerate(batch):
+            if position > 0 and self.group_formulas[i] != self.group_formulas[batch[position - 1]]:
+                terms += run**2 - run
+                run = 0
+            run += self.group_lengths[i]
+        return int(terms + run**2 - run)
+
+    def packing_stats(self, batches=None):
+        batches = self._batches if batches is None else batches
+        stats = super().packing_stats(batches)
+        stats["pairwise_terms"] = sum(self.pairwise_terms(batch) for batch in batches)
+        return stats
+
+    def __iter__(self):
+        batches = self._batches
+        stats = self.packing_stats(batches)
+        self._batches = self._plan()
+        start = time.time()
+        for batch in batches:
+            yield batch
+        stats["pairwise_terms_per_second"] = stats["pairwise_terms"] / max(time.time() - start, 1e-9)
+        self.last_epoch_stats = stats
+
+
+def get_comp_group_info(comp_data):
+    # atoms, structures and composition id of every CompData group (list of CompData or packed store)
+    if isinstance(comp_data, PackedGraphDataset):
+        group_ptr = comp_data.group_ptr
+        atoms = comp_data.fields["pos"][3][:, 0]
+        sizes = np.array([atoms[group_ptr[i]:group_ptr[i + 1]].sum() for i in range(len(group_ptr) - 1)], dtype=np.int64)
+        _, comp_ids, comp_ptr, _ = comp_data.fields["comp_id"]
+        formulas = [int(comp_ids[comp_ptr[start]]) for start in group_ptr[:-1]]
+        return sizes, np.diff(group_ptr), formulas
+
+    sizes = np.array([sum(data.pos.shape[0] for data in group.structures) for group in comp_data], dtype=np.int64)
+    lengths = np.array([len(group.structures) for group in comp_data], dtype=np.int64)
+    formulas = [int(group.structures[0].comp_id) for group in comp_data]
+    return sizes, lengths, formulas
+
+
+def report_group_packing(sampler, batch_size):
+    # the terms per second of both loaders are measured by the training loop
+    report_packing(sampler)
+    stats = sampler.packing_stats()
+    print("Composition groups: " + str(stats["pairwise_terms"]) + " pairwise terms per epoch in " + str(stats["num_batches"])
+          + " batches (" + str(-(-len(sampler.group_lengths) // batch_size)) + " batches of " + str(batch_size) + " groups), "
+          + "{:.1f}".format(stats["pairwise_terms"] / stats["num_batches"]) + " per batch")
@@ -1,106 +1,212 @@
 import torch_geometric as tg
 import torch
-import json
 import numpy as np
+import pandas as pd
 import random
-from tqdm import tqdm
-from ase import Atom
+from functools import partial
 from ase.neighborlist import neighbor_list
 
+from processing.dataloader.atom_encoding import get_atom_encoding_registry
 from processing.dataloader.contrastive_data import CompData
+from processing.dataloader.graph_cache import graph_cache_key
+from processing.dataloader.neighbor_list import batched_neighbor_lists, get_structure_templates
+from processing.dataloader.parallel import parallel_map
 
 default_dtype = torch.float32
 
 
-def get_atom_encoding():
-    # one-hot encoding atom type and mass (from Mingda Li, et al. Adv. Sci. 2021, 8, 2004214)
-    type_encoding = {}
-    specie_am = []
-    for Z in range(1, 119):
-        specie = Atom(Z)
-        type_encoding[specie.symbol] = Z - 1
-        specie_am.append(specie.mass)
-
-    atom_inits_atomic_mass = torch.diag(torch.tensor(specie_am))
-
-    # CGCNN-type embedding
-    f = open("processing/dataloader/atom_init.json")
-    atom_inits = json.load(f)
-
-    atom_inits_cgcnn = []
-    for i in range(1, 101):
-        atom_inits_cgcnn.append(atom_inits[str(i)])
-    atom_inits_cgcnn = torch.tensor(atom_inits_cgcnn, dtype=default_dtype)
-
-    return type_encoding, atom_inits_cgcnn, atom_inits_atomic_mass
-
-
-def build_e3nn_data(entry, prop, r_max, per_site = False):
+def build_e3nn_data(entry, prop, r_max, per_site = False, edges = None, with_edges = True, compact = False):
     #### TAKEN FROM https://github.com/ninarina12/phononDoS_tutorial/blob/main/phononDoS.ipynb
     torch.set_default_dtype(default_dtype)
-    type_encoding, atom_inits_cgcnn, atom_inits_atomic_mass = get_atom_encoding()
-    symbols = list(entry['ase_structure'].symbols).copy()
+    atom_encoding = get_atom_encoding_registry()
+    numbers = entry['ase_structure'].numbers
     positions = torch.from_numpy(entry['ase_structure'].positions.copy()).float()
     lattice = torch.from_numpy(entry['ase_structure'].cell.array.copy()).float().unsqueeze(0)
+
+    if compact:
+        # atomic numbers instead of embeddings; x and z are looked up when batches are collated (see CompactGraphCollater)
+        data = tg.data.Data(
+            pos=positions,
+            species=torch.from_numpy(numbers.astype(np.int8)),
+            comp_id = get_comp_id(entry),
+            target=get_target_data(entry, prop, per_site),
+            idx=torch.tensor([entry['idx']])
+        )
+        # the lattice is only needed to build edges on the fly
+        if not with_edges:
+            data.lattice = lattice
+            return data
+    else:
+        data = tg.data.Data(
+            pos=positions, lattice=lattice,
+            species=torch.from_numpy(numbers.astype(np.int8)), # atomic numbers, collated as one tensor
+            comp_id = get_comp_id(entry),
+            x=atom_encoding.cgcnn_features(numbers), # CGCNN-type embedding (node feature)
+            z=atom_encoding.cgcnn_features(numbers), # CGCNN-type embedding (node attribute)
+            target=get_target_data(entry, prop, per_site),
+            idx=torch.tensor([entry['idx']]).unsqueeze(0)
+        )
+
+    # without edges, the periodic graph is built on the fly when batches are collated
+    if not with_edges:
+        return data
         
     # edge_src and edge_dst are the indices of the central and neighboring atom, respectively
     # edge_shift indicates whether the neighbors are in different images or copies of the unit cell
-    edge_src, edge_dst, edge_shift = neighbor_list("ijS", a=entry['ase_structure'], cutoff=r_max, self_interaction=True)
-    #print(edge_src)
-    #print(edge_dst)
-    #print(edge_shift)
+    if edges is None:
+        edge_src, edge_dst, edge_shift = neighbor_list("ijS", a=entry['ase_structure'], cutoff=r_max, self_interaction=True)
+    else:
+        edge_src, edge_dst, edge_shift = edges
 
     # compute the relative distances and unit cell shifts from periodic boundaries
     edge_batch = positions.new_zeros(positions.shape[0], dtype=torch.long)[torch.from_numpy(edge_src)]
-    #print(edge_batch)
-    #print(positions[torch.from_numpy(edge_dst)].type())
-    #print(torch.tensor(edge_shift).type())
-    #print(lattice[edge_batch].type())
     edge_vec = (positions[torch.from_numpy(edge_dst)]
                 - positions[torch.from_numpy(edge_src)]
                 + torch.einsum('ni,nij->nj', torch.tensor(edge_shift, dtype = default_dtype), lattice[edge_batch]))
 
-    #print(edge_vec)
-    #print(edge_vec.type())
-    
+    data.edge_index = torch.stack([torch.LongTensor(edge_src), torch.LongTensor(edge_dst)], dim=0)
+    data.edge_vec = edge_vec
+
+    if compact:
+        data.edge_shift = torch.tensor(edge_shift, dtype=torch.int8)
+        return data
+
     # compute edge lengths (rounded only for plotting purposes)
     edge_len = np.around(edge_vec.norm(dim=1).numpy(), decimals=2)
+
+    data.edge_shift = torch.tensor(edge_shift, dtype=default_dtype)
+    data.edge_len = edge_len
         
-    if "formula" in entry:
-        curr_comp = entry["formula"]
-    else:
-        curr_comp = None
+    return data
+
+
+class CompactGraphCollater:
+    # wraps a collate function and adds the CGCNN-type embedding of compact graphs to the collated batch,
+    # as one tensor referenced by both x (node feature) and z (node attribute)
+    def __init__(self, collate_fn):
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch):
+        batch = self.collate_fn(batch)
+        batch.x = get_atom_encoding_registry().cgcnn_features(batch.species)
+        batch.z = batch.x
+        return batch
+
 
+def build_e3nn_data_with_edges(item, prop, r_max, per_site = False, compact = False):
+    entry, edges = item
+    return build_e3nn_data(entry, prop, r_max, per_site=per_site, edges=edges, compact=compact)
+
+
+def get_comp_id(entry):
+    # integer id of the composition (see get_entry_records), -1 without formulas
+    return torch.tensor([entry.get("comp_id", -1)], dtype=torch.long)
+
+
+def get_target_data(entry, prop, per_site=False):
     if per_site:
-        target_data = torch.tensor(entry[prop]).unsqueeze(0)
+        return torch.tensor(entry[prop]).unsqueeze(0)
     else:
-        target_data = torch.tensor([entry[prop]]).unsqueeze(0)
-
-    data = tg.data.Data(
-        pos=positions, lattice=lattice, symbol=symbols,
-        comp = curr_comp,
-        x=atom_inits_cgcnn[[type_encoding[specie] for specie in symbols]], # CGCNN-type embedding (node feature)
-        z=atom_inits_cgcnn[[type_encoding[specie] for specie in symbols]], # CGCNN-type embedding (node attribute)
-        edge_index=torch.stack([torch.LongTensor(edge_src), torch.LongTensor(edge_dst)], dim=0),
-        edge_shift=torch.tensor(edge_shift, dtype=default_dtype),
-        edge_vec=edge_vec,
-        edge_len=edge_len,
-        target=target_data,
-        idx=torch.tensor([entry['idx']]).unsqueeze(0)
-    )
-        
+        return torch.tensor([entry[prop]]).unsqueeze(0)
+
+
+def refresh_entry_fields(data, entry, prop, per_site=False, compact=False):
+    # the row identity and label are not part of the structure key, so take them from the entry
+    data.comp_id = get_comp_id(entry)
+    data.target = get_target_data(entry, prop, per_site)
+    data.idx = torch.tensor([entry['idx']]) if compact else torch.tensor([entry['idx']]).unsqueeze(0)
     return data
 
 
-def construct_contrastive_dataset(df,prop,r_max):   
+def get_entry_records(df, prop):
+    # the per-row fields used by build_e3nn_data, as plain dicts that are cheap to send to workers
+    columns = ['ase_structure', prop, 'idx']
+    if 'formula' in df.columns:
+        columns.append('formula')
+    records = df[columns].to_dict('records')
+    if 'formula' in df.columns:
+        # compositions are numbered in order of appearance, so that groups are compared as integers
+        comp_ids = pd.factorize(df['formula'])[0]
+        for record, comp_id in zip(records, comp_ids):
+            record['comp_id'] = int(comp_id)
+    return records
+
+
+def get_ase_neighbor_list(atoms, r_max):
+    return neighbor_list("ijS", a=atoms, cutoff=r_max, self_interaction=True)
+
+
+def build_e3nn_dataset(df, prop, r_max, per_site=False, graph_cache=None, num_workers=0, chunksize=64, neighbor_engine="ase", reuse_templates=False, compact=False):
+    # neighbor_engine: "ase" (per-structure ase neighbor_list), "batched" (vectorised search over all structures)
+    # or "on_the_fly" (no edges are stored; they are built from each collated batch)
+    # reuse_templates: compute the neighbor list once per lattice/positions template and share it across its orderings
+    # compact: graphs in the compact schema of build_e3nn_data, to be collated with CompactGraphCollater
+    if neighbor_engine == "on_the_fly":
+        graph_cache = None
+        reuse_templates = False
+    if neighbor_engine not in ("ase", "batched", "on_the_fly"):
+        raise ValueError("neighbor_engine must be 'ase', 'batched' or 'on_the_fly'")
+
+    entries = get_entry_records(df, prop)
+    data_list = [None] * len(entries)
+    keys = [None] * len(entries)
+    missing = []
+
+    for i, entry in enumerate(entries):
+        if graph_cache is None:
+            missing.append(i)
+            continue
+        keys[i] = graph_cache_key(entry['ase_structure'], prop, r_max, per_site, compact=compact)
+        data = graph_cache.get(keys[i])
+        if data is None:
+            missing.append(i)
+        else:
+            data_list[i] = refresh_entry_fields(data, entry, prop, per_site, compact=compact)
+
+    missing_entries = [entries[i] for i in missing]
+    if reuse_templates:
+        # only node features (and edge vectors) are built per structure
+        template_of = get_structure_templates([entry['ase_structure'] for entry in missing_entries])
+        templates = sorted(set(template_of))
+        template_atoms = [missing_entries[i]['ase_structure'] for i in templates]
+        if neighbor_engine == "batched":
+            template_edges = batched_neighbor_lists(template_atoms, r_max)
+        else:
+            template_edges = parallel_map(partial(get_ase_neighbor_list, r_max=r_max), template_atoms,
+                                          num_workers=num_workers, chunksize=chunksize)
+        edges_of = dict(zip(templates, template_edges))
+        missing_entries = [(entry, edges_of[template]) for entry, template in zip(missing_entries, template_of)]
+        build_fn = partial(build_e3nn_data_with_edges, prop=prop, r_max=r_max, per_site=per_site, compact=compact)
+    elif neighbor_engine == "ase":
+        build_fn = partial(build_e3nn_data, prop=prop, r_max=r_max, per_site=per_site, compact=compact)
+    elif neighbor_engine == "batched":
+        edges = batched_neighbor_lists([entry['ase_structure'] for entry in missing_entries], r_max)
+        missing_entries = list(zip(missing_entries, edges))
+        build_fn = partial(build_e3nn_data_with_edges, prop=prop, r_max=r_max, per_site=per_site, compact=compact)
+    else:
+        build_fn = partial(build_e3nn_data, prop=prop, r_max=r_max, per_site=per_site, with_edges=False, compact=compact)
+
+    built_data = parallel_map(build_fn, missing_entries, num_workers=num_workers, chunksize=chunksize)
+
+    for i, data in zip(missing, built_data):
+        data_list[i] = data
+        if graph_cache is not None:
+            graph_cache.put(keys[i], data)
+
+    return data_list
+
+
+def construct_contrastive_dataset(df,prop,r_max,graph_cache=None,num_workers=0,chunksize=64,neighbor_engine="ase",reuse_templates=False,compact=False,group_size=6):   
+    # group_size: structures per CompData; None keeps every composition in one CompData
+    data_list = build_e3nn_dataset(df, prop, r_max, graph_cache=graph_cache, num_workers=num_workers, chunksize=chunksize,
+                                   neighbor_engine=neighbor_engine, reuse_templates=reuse_templates, compact=compact)
+
     comp_to_data = {}
-    for _,row in tqdm(df.iterrows(), total=df.shape[0]):     
-        curr_data = build_e3nn_data(row, prop, r_max)
-        
-        if row.formula in comp_to_data:
-            comp_to_data[row.formula].append(curr_data)
+    for formula, curr_data in zip(df['formula'], data_list):     
+        if formula in comp_to_data:
+            comp_to_data[formula].append(curr_data)
         else:
-            comp_to_data[row.formula] = [curr_data]
+            comp_to_data[formula] = [curr_data]
                 
     stored_data = []
     for formula in comp_to_data.keys():
@@ -109,7 +215,7 @@ def construct_contrastive_dataset(df,prop,r_max):
         for datapoint in comp_to_data[formula]:           
             curr_arr.append(datapoint)
             
-            if len(curr_arr)==6:
+            if len(curr_arr)==group_size:
                 stored_data.append(CompData(curr_arr))
                 curr_arr = []
         
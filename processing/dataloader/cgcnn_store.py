@@ -0,0 +1,40 @@
+import torch_geometric as tg
+from torch.utils.data import DataLoader
+from torch.utils.data.sampler import RandomSampler
+
+from processing.dataloader.packed_store import write_packed_graphs, PackedGraphDataset
+
+
+### CGCNN inputs precomputed once and kept in a packed store (see packed_store.py): the items of the
+### dataset behind get_cgcnn_loader, ((atom_fea, nbr_fea, nbr_fea_idx), target, cif_id), are stored as
+### flat arrays, together with the loader's collate function, so that loaders of any batch size can be
+### built on top of the store without featurising the structures again
+
+
+def write_cgcnn_store(data_loader, path):
+    data_list = []
+    for (atom_fea, nbr_fea, nbr_fea_idx), target, cif_id in data_loader.dataset:
+        data_list.append(tg.data.Data(atom_fea=atom_fea, nbr_fea=nbr_fea, nbr_fea_idx=nbr_fea_idx, target=target, cif_id=cif_id))
+
+    metadata = {
+        "collate_fn": data_loader.collate_fn,
+        "shuffle": isinstance(data_loader.sampler, RandomSampler),
+        "num_workers": data_loader.num_workers,
+        "pin_memory": data_loader.pin_memory,
+    }
+    write_packed_graphs(data_list, path, metadata=metadata)
+
+
+class PackedCGCNNDataset(PackedGraphDataset):
+    # items in the format of the CGCNN dataset, with the tensors as views into the store
+
+    def get(self, idx):
+        data = self.get_graph(idx)
+        return (data.atom_fea, data.nbr_fea, data.nbr_fea_idx), data.target, data.cif_id
+
+
+def get_cgcnn_store_loader(path, batch_size):
+    dataset = PackedCGCNNDataset(path)
+    metadata = dataset.metadata
+    return DataLoader(dataset, batch_size=batch_size, shuffle=metadata["shuffle"], collate_fn=metadata["collate_fn"],
+                      num_workers=metadata["num_workers"], pin_memory=metadata["pin_memory"])
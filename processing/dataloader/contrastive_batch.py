@@ -19,7 +19,8 @@ class CompBatch(Batch):
     @classmethod
     def from_data_list(cls, data_list: List[BaseData],
                        follow_batch: Optional[List[str]] = None,
-                       exclude_keys: Optional[List[str]] = None):
+                       exclude_keys: Optional[List[str]] = None,
+                       segments: str = "composition"):
 
         batch, slice_dict, inc_dict = comp_collate(
             cls,
@@ -33,5 +34,21 @@ class CompBatch(Batch):
         batch._num_graphs = len(data_list)
         batch._slice_dict = slice_dict
         batch._inc_dict = inc_dict
+        if segments == "group" and not isinstance(data_list[0], CompBatch):
+            # one segment per CompData, so that neighbouring groups of the same composition stay separate
+            batch.group_ptr = get_comp_data_ptr(data_list)
+        else:
+            batch.group_ptr = get_group_ptr(batch.comp_id)
 
         return batch
+
+
+def get_comp_data_ptr(data_list):
+    # CSR-style offsets of the structures of every CompData
+    return torch.from_numpy(np.cumsum([0] + [len(data.structures) for data in data_list]))
+
+
+def get_group_ptr(comp_id):
+    # CSR-style offsets of the runs of equal composition ids, the segments of contrastive_loss
+    change = torch.nonzero(comp_id[1:] != comp_id[:-1]).view(-1) + 1
+    return torch.cat([change.new_zeros(1), change, change.new_tensor([comp_id.shape[0]])])
@@ -17,14 +17,15 @@ class CompData():
 
 ### Copied from Pytorch Geometric apart from new collator
 class CompCollater:
-    def __init__(self, follow_batch, exclude_keys):
+    def __init__(self, follow_batch, exclude_keys, segments="composition"):
         self.follow_batch = follow_batch
         self.exclude_keys = exclude_keys
+        self.segments = segments
 
     def __call__(self, batch):
         elem = batch[0]
         if isinstance(elem, CompData):
-            return CompBatch.from_data_list(batch, self.follow_batch, self.exclude_keys)
+            return CompBatch.from_data_list(batch, self.follow_batch, self.exclude_keys, segments=self.segments)
         elif isinstance(elem, torch.Tensor):
             return default_collate(batch)
         elif isinstance(elem, float):
@@ -56,6 +57,7 @@ class CompDataLoader(torch.utils.data.DataLoader):
         shuffle: bool = False,
         follow_batch: Optional[List[str]] = None,
         exclude_keys: Optional[List[str]] = None,
+        segments: str = "composition",
         **kwargs,
     ):
 
@@ -70,6 +72,6 @@ class CompDataLoader(torch.utils.data.DataLoader):
             dataset,
             batch_size,
             shuffle,
-            collate_fn=CompCollater(follow_batch, exclude_keys),
+            collate_fn=CompCollater(follow_batch, exclude_keys, segments=segments),
             **kwargs,
         )
@@ -3,10 +3,24 @@ import numpy as np
 from torch.utils.data import DataLoader
 from torch.utils.data.sampler import RandomSampler
 import torch_geometric as tg
+import os
 import json
+import uuid
+from functools import partial
 from tqdm import tqdm
-from pymatgen.io.ase import AseAtomsAdaptor
-from processing.dataloader.build_data import build_e3nn_data, construct_contrastive_dataset
+from processing.utils import to_ase_atoms
+from processing.columnar import to_object_array
+from processing.dataloader.atom_encoding import get_atom_encoding_registry
+from processing.dataloader.build_data import build_e3nn_dataset, construct_contrastive_dataset, get_entry_records, CompactGraphCollater
+from processing.dataloader.graph_cache import get_graph_cache, dataset_fingerprint
+from processing.dataloader.parallel import parallel_map
+from processing.dataloader.neighbor_list import PeriodicRadiusGraphCollater, get_structure_templates
+from processing.dataloader.packed_store import packed_store_key, is_packed_store, write_packed_graphs, write_packed_comp_data, PackedGraphDataset, PackedCompDataset
+from processing.dataloader.cgcnn_store import write_cgcnn_store, get_cgcnn_store_loader
+from processing.dataloader.dataset_stats import attach_dataset_stats
+from processing.dataloader.budget_sampler import BudgetBatchSampler, CompositionGroupSampler, get_graph_budget_sizes, get_painn_budget_sizes, get_comp_group_info, report_packing, report_group_packing
+from processing.dataloader.pipeline import attach_pipeline
+from processing.dataloader.eval_batches import cache_eval_batches
 from processing.dataloader.contrastive_data import CompDataLoader
 from models.PerovskiteOrderingGCNNs_cgcnn.cgcnn.data import get_cgcnn_loader
 import sys
@@ -14,88 +28,293 @@ sys.path.append('models/PerovskiteOrderingGCNNs_painn/')
 from nff.data import Dataset, collate_dicts
 
 
-def get_dataloader(data, prop="dft_e_hull", model_type="CGCNN", batch_size=10, interpolation=True, per_site=False, long_range=False):
+def get_default_loader_options():
+
+    loader_options = {}
+
+    loader_options["graph_cache_dir"] = None                # directory of the on-disk e3nn graph cache (None disables caching)
+    loader_options["graph_cache_size_limit"] = 20 * 1024**3  # in bytes; least recently used graphs are evicted beyond this size
+    loader_options["featurize_workers"] = 0                 # worker processes for graph construction (0 or 1 runs serially)
+    loader_options["featurize_chunksize"] = 64              # structures dispatched to a worker at a time
+    loader_options["neighbor_engine"] = "ase"               # "ase", "batched" (vectorised over structures) or "on_the_fly" (built at collation)
+    loader_options["reuse_templates"] = False               # share neighbor lists between structures with the same lattice and positions
+    loader_options["compact_graphs"] = False                # e3nn graphs with int8 shifts and species codes; embeddings are looked up at collation
+    loader_options["painn_dataset_dir"] = None              # directory of saved PaiNN datasets with their neighbor lists (None rebuilds them every time)
+    loader_options["cgcnn_store_dir"] = None                # directory of precomputed CGCNN inputs, shared by loaders of any batch size (None featurises every time)
+    loader_options["packed_store_dir"] = None               # directory of memory-mapped packed e3nn datasets, reused across processes (None keeps graphs in memory)
+    loader_options["batch_budget"] = None                   # e3nn and PaiNN batches filled up to this many atoms or edges (None uses batch_size)
+    loader_options["batch_budget_unit"] = "nodes"           # "nodes" (atoms) or "edges"
+    loader_options["contrastive_group_size"] = 6            # structures per contrastive group (None keeps whole compositions together)
+    loader_options["contrastive_atom_budget"] = None        # contrastive batches filled with whole groups up to this many atoms (None uses batch_size)
+    loader_options["contrastive_segments"] = "composition"  # contrastive_loss segments: "composition" (runs of equal composition in a batch) or "group" (one per CompData)
+    loader_options["loader_workers"] = 0                    # persistent worker processes collating training batches ahead of the loop (0 collates in the training loop)
+    loader_options["prefetch_factor"] = 2                   # batches prefetched per loader worker
+    loader_options["pin_memory"] = False                    # collate into pinned host memory for faster, asynchronous copies to the GPU
+    loader_options["eval_batch_size"] = None                # evaluation loaders collated once into batches of this size, in dataset order (None re-collates every epoch)
+
+    return loader_options
+
+
+def get_loader_options(loader_options=None):
+    options = get_default_loader_options()
+    if loader_options is not None:
+        options.update(loader_options)
+    return options
+
+
+def get_dataloader(data, prop="dft_e_hull", model_type="CGCNN", batch_size=10, interpolation=True, per_site=False, long_range=False, loader_options=None, pipeline=False):
+    loader_options = get_loader_options(loader_options)
     tqdm.pandas()
     pd.options.mode.chained_assignment = None # Disable the SettingWithCopy warning (due to pandas.apply as new column)
     
-    data['ase_structure'] = data.progress_apply(lambda x: AseAtomsAdaptor.get_atoms(x['structure']), axis=1)
+    data['ase_structure'] = pd.Series(to_object_array([to_ase_atoms(structure) for structure in tqdm(data['structure'])]), index=data.index)
     data['idx'] = data.index
 
     if interpolation:
         prop += "_diff"
 
     if model_type == "CGCNN":
-        data_loader = get_cgcnn_loader(data,prop,batch_size,per_site=per_site,long_range=long_range)
+        data_loader = get_stored_cgcnn_loader(data,prop,batch_size,per_site,long_range,loader_options)
     elif model_type == "Painn":
-        data_loader = get_painn_dataloader(data,prop,batch_size)
+        data_loader = get_painn_dataloader(data,prop,batch_size,loader_options)
     elif model_type == "e3nn":
-        data_loader = get_e3nn_dataloader(data,prop,batch_size,per_site=per_site)
+        data_loader = get_e3nn_dataloader(data,prop,batch_size,per_site=per_site,loader_options=loader_options)
     elif model_type == "e3nn_contrastive":
-        data_loader = get_e3nn_contrastive_dataloader(data,prop,batch_size)
+        data_loader = get_e3nn_contrastive_dataloader(data,prop,batch_size,loader_options=loader_options)
     else:
         raise ValueError("Model Type Not Supported")
 
+    # only loaders iterated every epoch by the training loop (pipeline=True) keep worker processes for the run
+    if pipeline:
+        data_loader = attach_pipeline(data_loader, loader_options)
+
+    # computed on first use; e3nn graphs already carry their edges, so the neighbor count is read off the built dataset
+    graphs = data_loader.dataset if "e3nn" in model_type else None
+    attach_dataset_stats(data_loader, data, prop, graphs=graphs)
+
     return data_loader
 
 
-def get_painn_dataloader(data,prop,batch_size):
+def get_eval_dataloader(data_loader, model_type, loader_options=None):
+    # evaluation loaders of CGCNN and e3nn models are collated once; the nff evaluation of PaiNN is left as is
+    loader_options = get_loader_options(loader_options)
+    if loader_options["eval_batch_size"] is None or model_type == "Painn":
+        return data_loader
+    return cache_eval_batches(data_loader, loader_options["eval_batch_size"])
+
+
+def get_stored_cgcnn_loader(data,prop,batch_size,per_site,long_range,loader_options):
+    if loader_options["cgcnn_store_dir"] is None:
+        return get_cgcnn_loader(data,prop,batch_size,per_site=per_site,long_range=long_range)
+
+    # the structures enter the key through their geometry, so the structure type is covered as well
+    key = dataset_fingerprint(get_entry_records(data, prop), prop, ["cgcnn", prop, per_site, long_range])
+    os.makedirs(loader_options["cgcnn_store_dir"], exist_ok=True)
+    store_path = os.path.join(loader_options["cgcnn_store_dir"], key)
+    if not is_packed_store(store_path):
+        write_cgcnn_store(get_cgcnn_loader(data,prop,batch_size,per_site=per_site,long_range=long_range), store_path)
+
+    return get_cgcnn_store_loader(store_path, batch_size)
+
+
+def get_painn_dataloader(data,prop,batch_size,loader_options):
+    dataset_path = get_painn_dataset_path(data, prop, loader_options, cutoff=5.0)
+
+    if dataset_path is not None and os.path.isfile(dataset_path):
+        dataset = Dataset.from_file(dataset_path)
+    else:
+        dataset = build_painn_dataset(data, prop, loader_options, cutoff=5.0)
+        if dataset_path is not None:
+            save_painn_dataset(dataset, dataset_path)
+
+    if loader_options["batch_budget"] is not None:
+        sampler = get_budget_sampler(get_painn_budget_sizes(dataset, loader_options["batch_budget_unit"]), loader_options)
+        data_loader = DataLoader(dataset, collate_fn=collate_dicts, batch_sampler=sampler)
+    else:
+        data_loader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_dicts, sampler=RandomSampler(dataset))
+
+    return data_loader
+
 
+def build_painn_dataset(data, prop, loader_options, cutoff=5.0):
     data_props = dataframe_to_props_painn(data, prop)
     dataset = Dataset(data_props, units='eV', stack=True)
-    f = open("processing/dataloader/atom_init.json")
-    atom_inits = json.load(f)
+    atom_inits = dict(get_atom_encoding_registry().atom_inits)
 
-    for key, value in atom_inits.items():
-        atom_inits[key] = np.array(value, dtype=np.float32)
+    # the neighbor list and offsets depend only on the lattice and positions, so with reuse_templates they are
+    # generated for one structure per template and shared with every ordering of that template
+    if loader_options["reuse_templates"]:
+        template_of = get_structure_templates(data['ase_structure'].tolist())
+    else:
+        template_of = list(range(len(data)))
+    templates = sorted(set(template_of))
+    template_props = {key: [values[i] for i in templates] for key, values in data_props.items()}
+    nbr_list, offsets = generate_painn_neighbor_lists(template_props, cutoff, num_workers=loader_options["featurize_workers"],
+                                                      chunksize=loader_options["featurize_chunksize"])
 
-    dataset.generate_neighbor_list(cutoff=5.0, undirected=False)
+    position = {template: i for i, template in enumerate(templates)}
+    dataset.props['nbr_list'] = [nbr_list[position[template]] for template in template_of]
+    dataset.props['offsets'] = [offsets[position[template]] for template in template_of]
     dataset.generate_atom_initializations(atom_inits)
-    data_loader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_dicts, sampler=RandomSampler(dataset))
+
+    return dataset
+
+
+def generate_painn_neighbor_chunk(chunk_props, cutoff):
+    chunk_dataset = Dataset(chunk_props, units='eV', stack=True)
+    chunk_dataset.generate_neighbor_list(cutoff=cutoff, undirected=False)
+    return chunk_dataset.props['nbr_list'], chunk_dataset.props['offsets']
+
+
+def generate_painn_neighbor_lists(data_props, cutoff, num_workers=0, chunksize=64):
+    # periodic neighbor lists and offsets of every structure, generated chunk by chunk in worker processes
+    num_structures = len(data_props['nxyz'])
+    chunks = [{key: values[i:i + chunksize] for key, values in data_props.items()} for i in range(0, num_structures, chunksize)]
+    results = parallel_map(partial(generate_painn_neighbor_chunk, cutoff=cutoff), chunks, num_workers=num_workers, chunksize=1,
+                           desc="Neighbor lists")
+
+    nbr_list = [nbrs for chunk_nbr_list, _ in results for nbrs in chunk_nbr_list]
+    offsets = [offs for _, chunk_offsets in results for offs in chunk_offsets]
+    return nbr_list, offsets
+
+
+def get_painn_dataset_path(data, prop, loader_options, cutoff=5.0):
+    if loader_options["painn_dataset_dir"] is None:
+        return None
+    key = dataset_fingerprint(get_entry_records(data, prop), prop, ["painn", prop, cutoff])
+    os.makedirs(loader_options["painn_dataset_dir"], exist_ok=True)
+    return os.path.join(loader_options["painn_dataset_dir"], key + ".pth.tar")
+
+
+def save_painn_dataset(dataset, path):
+    # saved under a private name and moved into place, so that a concurrent reader never loads a partial file
+    tmp_path = path + ".tmp." + uuid.uuid4().hex
+    dataset.save(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def get_e3nn_dataloader(data,prop,batch_size,per_site,loader_options):
+    store_path = get_packed_store_path(data, prop, per_site, loader_options, contrastive=False)
+
+    if store_path is not None and is_packed_store(store_path):
+        dataset = PackedGraphDataset(store_path)
+    else:
+        graph_cache = get_loader_graph_cache(loader_options)
+        dataset = build_e3nn_dataset(data, prop, r_max=5.0, per_site=per_site, graph_cache=graph_cache,
+                                     num_workers=loader_options["featurize_workers"], chunksize=loader_options["featurize_chunksize"],
+                                     neighbor_engine=loader_options["neighbor_engine"], reuse_templates=loader_options["reuse_templates"],
+                                     compact=loader_options["compact_graphs"])
+        report_graph_cache(graph_cache)
+        if store_path is not None:
+            write_packed_graphs(dataset, store_path)
+            dataset = PackedGraphDataset(store_path)
+
+    if isinstance(dataset, PackedGraphDataset):
+        # positions of the rows in the packed store
+        data['datapoint'] = pd.Series(np.arange(len(dataset)), index=data.index)
+    else:
+        # filled element-wise, so that pandas does not try to unpack the (iterable) Data objects
+        data['datapoint'] = pd.Series(to_object_array(dataset), index=data.index)
+        dataset = data['datapoint'].values
+
+    if loader_options["batch_budget"] is not None:
+        sampler = get_budget_sampler(get_graph_budget_sizes(dataset, loader_options["batch_budget_unit"]), loader_options)
+        data_loader = tg.loader.DataLoader(dataset, batch_sampler=sampler)
+    else:
+        data_loader = tg.loader.DataLoader(dataset, batch_size=batch_size, shuffle=True)
+    attach_compact_features(data_loader, loader_options)
+    attach_on_the_fly_edges(data_loader, loader_options)
 
     return data_loader
 
 
-def get_e3nn_dataloader(data,prop,batch_size,per_site):
-    data['datapoint'] = data.progress_apply(lambda x: build_e3nn_data(x, prop, r_max=5.0,per_site=per_site), axis=1)
-    data_loader = tg.loader.DataLoader(data['datapoint'].values, batch_size=batch_size, shuffle=True)
+def get_e3nn_contrastive_dataloader(data,prop,batch_size,loader_options):
+    store_path = get_packed_store_path(data, prop, False, loader_options, contrastive=True)
+
+    if store_path is not None and is_packed_store(store_path):
+        comp_data = PackedCompDataset(store_path)
+    else:
+        graph_cache = get_loader_graph_cache(loader_options)
+        comp_data = construct_contrastive_dataset(data,prop,r_max=5.0,graph_cache=graph_cache,
+                                                  num_workers=loader_options["featurize_workers"],chunksize=loader_options["featurize_chunksize"],
+                                                  neighbor_engine=loader_options["neighbor_engine"], reuse_templates=loader_options["reuse_templates"],
+                                                  compact=loader_options["compact_graphs"], group_size=loader_options["contrastive_group_size"])
+        report_graph_cache(graph_cache)
+        if store_path is not None:
+            write_packed_comp_data(comp_data, store_path)
+            comp_data = PackedCompDataset(store_path)
+
+    segments = loader_options["contrastive_segments"]
+    if segments not in ("composition", "group"):
+        raise ValueError("contrastive_segments must be 'composition' or 'group'")
+    if loader_options["contrastive_atom_budget"] is not None:
+        sizes, group_lengths, group_formulas = get_comp_group_info(comp_data)
+        sampler = CompositionGroupSampler(sizes, group_lengths, loader_options["contrastive_atom_budget"],
+                                          group_formulas=group_formulas if segments == "composition" else None)
+        report_group_packing(sampler, batch_size)
+        data_loader = CompDataLoader(comp_data, batch_sampler=sampler, segments=segments)
+    else:
+        data_loader = CompDataLoader(comp_data, batch_size=batch_size, shuffle=True, segments=segments)
+    attach_compact_features(data_loader, loader_options)
+    attach_on_the_fly_edges(data_loader, loader_options)
 
     return data_loader
 
 
-def get_e3nn_contrastive_dataloader(data,prop,batch_size):
-    comp_data = construct_contrastive_dataset(data,prop,r_max=5.0)
-    data_loader = CompDataLoader(comp_data, batch_size=batch_size, shuffle=True)
+def get_packed_store_path(data, prop, per_site, loader_options, contrastive=False):
+    if loader_options["packed_store_dir"] is None:
+        return None
+    key = packed_store_key(get_entry_records(data, prop), prop, 5.0, per_site, loader_options["neighbor_engine"],
+                           contrastive=contrastive, compact=loader_options["compact_graphs"], group_size=loader_options["contrastive_group_size"])
+    os.makedirs(loader_options["packed_store_dir"], exist_ok=True)
+    return os.path.join(loader_options["packed_store_dir"], key)
+
+
+def get_budget_sampler(sizes, loader_options):
+    if loader_options["batch_budget_unit"] not in ("nodes", "edges"):
+        raise ValueError("batch_budget_unit must be 'nodes' or 'edges'")
+    sampler = BudgetBatchSampler(sizes, loader_options["batch_budget"])
+    report_packing(sampler)
+    return sampler
+
 
+def attach_compact_features(data_loader, loader_options):
+    if loader_options["compact_graphs"]:
+        data_loader.collate_fn = CompactGraphCollater(data_loader.collate_fn)
     return data_loader
 
 
+def attach_on_the_fly_edges(data_loader, loader_options):
+    if loader_options["neighbor_engine"] == "on_the_fly":
+        data_loader.collate_fn = PeriodicRadiusGraphCollater(data_loader.collate_fn, r_max=5.0)
+    return data_loader
+
+
+def get_loader_graph_cache(loader_options):
+    if loader_options["graph_cache_dir"] is None:
+        return None
+    return get_graph_cache(loader_options["graph_cache_dir"], max_size_bytes=loader_options["graph_cache_size_limit"])
+
+
+def report_graph_cache(graph_cache):
+    if graph_cache is not None:
+        stats = graph_cache.stats()
+        print("Graph cache: " + str(stats["hits"]) + " hits, " + str(stats["misses"]) + " misses, " + str(stats["evictions"]) + " evictions")
+
+
 def dataframe_to_props_painn(df, target_prop):   
-    prop_names = [target_prop]
+    atoms_list = df['ase_structure'].tolist()
     props = {}
-    id_list = []
-    nxyz_list = []
-    props_list = {prop: [] for prop in prop_names}
-    lattice_list = []    
-    
-    for index, row in df.iterrows():
-        curr_struct = row['ase_structure']
-        id_list.append(index)
-        
-        for prop in prop_names:
-            props_list[prop].append(row[prop])
-        
-        n = np.asarray(curr_struct.numbers).reshape(-1,1)
-        xyz = np.asarray(curr_struct.positions)
-        curr_nxyz = np.concatenate((n, xyz), axis=1)
-        nxyz_list.append(curr_nxyz)
-        lattice_list.append(curr_struct.cell[:])
-        
-    props['crystal_id'] = id_list
-    props['nxyz'] = nxyz_list
-    
-    for prop in prop_names:
-        props[prop] = props_list[prop]
-    
-    props['lattice'] = lattice_list
+
+    # all structures are stacked once and split into per-structure views
+    counts = [len(atoms) for atoms in atoms_list]
+    n = np.concatenate([atoms.numbers for atoms in atoms_list]).reshape(-1,1)
+    xyz = np.concatenate([atoms.positions for atoms in atoms_list])
+    nxyz = np.concatenate((n, xyz), axis=1)
+
+    props['crystal_id'] = df.index.tolist()
+    props['nxyz'] = np.split(nxyz, np.cumsum(counts)[:-1])
+    props[target_prop] = df[target_prop].tolist()
+    props['lattice'] = [atoms.cell.array for atoms in atoms_list]
         
     return props
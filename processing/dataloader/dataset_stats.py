@@ -0,0 +1,157 @@
+import numpy as np
+
+from processing.dataloader.contrastive_data import CompData
+from processing.dataloader.packed_store import PackedGraphDataset, PackedCompDataset
+
+
+### Statistics manifest of a dataset, attached to its loader as data_loader.dataset_stats and computed on
+### first use (in practice only for training loaders), so that create_model can set up normalisation and
+### the e3nn neighbor scaling without iterating (and collating) the whole training loader:
+###   target: labels of the structures the loader serves, with
+###     count, nan_count
+###     mean, std            as torch.mean and torch.std (unbiased) in Normalizer: NaN if any label is NaN
+###     nanmean, nanstd      as np.nanmean and np.nanstd (population), skipping NaN labels
+###   graph_size_histogram: number of structures of each size, keyed by the number of atoms
+###   mean_neighbor_count: mean number of edges per atom, or None when edges are built at collation
+### The labels are read from the DataFrame the loader was built from. When the loader's dataset does not
+### hold one structure per row (e.g. rows dropped while featurising), no manifest is given and the models
+### fall back to reading the labels off the loader.
+
+
+class StreamingStats():
+    """
+    One-pass accumulator of the count, mean and variance of a stream of values. NaN values are counted
+    separately and left out of the mean and variance. Chunks are merged with the parallel variant of
+    Welford's algorithm.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.nan_count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        is_nan = np.isnan(values)
+        self.nan_count += int(is_nan.sum())
+        values = values[~is_nan]
+        if len(values) == 0:
+            return self
+
+        count = len(values)
+        mean = values.mean()
+        m2 = np.square(values - mean).sum()
+
+        delta = mean - self.mean
+        total = self.count + count
+        self.mean += delta * count / total
+        self.m2 += m2 + delta**2 * self.count * count / total
+        self.count = total
+        return self
+
+    def std(self, ddof=0):
+        if self.count - ddof <= 0:
+            return float("nan")
+        return float(np.sqrt(self.m2 / (self.count - ddof)))
+
+    def to_dict(self):
+        nanmean = float(self.mean) if self.count > 0 else float("nan")
+        has_nan = self.nan_count > 0
+        return {"count": self.count + self.nan_count, "nan_count": self.nan_count,
+                "mean": float("nan") if has_nan else nanmean, "std": float("nan") if has_nan else self.std(ddof=1),
+                "nanmean": nanmean, "nanstd": self.std(ddof=0)}
+
+
+def get_graph_list(dataset):
+    # the tg.data.Data graphs of an e3nn dataset, flattening contrastive groups
+    graphs = []
+    for item in dataset:
+        if isinstance(item, CompData):
+            graphs.extend(item.structures)
+        else:
+            graphs.append(item)
+    return graphs
+
+
+def count_edges(dataset):
+    # total number of edges of an e3nn dataset, or None if its graphs carry no edges
+    if isinstance(dataset, PackedGraphDataset):
+        if "edge_index" not in dataset.fields:
+            return None
+        # the per-graph shapes of the packed edge_index are (2, num_edges)
+        return int(dataset.fields["edge_index"][3][:, 1].sum())
+
+    num_edges = 0
+    for graph in get_graph_list(dataset):
+        if "edge_index" not in graph:
+            return None
+        num_edges += graph.edge_index.shape[1]
+    return num_edges
+
+
+def count_structures(dataset):
+    # number of structures of a loader's dataset, counting the graphs of contrastive groups
+    if isinstance(dataset, PackedCompDataset):
+        return int(dataset.group_ptr[-1])
+    if isinstance(dataset, (list, np.ndarray)):
+        return sum(len(item.structures) if isinstance(item, CompData) else 1 for item in dataset)
+    # datasets featurising on access (CGCNN, nff) are not iterated
+    return len(dataset)
+
+
+def compute_dataset_stats(targets, num_atoms, graphs=None):
+    # targets and num_atoms: the labels and sizes of the rows of the DataFrame the loader is built from;
+    # graphs: its e3nn dataset, if any, for the neighbor count
+    target_stats = StreamingStats()
+    for target in targets:
+        target_stats.update(target)
+
+    sizes, counts = np.unique(num_atoms, return_counts=True)
+
+    mean_neighbor_count = None
+    if graphs is not None:
+        num_edges = count_edges(graphs)
+        if num_edges is not None and num_atoms.sum() > 0:
+            # equal to the per-atom mean of get_neighbors, as both sums are exact integers
+            mean_neighbor_count = num_edges / int(num_atoms.sum())
+
+    return {
+        "target": target_stats.to_dict(),
+        "graph_size_histogram": {int(size): int(count) for size, count in zip(sizes, counts)},
+        "mean_neighbor_count": mean_neighbor_count,
+    }
+
+
+class DatasetStats():
+    """
+    Statistics manifest of a loader's dataset, computed on the first call of get and memoised.
+    Only the labels and sizes of the rows are kept until then.
+    """
+
+    def __init__(self, data, prop, dataset, graphs=None):
+        self.targets = data[prop].tolist()
+        self.structures = data['ase_structure'].tolist()
+        self.dataset = dataset
+        self.graphs = graphs
+        self.stats = None
+
+    def get(self):
+        if self.stats is None and self.dataset is not None:
+            if count_structures(self.dataset) == len(self.targets):
+                num_atoms = np.array([len(atoms) for atoms in self.structures], dtype=np.int64)
+                self.stats = compute_dataset_stats(self.targets, num_atoms, graphs=self.graphs)
+            self.targets, self.structures, self.dataset, self.graphs = None, None, None, None
+        return self.stats
+
+
+def attach_dataset_stats(data_loader, data, prop, graphs=None):
+    data_loader.dataset_stats = DatasetStats(data, prop, data_loader.dataset, graphs=graphs)
+    return data_loader
+
+
+def get_dataset_stats(data_loader):
+    # the manifest attached when the loader was built, or None for loaders built elsewhere and for
+    # datasets that do not hold one structure per row
+    stats = getattr(data_loader, "dataset_stats", None)
+    return None if stats is None else stats.get()
@@ -0,0 +1,103 @@
+import math
+from torch.utils.data import DataLoader, BatchSampler
+from torch.utils.data.distributed import DistributedSampler
+
+from processing.dataloader.budget_sampler import BudgetBatchSampler
+from processing.dataloader.pipeline import PipelineDataLoader
+from processing.dataloader.eval_batches import CachedEvalBatches
+
+
+### Sharded loaders for data-parallel training. Every rank builds the same loader and keeps its share:
+### fixed-size batches are drawn from a DistributedSampler, budget and composition-group batches are
+### planned identically on all ranks (same seed) and dealt out round-robin. Training shards are padded
+### with repeated batches so that every rank takes the same number of optimizer steps, which the
+### gradient all-reduce requires; evaluation shards are not padded, so no item is counted twice.
+
+
+class EpochDistributedSampler(DistributedSampler):
+    """
+    DistributedSampler that moves on to the next epoch's shuffle after every pass, so that the
+    training loops (including nff's Trainer) need not call set_epoch.
+    """
+
+    def __iter__(self):
+        indices = super().__iter__()
+        self.set_epoch(self.epoch + 1)
+        return indices
+
+
+class DistributedBatchSampler():
+    """
+    Every num_replicas-th batch of a batch sampler that yields the same batches on all ranks,
+    starting at the rank's own. With pad, the shard is filled up with the first batches of the
+    epoch to ceil(batches / num_replicas).
+    """
+
+    def __init__(self, batch_sampler, num_replicas, rank, pad=True):
+        self.batch_sampler = batch_sampler
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.pad = pad
+
+    def __iter__(self):
+        # the wrapped sampler is consumed lazily, so that its per-epoch statistics time this rank's pass
+        first = []
+        num_batches = 0
+        for position, batch in enumerate(self.batch_sampler):
+            if len(first) < self.num_replicas:
+                first.append(batch)
+            if position % self.num_replicas == self.rank:
+                yield batch
+            num_batches += 1
+        if self.pad:
+            for position in range(num_batches, math.ceil(num_batches / self.num_replicas) * self.num_replicas):
+                if position % self.num_replicas == self.rank:
+                    yield first[position - num_batches]
+
+    def __len__(self):
+        num_batches = len(self.batch_sampler)
+        if self.pad:
+            return math.ceil(num_batches / self.num_replicas)
+        return len(range(self.rank, num_batches, self.num_replicas))
+
+
+def distribute_loader(data_loader, rank, world_size, seed=0):
+    # each rank keeps its own batch size, so the effective batch size grows with the number of ranks
+    if isinstance(data_loader.batch_sampler, BudgetBatchSampler):
+        data_loader.batch_sampler.reseed(seed)
+        batch_sampler = DistributedBatchSampler(data_loader.batch_sampler, world_size, rank)
+    else:
+        sampler = EpochDistributedSampler(data_loader.dataset, num_replicas=world_size, rank=rank, shuffle=True, seed=seed)
+        batch_sampler = BatchSampler(sampler, data_loader.batch_size, drop_last=False)
+    return rebuild_loader(data_loader, batch_sampler)
+
+
+def shard_eval_loader(data_loader, rank, world_size):
+    if isinstance(data_loader, CachedEvalBatches):
+        return copy_loader_attributes(data_loader, CachedEvalBatches(data_loader.batches[rank::world_size], dataset=data_loader.dataset))
+    if isinstance(data_loader.batch_sampler, BudgetBatchSampler):
+        data_loader.batch_sampler.reseed(0)
+        batch_sampler = DistributedBatchSampler(data_loader.batch_sampler, world_size, rank, pad=False)
+    else:
+        batch_sampler = BatchSampler(range(rank, len(data_loader.dataset), world_size), data_loader.batch_size, drop_last=False)
+    return rebuild_loader(data_loader, batch_sampler)
+
+
+def rebuild_loader(data_loader, batch_sampler):
+    # same dataset, collate function and worker settings as the original loader
+    if data_loader.num_workers > 0:
+        worker_options = {"num_workers": data_loader.num_workers, "persistent_workers": data_loader.persistent_workers,
+                          "prefetch_factor": data_loader.prefetch_factor}
+    else:
+        worker_options = {}
+    loader_class = PipelineDataLoader if isinstance(data_loader, PipelineDataLoader) else DataLoader
+    sharded = loader_class(data_loader.dataset, batch_sampler=batch_sampler, collate_fn=data_loader.collate_fn,
+                           pin_memory=data_loader.pin_memory, **worker_options)
+    return copy_loader_attributes(data_loader, sharded)
+
+
+def copy_loader_attributes(data_loader, sharded):
+    # the statistics describe the whole dataset, as on a single process
+    if hasattr(data_loader, "dataset_stats"):
+        sharded.dataset_stats = data_loader.dataset_stats
+    return sharded
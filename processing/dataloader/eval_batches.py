@@ -0,0 +1,49 @@
+import copy
+from tqdm import tqdm
+
+from processing.dataloader.contrastive_data import CompData
+from processing.dataloader.contrastive_batch import get_comp_data_ptr
+
+
+### Evaluation batches collated once: the items of an evaluation loader are taken in dataset order,
+### collated into large batches with the loader's own collate function and kept in memory, so that
+### the losses evaluated every epoch no longer re-collate the dataset. The summed losses of
+### evaluate_model do not depend on how the items are batched, except for the segments of
+### contrastive_loss, which would merge when two groups of the same composition become neighbours;
+### group_ptr is therefore set to the boundaries of the CompData groups, as when every group was its
+### own batch.
+
+
+class CachedEvalBatches():
+    """
+    Iterable over pre-collated batches. tg batches are handed out as shallow copies, because models
+    (e.g. PeriodicNetwork) overwrite the attributes of the batch they are given.
+    """
+
+    def __init__(self, batches, dataset=None):
+        self.batches = batches
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield copy.copy(batch) if hasattr(batch, "to") else batch
+
+
+def cache_eval_batches(data_loader, batch_size):
+    dataset = data_loader.dataset
+    collate_fn = data_loader.collate_fn
+    batches = []
+    for start in tqdm(range(0, len(dataset), batch_size), desc="Collating evaluation batches"):
+        items = [dataset[i] for i in range(start, min(start + batch_size, len(dataset)))]
+        batch = collate_fn(items)
+        if isinstance(items[0], CompData):
+            batch.group_ptr = get_comp_data_ptr(items)
+        batches.append(batch)
+
+    cached = CachedEvalBatches(batches, dataset=dataset)
+    if hasattr(data_loader, "dataset_stats"):
+        cached.dataset_stats = data_loader.dataset_stats
+    return cached
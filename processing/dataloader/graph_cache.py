@@ -0,0 +1,158 @@
+import os
+import json
+import pickle
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch_geometric as tg
+
+
+_graph_caches = {}
+
+# bumped whenever the fields of the featurised graphs change, so that stale graphs are not reused
+graph_schema_version = 2
+
+
+def structure_hash(atoms, decimals=8):
+    # canonical hash of an ase structure: species, cartesian positions, cell and periodicity
+    # (coordinates are rounded and -0.0 is folded into 0.0 so that equal structures hash equally)
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(atoms.numbers, dtype=np.int64).tobytes())
+    h.update((np.round(np.asarray(atoms.positions, dtype=np.float64), decimals) + 0.0).tobytes())
+    h.update((np.round(np.asarray(atoms.cell.array, dtype=np.float64), decimals) + 0.0).tobytes())
+    h.update(np.asarray(atoms.pbc, dtype=np.bool_).tobytes())
+    return h.hexdigest()
+
+
+def graph_cache_key(atoms, prop, r_max, per_site=False, compact=False):
+    key = structure_hash(atoms) + "|" + repr(float(r_max)) + "|" + str(prop) + "|" + str(bool(per_site))
+    if compact:
+        key += "|compact"
+    key += "|v" + str(graph_schema_version)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def dataset_fingerprint(entries, prop, settings):
+    # fingerprint of a whole featurised dataset: its settings and every row's structure, identity and label, in order
+    h = hashlib.sha1()
+    h.update(json.dumps(settings).encode())
+    for entry in entries:
+        h.update(structure_hash(entry['ase_structure']).encode())
+        h.update(repr((entry['idx'], entry[prop], entry.get('formula'))).encode())
+    return h.hexdigest()
+
+
+class GraphCache():
+    """
+    Content-addressed on-disk cache of featurised tg.data.Data graphs.
+    Entries are evicted least-recently-used first once the cache grows beyond max_size_bytes.
+    """
+
+    def __init__(self, cache_dir, max_size_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".pt")
+
+    def _scan(self):
+        # index the files on disk from least to most recently used
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith(".pt"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, file_name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, file_name[:-3], stat.st_size))
+        entries.sort()
+
+        self._entries = OrderedDict((key, size) for _, key, size in entries)
+        self._total_size = sum(self._entries.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return os.path.isfile(self._path(key))
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            data_dict = torch.load(path)
+        except (FileNotFoundError, EOFError, RuntimeError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        if key in self._entries:
+            self._entries.move_to_end(key)
+
+        return tg.data.Data.from_dict(data_dict)
+
+    def put(self, key, data):
+        path = self._path(key)
+        tmp_path = path + ".tmp" + str(os.getpid())
+        with open(tmp_path, 'wb') as f:
+            torch.save(data.to_dict(), f)
+        os.replace(tmp_path, path)
+
+        size = os.path.getsize(path)
+        self._total_size += size - self._entries.pop(key, 0)
+        self._entries[key] = size
+
+        if self.max_size_bytes is not None and self._total_size > self.max_size_bytes:
+            self.evict()
+
+    def evict(self):
+        # other processes may share the directory, so re-index it before evicting
+        self._scan()
+        while self._total_size > self.max_size_bytes and len(self._entries) > 0:
+            key, size = self._entries.popitem(last=False)
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            self._total_size -= size
+            self.evictions += 1
+
+    def clear(self):
+        for key in list(self._entries.keys()):
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+        self._entries = OrderedDict()
+        self._total_size = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "size_bytes": self._total_size,
+        }
+
+
+def get_graph_cache(cache_dir, max_size_bytes=None):
+    # one cache object per directory and process, so that hit/miss counters accumulate across loaders
+    cache_dir = os.path.abspath(cache_dir)
+    if cache_dir not in _graph_caches:
+        _graph_caches[cache_dir] = GraphCache(cache_dir, max_size_bytes=max_size_bytes)
+    graph_cache = _graph_caches[cache_dir]
+    graph_cache.max_size_bytes = max_size_bytes
+    return graph_cache
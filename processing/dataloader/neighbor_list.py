@@ -0,0 +1,166 @@
+import numpy as np
+import torch
+
+
+def get_structure_templates(atoms_list, decimals=6):
+    """
+    Index of the template of every structure: the first structure with the same lattice and the same
+    positions, in the same order, within 10**-decimals. Orderings of one supercell differ only in their
+    species and share a template, and thereby their periodic neighbor list.
+    """
+    templates = {}
+    template_of = []
+    for i, atoms in enumerate(atoms_list):
+        key = (len(atoms),
+               (np.round(atoms.cell.array, decimals) + 0.0).tobytes(),
+               (np.round(atoms.positions, decimals) + 0.0).tobytes(),
+               tuple(atoms.pbc))
+        template_of.append(templates.setdefault(key, i))
+    return template_of
+
+
+def get_image_range(frac_pos, cell, ptr, r_max):
+    # number of periodic images needed along each lattice vector of each structure:
+    # a neighbor within r_max satisfies |df_k + S_k| * d_k < r_max, where d_k = 1 / |b_k| is the
+    # interplanar spacing and |df_k| is bounded by the spread of the fractional coordinates,
+    # so |S_k| < r_max * |b_k| + spread_k
+    reciprocal_norm = torch.linalg.inv(cell).norm(dim=1)
+    starts = ptr[:-1].numpy()
+    frac = frac_pos.numpy()
+    frac_span = np.maximum.reduceat(frac, starts, axis=0) - np.minimum.reduceat(frac, starts, axis=0)
+    image_range = torch.floor(r_max * reciprocal_norm + torch.from_numpy(frac_span))
+    return image_range.long()
+
+
+def get_image_shifts(image_range):
+    axes = [torch.arange(-n, n + 1) for n in image_range.tolist()]
+    return torch.cartesian_prod(*axes).view(-1, 3)
+
+
+def _radius_graph_chunk(pos, cell, counts, ptr, graphs, image_range, r_max, self_interaction):
+    # enumerate all (src, dst) pairs of the structures in the chunk, structure by structure
+    graph_counts = counts[graphs]
+    num_pairs = graph_counts ** 2
+    pair_graph = torch.arange(graphs.shape[0]).repeat_interleave(num_pairs)
+    pair_start = (torch.cumsum(num_pairs, dim=0) - num_pairs).repeat_interleave(num_pairs)
+    local = torch.arange(pair_graph.shape[0]) - pair_start
+    pair_count = graph_counts[pair_graph]
+    pair_ptr = ptr[graphs][pair_graph]
+    src = pair_ptr + torch.div(local, pair_count, rounding_mode='floor')
+    dst = pair_ptr + local % pair_count
+
+    # the same image shifts are tried for every structure of the chunk
+    shifts = get_image_shifts(image_range[graphs].max(dim=0).values)
+    shift_vec = torch.einsum('sk,gkj->gsj', shifts.to(cell.dtype), cell[graphs])
+    vec = (pos[dst] - pos[src]).unsqueeze(1) + shift_vec[pair_graph]
+    mask = vec.norm(dim=-1) < r_max
+
+    if not self_interaction:
+        mask &= ~((src == dst).unsqueeze(1) & (shifts == 0).all(dim=1).unsqueeze(0))
+
+    # nonzero is row-major, so edges come out sorted by src, then dst, then shift
+    pair_idx, shift_idx = mask.nonzero(as_tuple=True)
+    return src[pair_idx], dst[pair_idx], shifts[shift_idx]
+
+
+def periodic_radius_graph(pos, cell, batch, r_max, self_interaction=True, max_pair_images=2**22):
+    """
+    Periodic radius graph of many structures at once.
+    pos is (N, 3), cell is (B, 3, 3) with lattice vectors as rows and batch is the sorted (N,) structure index.
+    Returns edge_index (2, E), edge_shift (E, 3) and edge_vec (E, 3) in flat concatenated arrays, with
+    edge_vec = pos[dst] - pos[src] + edge_shift @ cell, i.e. the convention of ase's neighbor_list("ijS").
+    Structures are processed in chunks of at most max_pair_images (pair, image) candidates.
+    """
+    pos = torch.as_tensor(pos)
+    cell = torch.as_tensor(cell, dtype=pos.dtype).view(-1, 3, 3)
+    batch = torch.as_tensor(batch, dtype=torch.long)
+
+    if batch.shape[0] > 1 and (batch[1:] < batch[:-1]).any():
+        raise ValueError("batch must be sorted")
+
+    num_graphs = cell.shape[0]
+    counts = torch.bincount(batch, minlength=num_graphs)
+    if (counts == 0).any():
+        raise ValueError("every structure must contain at least one atom")
+    ptr = torch.cat([counts.new_zeros(1), torch.cumsum(counts, dim=0)])
+
+    # the search itself runs in double precision, as ase does
+    pos64 = pos.detach().cpu().double()
+    cell64 = cell.detach().cpu().double()
+    frac_pos = torch.einsum('ni,nij->nj', pos64, torch.linalg.inv(cell64)[batch.cpu()])
+    image_range = get_image_range(frac_pos, cell64, ptr.cpu(), r_max)
+    counts_cpu = counts.cpu()
+    ptr_cpu = ptr.cpu()
+    cost = (counts_cpu ** 2) * (2 * image_range + 1).prod(dim=1)
+
+    edge_src, edge_dst, edge_shift = [], [], []
+    start = 0
+    while start < num_graphs:
+        end = start + 1
+        chunk_cost = cost[start].item()
+        while end < num_graphs and chunk_cost + cost[end].item() <= max_pair_images:
+            chunk_cost += cost[end].item()
+            end += 1
+        src, dst, shift = _radius_graph_chunk(pos64, cell64, counts_cpu, ptr_cpu, torch.arange(start, end),
+                                              image_range, r_max, self_interaction)
+        edge_src.append(src)
+        edge_dst.append(dst)
+        edge_shift.append(shift)
+        start = end
+
+    edge_index = torch.stack([torch.cat(edge_src), torch.cat(edge_dst)], dim=0).to(pos.device)
+    edge_shift = torch.cat(edge_shift).to(pos.device)
+
+    # edge vectors in the working precision, computed exactly as in build_e3nn_data
+    edge_batch = batch[edge_index[0]]
+    edge_vec = (pos[edge_index[1]]
+                - pos[edge_index[0]]
+                + torch.einsum('ni,nij->nj', edge_shift.to(pos.dtype), cell[edge_batch]))
+
+    return edge_index, edge_shift, edge_vec
+
+
+def batched_neighbor_lists(atoms_list, r_max, self_interaction=True, max_pair_images=2**22):
+    # per-structure (edge_src, edge_dst, edge_shift) numpy arrays, as returned by ase's neighbor_list("ijS")
+    if len(atoms_list) == 0:
+        return []
+
+    counts = torch.tensor([len(atoms) for atoms in atoms_list])
+    pos = torch.from_numpy(np.concatenate([atoms.positions for atoms in atoms_list], axis=0))
+    cell = torch.from_numpy(np.stack([atoms.cell.array for atoms in atoms_list], axis=0))
+    batch = torch.arange(len(atoms_list)).repeat_interleave(counts)
+    edge_index, edge_shift, _ = periodic_radius_graph(pos, cell, batch, r_max, self_interaction=self_interaction,
+                                                      max_pair_images=max_pair_images)
+
+    ptr = torch.cat([counts.new_zeros(1), torch.cumsum(counts, dim=0)])
+    edge_counts = torch.bincount(batch[edge_index[0]], minlength=len(atoms_list)).tolist()
+    edge_src = torch.split(edge_index[0], edge_counts)
+    edge_dst = torch.split(edge_index[1], edge_counts)
+    edge_shift = torch.split(edge_shift, edge_counts)
+
+    neighbor_lists = []
+    for i in range(len(atoms_list)):
+        offset = ptr[i]
+        neighbor_lists.append(((edge_src[i] - offset).numpy(), (edge_dst[i] - offset).numpy(), edge_shift[i].numpy()))
+
+    return neighbor_lists
+
+
+def add_periodic_edges(batch, r_max, self_interaction=True):
+    edge_index, edge_shift, edge_vec = periodic_radius_graph(batch.pos, batch.lattice, batch.batch, r_max,
+                                                             self_interaction=self_interaction)
+    batch.edge_index = edge_index
+    batch.edge_shift = edge_shift.to(batch.pos.dtype)
+    batch.edge_vec = edge_vec
+    return batch
+
+
+class PeriodicRadiusGraphCollater:
+    # wraps a collate function and builds the periodic graph of the collated batch on the fly
+    def __init__(self, collate_fn, r_max, self_interaction=True):
+        self.collate_fn = collate_fn
+        self.r_max = r_max
+        self.self_interaction = self_interaction
+
+    def __call__(self, batch):
+        return add_periodic_edges(self.collate_fn(batch), self.r_max, self_interaction=self.self_interaction)
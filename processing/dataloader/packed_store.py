@@ -0,0 +1,185 @@
+import os
+import json
+import uuid
+import shutil
+import pickle
+import numpy as np
+import torch
+import torch_geometric as tg
+
+from processing.dataloader.contrastive_data import CompData
+from processing.dataloader.graph_cache import dataset_fingerprint, graph_schema_version
+
+manifest_name = "manifest.json"
+
+
+### Packed graph store: every array field of a list of graphs is concatenated into one flat array
+### <key>.npy with offsets <key>.ptr.npy and per-graph shapes <key>.shape.npy, so that graph i is
+### the view flat[ptr[i]:ptr[i+1]].reshape(shape[i]). Other fields, if any, are pickled.
+### For contrastive datasets, group_ptr.npy delimits the graphs of each CompData; anything else
+### needed to rebuild a loader on top of the store is pickled into metadata.pkl.
+
+
+def packed_store_key(entries, prop, r_max, per_site, neighbor_engine, contrastive=False, compact=False, group_size=6):
+    # fingerprint of everything the stored graphs depend on, including the row order
+    settings = [prop, r_max, per_site, neighbor_engine, contrastive, compact, graph_schema_version]
+    if contrastive and group_size != 6:
+        # the default grouping is left out, so that existing contrastive stores keep their keys
+        settings.append(group_size)
+    return dataset_fingerprint(entries, prop, settings)
+
+
+def is_packed_store(path):
+    return os.path.isfile(os.path.join(path, manifest_name))
+
+
+def _to_numpy(value):
+    if isinstance(value, torch.Tensor):
+        return "tensor", value.detach().cpu().numpy()
+    if isinstance(value, np.ndarray):
+        return "numpy", value
+    return None, value
+
+
+def write_packed_graphs(data_list, path, group_sizes=None, metadata=None):
+    """Write a list of tg.data.Data (and optionally the sizes of their CompData groups) as a packed store"""
+    if len(data_list) == 0:
+        raise ValueError("Cannot pack an empty dataset")
+
+    keys = list(data_list[0].to_dict().keys())
+    arrays = {}
+    objects = {}
+    kinds = {}
+    for key in keys:
+        kind, _ = _to_numpy(data_list[0][key])
+        kinds[key] = kind
+        if kind is None:
+            objects[key] = []
+        else:
+            arrays[key] = []
+
+    for data in data_list:
+        fields = data.to_dict()
+        if set(fields.keys()) != set(keys):
+            raise ValueError("All graphs of a packed store must have the same fields")
+        for key, value in fields.items():
+            if kinds[key] is None:
+                objects[key].append(value)
+            else:
+                arrays[key].append(_to_numpy(value)[1])
+
+    # write into a private directory and move it into place, so that concurrent writers and readers never see a partial store
+    tmp_path = path + ".tmp." + uuid.uuid4().hex
+    os.makedirs(tmp_path)
+    for key, values in arrays.items():
+        sizes = [value.size for value in values]
+        np.save(os.path.join(tmp_path, key + ".npy"), np.concatenate([value.reshape(-1) for value in values]))
+        np.save(os.path.join(tmp_path, key + ".ptr.npy"), np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64))
+        np.save(os.path.join(tmp_path, key + ".shape.npy"), np.array([value.shape for value in values], dtype=np.int64))
+    with open(os.path.join(tmp_path, "objects.pkl"), "wb") as f:
+        pickle.dump(objects, f, protocol=pickle.HIGHEST_PROTOCOL)
+    if group_sizes is not None:
+        np.save(os.path.join(tmp_path, "group_ptr.npy"), np.concatenate([[0], np.cumsum(group_sizes)]).astype(np.int64))
+    if metadata is not None:
+        with open(os.path.join(tmp_path, "metadata.pkl"), "wb") as f:
+            pickle.dump(metadata, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    manifest = {"num_graphs": len(data_list), "fields": {key: kinds[key] or "object" for key in keys}}
+    with open(os.path.join(tmp_path, manifest_name), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # another process finished the same store first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not is_packed_store(path):
+            raise
+
+
+def write_packed_comp_data(comp_data, path):
+    data_list = [data for group in comp_data for data in group.structures]
+    write_packed_graphs(data_list, path, group_sizes=[len(group.structures) for group in comp_data])
+
+
+def _load_mapped(path):
+    try:
+        return np.load(path, mmap_mode="c")
+    except ValueError:
+        # empty arrays cannot be memory mapped
+        return np.load(path)
+
+
+class PackedGraphDataset(tg.data.Dataset):
+    """
+    Graphs of a packed store, opened as copy-on-write memory maps so that every process
+    reading the same store shares one physical copy. get returns Data objects whose tensors
+    are views into the maps.
+    """
+
+    def __init__(self, path, transform=None):
+        self.path = path
+        self._open()
+        super().__init__(None, transform)
+
+    def _open(self):
+        with open(os.path.join(self.path, manifest_name)) as f:
+            self.manifest = json.load(f)
+        self.fields = {}
+        for key, kind in self.manifest["fields"].items():
+            if kind != "object":
+                self.fields[key] = (kind,
+                                    _load_mapped(os.path.join(self.path, key + ".npy")),
+                                    np.load(os.path.join(self.path, key + ".ptr.npy")),
+                                    np.load(os.path.join(self.path, key + ".shape.npy")))
+        with open(os.path.join(self.path, "objects.pkl"), "rb") as f:
+            self.objects = pickle.load(f)
+        self.metadata = None
+        if os.path.isfile(os.path.join(self.path, "metadata.pkl")):
+            with open(os.path.join(self.path, "metadata.pkl"), "rb") as f:
+                self.metadata = pickle.load(f)
+
+    def __getstate__(self):
+        # DataLoader workers reopen the maps instead of receiving a pickled copy of the arrays
+        state = self.__dict__.copy()
+        for key in ("manifest", "fields", "objects", "metadata"):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def len(self):
+        return self.manifest["num_graphs"]
+
+    def get_graph(self, idx):
+        values = {}
+        for key, (kind, flat, ptr, shape) in self.fields.items():
+            value = np.asarray(flat[ptr[idx]:ptr[idx + 1]]).reshape(shape[idx])
+            values[key] = torch.from_numpy(value) if kind == "tensor" else value
+        for key, items in self.objects.items():
+            values[key] = items[idx]
+        return tg.data.Data(**values)
+
+    def get(self, idx):
+        return self.get_graph(idx)
+
+
+class PackedCompDataset(PackedGraphDataset):
+    # contrastive variant: item i is the CompData of the graphs group_ptr[i]:group_ptr[i+1]
+
+    def _open(self):
+        super()._open()
+        self.group_ptr = np.load(os.path.join(self.path, "group_ptr.npy"))
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        del state["group_ptr"]
+        return state
+
+    def len(self):
+        return len(self.group_ptr) - 1
+
+    def get(self, idx):
+        return CompData([self.get_graph(i) for i in range(self.group_ptr[idx], self.group_ptr[idx + 1])])
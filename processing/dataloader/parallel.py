@@ -0,0 +1,38 @@
+import pickle
+import multiprocessing
+import torch
+from tqdm import tqdm
+
+
+def _init_worker():
+    # one intra-op thread per worker, as torch.utils.data.DataLoader does, to avoid oversubscription
+    torch.set_num_threads(1)
+
+
+def _apply_chunk(args):
+    func, chunk = args
+    # results are pickled explicitly so that tensors are copied through the pipe
+    # instead of being shared through one file descriptor per tensor
+    return pickle.dumps([func(entry) for entry in chunk], protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def parallel_map(func, entries, num_workers=0, chunksize=64, desc=None):
+    """
+    Apply func to every entry and return the results in the order of entries.
+    With num_workers > 1 the entries are dispatched in chunks to a process pool;
+    func must then be picklable (a module-level function or a functools.partial of one).
+    The workers are started with spawn rather than fork, so that none inherits the OpenMP/MKL
+    thread pools torch has already started in this process.
+    """
+    entries = list(entries)
+
+    if num_workers is None or num_workers <= 1 or len(entries) <= chunksize:
+        return [func(entry) for entry in tqdm(entries, desc=desc)]
+
+    chunks = [(func, entries[i:i + chunksize]) for i in range(0, len(entries), chunksize)]
+    results = []
+    with multiprocessing.get_context("spawn").Pool(processes=num_workers, initializer=_init_worker) as pool:
+        for chunk_results in tqdm(pool.imap(_apply_chunk, chunks), total=len(chunks), desc=desc):
+            results.extend(pickle.loads(chunk_results))
+
+    return results
@@ -0,0 +1,79 @@
+import time
+from torch.utils.data import DataLoader
+
+
+### Asynchronous input pipeline: batches are collated in persistent worker processes, with a bounded
+### number of batches prefetched per worker, and optionally placed in pinned host memory. The loader
+### records per epoch how long the training loop waited for input (stall time) and how many batches
+### were in flight when it asked for the next one (queue depth).
+
+
+class PipelineDataLoader(DataLoader):
+    """
+    DataLoader whose iterators measure stall time and queue depth; the statistics of the last
+    complete pass are kept in pipeline_stats.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pipeline_stats = None
+
+    def __iter__(self):
+        return InstrumentedIterator(super().__iter__(), self)
+
+
+class InstrumentedIterator():
+
+    def __init__(self, iterator, loader):
+        self.iterator = iterator
+        self.loader = loader
+        self.start = time.time()
+        self.batches = 0
+        self.stall_time = 0.0
+        self.depths = []
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return len(self.iterator)
+
+    def __next__(self):
+        # batches dispatched to the workers and not yet consumed (0 for a single-process loader)
+        self.depths.append(getattr(self.iterator, "_tasks_outstanding", 0))
+        start = time.time()
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.depths.pop()
+            self.loader.pipeline_stats = self.get_stats()
+            raise
+        self.stall_time += time.time() - start
+        self.batches += 1
+        return batch
+
+    def get_stats(self):
+        epoch_time = time.time() - self.start
+        return {"batches": self.batches,
+                "epoch_time": epoch_time,
+                "stall_time": self.stall_time,
+                "stall_fraction": self.stall_time / epoch_time if epoch_time > 0 else 0.0,
+                "mean_queue_depth": sum(self.depths) / len(self.depths) if self.depths else 0.0,
+                "min_queue_depth": min(self.depths) if self.depths else 0}
+
+
+def attach_pipeline(data_loader, loader_options):
+    # rebuild the loader around its own batch sampler and collate function, so that batching is unchanged
+    if loader_options["loader_workers"] <= 0:
+        return data_loader
+    return PipelineDataLoader(data_loader.dataset, batch_sampler=data_loader.batch_sampler, collate_fn=data_loader.collate_fn,
+                              num_workers=loader_options["loader_workers"], pin_memory=loader_options["pin_memory"],
+                              persistent_workers=True, prefetch_factor=loader_options["prefetch_factor"])
+
+
+def report_pipeline(data_loader):
+    stats = getattr(data_loader, "pipeline_stats", None)
+    if stats is not None:
+        print("Input pipeline: " + "{:.2f}".format(stats["stall_time"]) + " s waiting for batches ("
+              + "{:.1%}".format(stats["stall_fraction"]) + " of the epoch), " + "{:.1f}".format(stats["mean_queue_depth"])
+              + " batches in flight on average")
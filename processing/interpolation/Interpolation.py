@@ -1,108 +1,124 @@
+import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix
+from processing.utils import load_dataset
+
+edge_dataset_path = "data/edge_dataset.json"
+
+# edge datasets and pure end-member reference tables, loaded once per process
+_edge_datasets = {}
+_pure_references = {}
+
+
+def get_edge_dataset(path=edge_dataset_path):
+    if path not in _edge_datasets:
+        _edge_datasets[path] = load_dataset(path)
+    return _edge_datasets[path]
+
+
+def get_pure_references(prop, path=edge_dataset_path):
+    """
+    Reference table of the pure (A, B) end members: a dict from (A, B) to its row in the table and the
+    array of their prop values, taken from the lowest-energy entry of every end member in the edge dataset
+    """
+    if (path, prop) not in _pure_references:
+        df = get_edge_dataset(path)
+        pair_index = {}
+        values = []
+        energies = []
+        for composition, energy, value in zip(df["composition"], df["dft_energy_per_atom"], df[prop]):
+            if len(composition["sites"]["A"]) != 1 or len(composition["sites"]["B"]) != 1:
+                raise Warning("A non-binary composition exist in edge_dataset")
+            curr_perov = (composition["sites"]["A"][0], composition["sites"]["B"][0])
+            if curr_perov not in pair_index:
+                pair_index[curr_perov] = len(values)
+                values.append(value)
+                energies.append(energy)
+            elif energy < energies[pair_index[curr_perov]]:
+                values[pair_index[curr_perov]] = value
+                energies[pair_index[curr_perov]] = energy
 
+        _pure_references[(path, prop)] = (pair_index, np.array(values, dtype=np.float64))
 
-def update_pure(props):
-    df = pd.read_json("data/edge_dataset.json")
-    for prop in props:       
-        pure_dict_init = {}
-        for _, row in df.iterrows():
-            if len(row["composition"]["sites"]["A"]) == 1 and len(row["composition"]["sites"]["B"]) == 1:
-                A_site = row["composition"]["sites"]["A"][0]
-                B_site = row["composition"]["sites"]["B"][0]
-                curr_perov = (A_site, B_site)
-                if curr_perov in pure_dict_init:
-                    if row["dft_energy_per_atom"] < pure_dict_init[curr_perov][1]:
-                        pure_dict_init[curr_perov] = [row[prop], row["dft_energy_per_atom"]]
-                else:
-                    pure_dict_init[curr_perov] = [row[prop], row["dft_energy_per_atom"]]
-            else:
-                raise Warning("A non-binary composition exist in edge_dataset")
+    return _pure_references[(path, prop)]
 
-        Pure_ref = {}
-        for key in pure_dict_init:
-            Pure_ref[key[0] + '.' + key[1]] = pure_dict_init[key][0]
+
+def update_pure(props):
+    for prop in props:
+        pair_index, values = get_pure_references(prop)
+        Pure_ref = {A_site + '.' + B_site: values[i] for (A_site, B_site), i in pair_index.items()}
 
     return Pure_ref
 
 
+def get_alloy_mask(df):
+    return np.array([len(composition["sites"]["A"]) > 1 or len(composition["sites"]["B"]) > 1
+                     for composition in df["composition"]], dtype=bool)
+
+
 def filter_alloys(df):
-    filt = []
-    for index, row in df.iterrows():
-        if len(row["composition"]["sites"]["A"]) > 1 or len(row["composition"]["sites"]["B"]) > 1:
-            filt.append(index)
-        else:
-             raise Warning("A binary composition exists in the examined dataset")
-    if len(filt) == 0:
+    if not get_alloy_mask(df).all():
+        raise Warning("A binary composition exists in the examined dataset")
+    if len(df) == 0:
         raise ValueError("All binary compositions")
-    filt_structs = df.loc[filt]
-
-    return filt_structs
-
-
-def interpolator(df, prop, Pure_ref):
-    Interpolation = []
-    Difference = []
-
-    for index, row in df.iterrows():
-        A_sites = row["composition"]["sites"]["A"]
-        B_sites = row["composition"]["sites"]["B"]
-        bounds = {}
-        found_bounds = True
-        
-        for A in A_sites:
-            for B in B_sites:
-                if A + '.' + B in Pure_ref:
-                    bounds[A + '.' + B] = []
-                    compA = float(row["composition"]["composition"][A])
-                    compB = float(row["composition"]["composition"][B])
-                    curr_comp = compA * compB
-                    bounds[A + '.' + B].append(curr_comp)
-                    bounds[A + '.' + B].append(Pure_ref[A + '.' + B])
+    # every row is an alloy; filter_interpolation copies the frame before adding columns
+    return df
+
+
+def get_interpolation_weights(compositions, pair_index):
+    # sparse weights x_A * x_B of every composition over the pure end members, together with whether all
+    # of its (A, B) end members have a reference. Entries are kept in (A, B) iteration order, so that the
+    # row sums of the products below are accumulated in the same order as the former per-row loop.
+    indptr = [0]
+    indices = []
+    weights = []
+    found_bounds = np.ones(len(compositions), dtype=bool)
+
+    for i, composition in enumerate(compositions):
+        fractions = composition["composition"]
+        for A in composition["sites"]["A"]:
+            for B in composition["sites"]["B"]:
+                j = pair_index.get((A, B))
+                if j is None:
+                    found_bounds[i] = False
                 else:
-                    found_bounds = False
-        total_comp = 0
-        for bound in bounds:
-            total_comp += bounds[bound][0]
-        if total_comp != 1.0:
-            for bound in bounds:
-                bounds[bound][0] /= total_comp
-        if (found_bounds):
-            curr_interpolation = 0
-            for bound in bounds:
-                curr_interpolation += bounds[bound][0] * bounds[bound][1]
-        else:
-            curr_interpolation = None
-
-
-        Interpolation.append(curr_interpolation)
-        
-        if curr_interpolation:
-            Difference.append(row[prop] - curr_interpolation)
-        else:
-            Difference.append(None)
-#            raise Warning("Cannot find all binary edges for an composition")
+                    indices.append(j)
+                    weights.append(float(fractions[A]) * float(fractions[B]))
+        indptr.append(len(indices))
+
+    weights = csr_matrix((np.array(weights, dtype=np.float64), np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+                         shape=(len(compositions), len(pair_index)))
+    return weights, found_bounds
+
+
+def interpolator(df, prop, pure_references):
+    """Interpolated prop of every composition from its pure end members, and the difference to prop (NaN where an end member is missing)"""
+    pair_index, values = pure_references
+    weights, found_bounds = get_interpolation_weights(df["composition"].tolist(), pair_index)
+
+    # weights are normalised only for compositions whose weights do not already sum to one
+    total_comp = np.repeat(weights @ np.ones(weights.shape[1]), np.diff(weights.indptr))
+    weights.data = np.where(total_comp != 1.0, weights.data / np.where(total_comp != 0.0, total_comp, 1.0), weights.data)
+
+    Interpolation = weights @ values
+    Interpolation[~found_bounds] = np.nan
+    # an interpolation of exactly zero has no difference, as before
+    Difference = np.where(found_bounds & (Interpolation != 0), df[prop].to_numpy(dtype=np.float64) - Interpolation, np.nan)
 
     return Interpolation, Difference
 
 
-def filter_interpolation(df, prop, Interpolation, Difference):    
-    interp_out = []
-    diff_out = []
-    indexes = []
-    for i in range(len(Interpolation)):
-        interp_out.append(Interpolation[i])
-        diff_out.append(Difference[i])
-        indexes.append(i)  
-    df_out = df.iloc[indexes].copy()
-    df_out[prop + '_interp'] = interp_out
-    df_out[prop + '_diff'] = diff_out
+def filter_interpolation(df, prop, Interpolation, Difference):
+    df_out = df.copy()
+    df_out[prop + '_interp'] = Interpolation
+    df_out[prop + '_diff'] = Difference
     return df_out
 
 
 def apply_interpolation(df, prop):
-    Pure_ref = update_pure([prop])
+    pure_references = get_pure_references(prop)
     df_interp = filter_alloys(df)
-    interp, diff = interpolator(df_interp, prop, Pure_ref)
+    interp, diff = interpolator(df_interp, prop, pure_references)
     df_interp = filter_interpolation(df_interp, prop, interp, diff)
     prop_diff_name = prop + "_diff"
     df_interp = df_interp.dropna(subset=[prop_diff_name], how='all')
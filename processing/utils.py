@@ -1,5 +1,100 @@
-import copy
+import os
+import pandas as pd
 from pymatgen.core import Structure
+from pymatgen.io.ase import AseAtomsAdaptor
+from processing.columnar import PackedStructure, pack_structure_dict, to_object_array, columnar_path, get_columnar_columns, read_columnar
+
+structure_columns = {
+    "unrelaxed": "unrelaxed_struct",
+    "relaxed": "opt_struct",
+    "spud": "spud_struct",
+    "M3Gnet_relaxed": "M3Gnet_relaxed_struct",
+}
+
+
+def load_dataset(json_path, struct_type=None, columns=None):
+    # read the columnar copy of a json dataset when it exists (see processing/columnar.py),
+    # keeping only the structure column of struct_type, and fall back to the json file otherwise
+    cols_path = columnar_path(json_path)
+    if not os.path.isdir(cols_path):
+        return pd.read_json(json_path)
+
+    if columns is None and struct_type in structure_columns:
+        unused = set(structure_columns.values()) - {structure_columns[struct_type]}
+        columns = [column for column in get_columnar_columns(cols_path) if column not in unused]
+    return read_columnar(cols_path, columns=columns)
+
+
+def to_structure(struct):
+    if isinstance(struct, PackedStructure):
+        return struct.to_structure()
+    return Structure.from_dict(struct)
+
+
+class LazyStructure():
+    """
+    Entry of a structure column that is converted on first use and memoised:
+    to a pymatgen Structure when one of its attributes is accessed, or directly to ase Atoms with to_ase_atoms
+    """
+
+    def __init__(self, struct):
+        self._struct = struct
+        self._structure = None
+        self._atoms = None
+
+    @property
+    def structure(self):
+        if self._structure is None:
+            self._structure = to_structure(self._struct)
+        return self._structure
+
+    def to_ase_atoms(self):
+        if self._atoms is None:
+            if self._structure is not None:
+                self._atoms = AseAtomsAdaptor.get_atoms(self._structure)
+            elif isinstance(self._struct, PackedStructure):
+                self._atoms = self._struct.to_ase_atoms()
+            else:
+                try:
+                    self._atoms = pack_structure_dict(self._struct).to_ase_atoms()
+                except ValueError:
+                    # disordered sites, left to pymatgen
+                    self._atoms = AseAtomsAdaptor.get_atoms(self.structure)
+        return self._atoms
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.structure, name)
+
+    def __len__(self):
+        return len(self.structure)
+
+    def __getitem__(self, index):
+        return self.structure[index]
+
+    def __iter__(self):
+        return iter(self.structure)
+
+    def __repr__(self):
+        return repr(self.structure)
+
+
+def to_ase_atoms(structure):
+    if isinstance(structure, LazyStructure):
+        return structure.to_ase_atoms()
+    return AseAtomsAdaptor.get_atoms(structure)
+
+
+def restore_structure_dicts(df):
+    # packed structures are written back as serialised pymatgen Structures, as in the json datasets, with
+    # their oxidation states, site properties and charge (columnar copies written before these were stored
+    # have lost them and need to be converted again)
+    df = df.copy()
+    for column in structure_columns.values():
+        if column in df.columns:
+            df[column] = [struct.as_dict() if isinstance(struct, PackedStructure) else struct for struct in df[column]]
+    return df
 
 
 def filter_data_by_properties(df,props):
@@ -9,20 +104,11 @@ def filter_data_by_properties(df,props):
 
 
 def select_structures(df,structure_type):
-    df_copy = copy.deepcopy(df)
-
-    if structure_type == "unrelaxed":
-        df_copy = df_copy.dropna(subset=["unrelaxed_struct"])
-        df_copy["structure"] = df_copy.apply(lambda x: Structure.from_dict(x["unrelaxed_struct"]), axis=1)
-    elif structure_type == "relaxed":
-        df_copy = df_copy.dropna(subset=["opt_struct"])
-        df_copy["structure"] = df_copy.apply(lambda x: Structure.from_dict(x["opt_struct"]), axis=1)
-    elif structure_type == "spud":
-        df_copy = df_copy.dropna(subset=["spud_struct"])
-        df_copy["structure"] = df_copy.apply(lambda x: Structure.from_dict(x["spud_struct"]), axis=1)
-    elif structure_type == "M3Gnet_relaxed":
-        df_copy = df_copy.dropna(subset=["M3Gnet_relaxed_struct"])
-        df_copy["structure"] = df_copy.apply(lambda x: Structure.from_dict(x["M3Gnet_relaxed_struct"]), axis=1)
-    else:
+    if structure_type not in structure_columns:
         raise ValueError("structure_type must be 'unrelaxed' or 'relaxed'")
-    return df_copy
+
+    # the other columns are shared with df rather than copied, and only the chosen
+    # structure column is converted, row by row, when a structure is first used
+    struct_column = structure_columns[structure_type]
+    df_selected = df.dropna(subset=[struct_column])
+    return df_selected.assign(structure=to_object_array([LazyStructure(struct) for struct in df_selected[struct_column]]))
@@ -4,16 +4,23 @@ from nff.train.loss import build_mae_loss
 from nff.train.evaluate import evaluate
 import torch
 from torch.autograd import Variable
+from training.model_training.precision import autocast, autocast_forward, remove_autocast_forward
+from training.model_training.device import get_device, get_nff_device, to_device
+from training.model_training.distributed import all_reduce_sums
 
 
-def evaluate_model(model, normalizer, model_type, dataloader, loss_fn, gpu_num, is_contrastive=False, contrastive_weight=1.0):
-    device_name = "cuda:" + str(gpu_num)
-    device = torch.device(device_name)
+def evaluate_model(model, normalizer, model_type, dataloader, loss_fn, gpu_num, is_contrastive=False, contrastive_weight=1.0, precision="fp32", distributed=False):
+    device = get_device(gpu_num)
 
     if model_type == "Painn":
         prop_names = model.output_keys
         loss_fn_painn = build_mae_loss(loss_coef = {prop: 1.0 for prop in prop_names})
-        return evaluate(model, dataloader, loss_fn_painn, device=gpu_num)
+        # as in training, only the forward pass is autocast and the losses are computed in float32
+        autocast_forward(model, precision, device)
+        try:
+            return evaluate(model, dataloader, loss_fn_painn, device=get_nff_device(device))
+        finally:
+            remove_autocast_forward(model)
 
     else:
         model.eval()
@@ -26,19 +33,21 @@ def evaluate_model(model, normalizer, model_type, dataloader, loss_fn, gpu_num,
         total_count = 0
         with torch.no_grad():
             for j, d in enumerate(dataloader):
-                if model_type == "CGCNN":
-                    input_struct = d[0]
-                    target = d[1]
-                    input_var = (Variable(input_struct[0].cuda(non_blocking=True)),
-                                 Variable(input_struct[1].cuda(non_blocking=True)),
-                                 input_struct[2].cuda(non_blocking=True),
-                                 [crys_idx.cuda(non_blocking=True) for crys_idx in input_struct[3]])
-                    output = model(*input_var).view(-1)
-                    target = Variable(target.cuda(non_blocking=True))
-                else:
-                    d.to(device)
-                    output = model(d)
-                    target = d.target
+                with autocast(precision, device):
+                    if model_type == "CGCNN":
+                        input_struct = d[0]
+                        target = d[1]
+                        input_var = (Variable(to_device(input_struct[0], device)),
+                                     Variable(to_device(input_struct[1], device)),
+                                     to_device(input_struct[2], device),
+                                     [to_device(crys_idx, device) for crys_idx in input_struct[3]])
+                        output = model(*input_var).view(-1)
+                        target = Variable(to_device(target, device))
+                    else:
+                        d.to(device)
+                        output = model(d)
+                        target = d.target
+                output = output.float()
                     
                 prediction = normalizer.denorm(output)
                 predictions.append(prediction)
@@ -47,10 +56,10 @@ def evaluate_model(model, normalizer, model_type, dataloader, loss_fn, gpu_num,
                     loss = loss_fn(normalizer.denorm(output).view(target.shape), target)
                     loss_cumulative = loss_cumulative + loss.detach().item()*target.shape[0]
                 elif is_contrastive:
-                    loss, direct_loss, contrastive_loss = loss_fn(normalizer.denorm(output), d.target, d.comp, contrastive_weight)
+                    loss, direct_loss, contrastive_loss = loss_fn(normalizer.denorm(output), d.target, d.group_ptr, contrastive_weight)
                     loss_cumulative = loss_cumulative + loss.detach().item()
                     loss_direct_cumulative = loss_direct_cumulative + direct_loss.detach().item()*target.shape[0]
-                    curr_contrastive_count = count_contastive_terms(d.comp)
+                    curr_contrastive_count = count_contastive_terms(d.group_ptr)
                     loss_contrastive_cumulative = loss_contrastive_cumulative + contrastive_loss.detach().item()*curr_contrastive_count
                     contrastive_term_count += curr_contrastive_count
                 else:
@@ -58,6 +67,11 @@ def evaluate_model(model, normalizer, model_type, dataloader, loss_fn, gpu_num,
                     loss_cumulative = loss_cumulative + loss.detach().item()*target.shape[0]
                 
                 total_count += target.shape[0]
+
+            if distributed:
+                # every rank evaluated its shard; the losses are averaged over the whole dataset
+                loss_cumulative, loss_direct_cumulative, loss_contrastive_cumulative, contrastive_term_count, total_count = all_reduce_sums(
+                    [loss_cumulative, loss_direct_cumulative, loss_contrastive_cumulative, contrastive_term_count, total_count])
         
             if is_contrastive:
                 loss_output = [loss_direct_cumulative/total_count+contrastive_weight*(loss_contrastive_cumulative/contrastive_term_count),loss_direct_cumulative/total_count,loss_contrastive_cumulative/contrastive_term_count]
@@ -68,19 +82,6 @@ def evaluate_model(model, normalizer, model_type, dataloader, loss_fn, gpu_num,
 
 
 
-def count_contastive_terms(comps):
-    last_index = 0
-    ordering_count = 0
-    stored_comp = comps[0]
-    for i in range(len(comps)):
-        curr_comp = comps[i]
-        if curr_comp != stored_comp:
-            length = i-last_index
-            ordering_count += (length)**2 - length
-            last_index = i
-            stored_comp = comps[i]
-
-    length = len(comps)-last_index
-    ordering_count += (length)**2 - length
-
-    return ordering_count
\ No newline at end of file
+def count_contastive_terms(group_ptr):
+    lengths = group_ptr[1:] - group_ptr[:-1]
+    return int((lengths**2 - lengths).sum())
\ No newline at end of file
@@ -1,4 +1,6 @@
 import torch
+import torch_scatter
+from functools import partial
 
 kb = 0.00008617333
 T = 1300
@@ -49,26 +51,77 @@ def pairwise_energies(output, target):
     return torch.sum(torch.abs(output_matrix-target_matrix))
     
 
-def contrastive_loss(output,target,comp,contrastive_weight):
+def get_group_pairs(group_ptr):
+    # indices (i, j) of every ordered pair of structures within the same group, including i == j
+    sizes = group_ptr[1:] - group_ptr[:-1]
+    group = torch.repeat_interleave(torch.arange(len(sizes), device=sizes.device), sizes)
+    rows = torch.repeat_interleave(torch.arange(len(group), device=sizes.device), sizes[group])
+    row_start = torch.cumsum(sizes[group], 0) - sizes[group]
+    cols = group_ptr[group[rows]] + torch.arange(len(rows), device=sizes.device) - row_start[rows]
+    return group, rows, cols
+
+
+def segment_min(values, group, num_groups):
+    return torch_scatter.scatter_min(values, group, dim=0, dim_size=num_groups)[0]
+
+
+def segment_pairwise_energies(output, target, group_ptr):
+    # pairwise_energies summed over all groups of the batch at once
+    group, rows, cols = get_group_pairs(group_ptr)
+    output_ref = output - segment_min(output, group, len(group_ptr) - 1)[group]
+    target_ref = target - segment_min(target, group, len(group_ptr) - 1)[group]
+    output_matrix = output_ref[rows] - output_ref[cols]
+    target_matrix = target_ref[rows] - target_ref[cols]
+    return torch.sum(torch.abs(output_matrix-target_matrix))
+
+
+def segment_pairwise_probs(output, target, group_ptr):
+    # pairwise_probs summed over all groups of the batch at once
+    group, rows, cols = get_group_pairs(group_ptr)
+    num_groups = len(group_ptr) - 1
+    output_prob = torch.exp(-(output - segment_min(output, group, num_groups)[group])/(kb*T))
+    target_prob = torch.exp(-(target - segment_min(target, group, num_groups)[group])/(kb*T))
+    output_norm = output_prob / torch_scatter.scatter_add(output_prob, group, dim=0, dim_size=num_groups)[group]
+    target_norm = target_prob / torch_scatter.scatter_add(target_prob, group, dim=0, dim_size=num_groups)[group]
+    output_matrix = output_norm[rows] - output_norm[cols]
+    target_matrix = target_norm[rows] - target_norm[cols]
+    return torch.sum(torch.abs(output_matrix-target_matrix))
+
+
+def sorted_pairwise_energies(output, target, group_ptr):
+    # the same sum as segment_pairwise_energies in O(n log n): every pairwise term is |r_i - r_j| of the residuals
+    # r = output - target (the group minima cancel), and over the sorted residuals of a group of size n the k-th
+    # smallest enters the n*(n-1)/2 unordered pairs with weight 2k - n + 1; ordered pairs count twice
+    sizes = group_ptr[1:] - group_ptr[:-1]
+    group = torch.repeat_interleave(torch.arange(len(sizes), device=sizes.device), sizes)
+    residual = output - target
+    # sort by residual, then stably by group, so that each group's residuals are sorted in place
+    order = torch.argsort(residual)
+    order = order[torch.sort(group[order], stable=True)[1]]
+    rank = torch.arange(len(group), device=sizes.device) - group_ptr[group]
+    return 2 * torch.sum(residual[order] * (2 * rank - sizes[group] + 1))
+
+
+def contrastive_loss(output,target,group_ptr,contrastive_weight,pairwise=segment_pairwise_energies):
+    # group_ptr: offsets of the composition groups in the batch (CompBatch.group_ptr)
+    # pairwise: segment_pairwise_energies, segment_pairwise_probs or sorted_pairwise_energies
     MAE = torch.mean(torch.abs(output-target))
-    ordering = 0
-    last_index = 0
-    ordering_count = 0
-    stored_comp = comp[0]
-    for i in range(len(comp)):
-        curr_comp = comp[i]
-        if curr_comp != stored_comp:
-            #ordering += pairwise_probs(output[last_index:i],target[last_index:i])
-            ordering += pairwise_energies(output[last_index:i],target[last_index:i])
-            ordering_count += (output[last_index:i].shape[0])**2 - output[last_index:i].shape[0]
-            last_index = i
-            stored_comp = comp[i]
-    
-    ordering += pairwise_energies(output[last_index:],target[last_index:])
-    ordering_count += (output[last_index:].shape[0])**2 - output[last_index:].shape[0]
+    group_ptr = group_ptr.to(output.device)
+    sizes = group_ptr[1:] - group_ptr[:-1]
+    ordering = pairwise(output.view(-1), target.view(-1), group_ptr)
+    ordering_count = (sizes**2 - sizes).sum()
 
     if ordering_count != 0:
-        ordering /= ordering_count
+        ordering = ordering / ordering_count
     
     return MAE + contrastive_weight*ordering, MAE, ordering
 
+
+contrastive_loss_modes = {"energies": segment_pairwise_energies, "probs": segment_pairwise_probs, "sorted": sorted_pairwise_energies}
+
+
+def get_contrastive_loss(mode="energies"):
+    # "sorted" gives the "energies" loss in O(n log n) time and O(n) memory, for groups of hundreds of orderings
+    if mode not in contrastive_loss_modes:
+        raise ValueError("contrastive loss mode must be one of " + ", ".join(contrastive_loss_modes))
+    return partial(contrastive_loss, pairwise=contrastive_loss_modes[mode])
@@ -0,0 +1,113 @@
+import warnings
+import torch
+
+
+### Compiled execution of CGCNN and e3nn models. Only the forward method is replaced, so the module, its
+### state_dict keys and saved checkpoints are the same as in eager mode.
+###  - "compile" (PyTorch 2.0 or later) runs forward through torch.compile with dynamic shapes, so that
+###    structures of different sizes share compiled graphs instead of recompiling for every batch. Graph
+###    breaks are handled by torch.compile itself; a forward that fails to compile runs eagerly from then on.
+###  - "trace" (any PyTorch, CGCNN only) runs TorchScript traces of forward. A trace fixes the Python
+###    control flow of the batch it was recorded on: the pooling loop over the crystals of a batch and
+###    the training/evaluation behaviour of batch normalisation. One trace is therefore kept per number
+###    of crystals and mode; the atom and neighbor counts stay dynamic. e3nn models convert tensor values
+###    to Python integers while batching their graphs (e.g. scatter sizes), which a trace would freeze.
+### A mode that cannot run (no torch.compile, or a trace of an e3nn model) falls back to eager execution
+### with a warning.
+
+executions = ("eager", "compile", "trace")
+
+
+def get_execution(hyperparameters, execution="eager"):
+    # the hyperparameters take precedence, so that a sweep can select the execution mode
+    if isinstance(hyperparameters, dict) and "execution" in hyperparameters:
+        execution = hyperparameters["execution"]
+    if execution not in executions:
+        raise ValueError("execution must be one of " + ", ".join(executions))
+    return execution
+
+
+def compile_model(model, execution="eager", model_type="CGCNN"):
+    if execution == "eager" or "forward" in model.__dict__:
+        return model
+
+    if execution == "compile":
+        if not hasattr(torch, "compile"):
+            warnings.warn("execution 'compile' needs PyTorch 2.0 or later (installed: " + torch.__version__ + "); running eagerly")
+            return model
+        model.forward = CompiledForward(model)
+    elif execution == "trace":
+        if model_type != "CGCNN":
+            warnings.warn("execution 'trace' supports CGCNN models only; running " + model_type + " eagerly")
+            return model
+        model.forward = TracedForward(model)
+    else:
+        raise ValueError("execution must be one of " + ", ".join(executions))
+    return model
+
+
+def uncompile_model(model):
+    # back to the eager forward of the class, e.g. before pickling the whole module
+    model.__dict__.pop("forward", None)
+    return model
+
+
+class CompiledForward():
+    """
+    Replacement forward running torch.compile's version of the class forward, or the eager forward
+    once compilation has failed (with a warning, so that a training run continues).
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.compiled = torch.compile(type(model).forward.__get__(model), dynamic=True)
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args, **kwargs)
+            except Exception as error:
+                warnings.warn("torch.compile failed (" + type(error).__name__ + ": " + str(error) + "); running eagerly")
+                self.compiled = None
+        return type(self.model).forward(self.model, *args, **kwargs)
+
+
+class EagerForward(torch.nn.Module):
+    """
+    The eager forward of a CGCNN model with the crystal index list spread into separate tensor
+    arguments, as torch.jit.trace takes tensors (the parameters remain those of the model).
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, atom_fea, nbr_fea, nbr_fea_idx, *crystal_atom_idx):
+        return type(self.model).forward(self.model, atom_fea, nbr_fea, nbr_fea_idx, list(crystal_atom_idx))
+
+
+class TracedForward():
+    """
+    Replacement forward of a CGCNN model dispatching to a trace per (mode, autocast, number of crystals).
+    A trace is recorded without gradients and the model's buffers (the batch normalisation running
+    statistics) are restored afterwards, so every batch updates them once, as in eager mode.
+    """
+
+    def __init__(self, model):
+        self.eager = EagerForward(model)
+        self.traces = {}
+
+    def __call__(self, atom_fea, nbr_fea, nbr_fea_idx, crystal_atom_idx):
+        inputs = (atom_fea, nbr_fea, nbr_fea_idx, *crystal_atom_idx)
+        key = (self.eager.model.training, torch.is_autocast_enabled(), len(crystal_atom_idx))
+        if key not in self.traces:
+            self.traces[key] = self.record(inputs)
+        return self.traces[key](*inputs)
+
+    def record(self, inputs):
+        buffers = [(buffer, buffer.clone()) for buffer in self.eager.model.buffers()]
+        with torch.no_grad():
+            trace = torch.jit.trace(self.eager, inputs, check_trace=False)
+            for buffer, saved in buffers:
+                buffer.copy_(saved)
+        return trace
@@ -0,0 +1,65 @@
+import os
+import torch
+
+
+### Device abstraction for training and inference. gpu_num keeps its meaning as the index of a CUDA
+### device; "cpu" or a negative index selects the CPU backend, whose intra-op and inter-op thread pools
+### and (optionally) the cores the process may run on are set with configure_cpu.
+
+
+def is_cpu(gpu_num):
+    return gpu_num is None or gpu_num == "cpu" or (isinstance(gpu_num, int) and gpu_num < 0)
+
+
+def get_device(gpu_num):
+    if is_cpu(gpu_num):
+        return torch.device("cpu")
+    device = torch.device("cuda:" + str(gpu_num))
+    torch.cuda.set_device(device)
+    return device
+
+
+def get_nff_device(device):
+    # the nff Trainer and evaluate take a CUDA index or "cpu"
+    return "cpu" if device.type == "cpu" else device.index
+
+
+def to_device(tensor, device):
+    # non-blocking copies overlap with compute when the source is in pinned memory
+    return tensor.to(device, non_blocking=True)
+
+
+def configure_cpu(num_threads=None, num_interop_threads=None, cores=None):
+    """
+    Set the number of intra-op threads (within one operator), inter-op threads (between independent
+    operators) and the cores this process is pinned to. None leaves a setting at its default;
+    with cores but no num_threads, one intra-op thread is used per core.
+    """
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+        if num_threads is None:
+            num_threads = len(cores)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # it can only be set before the first inter-op parallel work
+            print("Inter-op threads already started, keeping " + str(torch.get_num_interop_threads()))
+    return {"num_threads": torch.get_num_threads(), "num_interop_threads": torch.get_num_interop_threads(),
+            "cores": sorted(os.sched_getaffinity(0))}
+
+
+def parse_cores(cores):
+    # "0-3,8,10-11" -> [0, 1, 2, 3, 8, 10, 11]
+    if cores is None:
+        return None
+    parsed = []
+    for part in cores.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            parsed.extend(range(int(start), int(end) + 1))
+        else:
+            parsed.append(int(part))
+    return parsed
@@ -0,0 +1,137 @@
+import os
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+### Multi-process data-parallel training over the gloo backend, which runs on CPU-only machines as well.
+### Processes are started by torchrun (one node or several), which sets RANK, LOCAL_RANK, WORLD_SIZE,
+### LOCAL_WORLD_SIZE, MASTER_ADDR and MASTER_PORT, or spawned with an explicit rank and init_method.
+### CGCNN and e3nn models are wrapped in DistributedDataParallel; PaiNN is trained by nff's Trainer,
+### which saves and reloads the whole module, so the module stays a plain nn.Module and its gradients are
+### averaged in buckets by the optimizer step.
+
+
+def init_distributed(rank=None, world_size=None, init_method="env://", backend="gloo"):
+    if rank is None:
+        rank = int(os.environ["RANK"])
+        world_size = int(os.environ["WORLD_SIZE"])
+    dist.init_process_group(backend, init_method=init_method, rank=rank, world_size=world_size)
+    return rank, world_size
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def get_local_rank():
+    return int(os.environ.get("LOCAL_RANK", get_rank()))
+
+
+def get_local_cores(local_rank, local_world_size):
+    # a contiguous block of the available cores for each process on this node
+    cores = sorted(os.sched_getaffinity(0))
+    per_process = max(1, len(cores) // local_world_size)
+    start = (local_rank * per_process) % len(cores)
+    return cores[start:start + per_process]
+
+
+def wrap_model(model, device):
+    # the parameters of rank 0 are broadcast to all ranks when the wrapper is built
+    if device.type == "cuda":
+        return DistributedDataParallel(model, device_ids=[device.index])
+    return DistributedDataParallel(model)
+
+
+def unwrap_model(model):
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+def broadcast_parameters(model):
+    # start every rank from the parameters of rank 0, as DistributedDataParallel does
+    for parameter in model.parameters():
+        dist.broadcast(parameter.data, src=0)
+    return model
+
+
+class AveragedGradientStep():
+    """
+    Replacement step of an optimizer that first averages the gradients over the ranks, in flattened
+    buckets of about bucket_bytes with one all_reduce each. A parameter without a gradient on this rank
+    contributes zeros, so that every rank takes part in the same collectives.
+    """
+
+    def __init__(self, optimizer, bucket_bytes=25 * 1024**2):
+        self.optimizer = optimizer
+        self.step = type(optimizer).step
+        self.bucket_bytes = bucket_bytes
+
+    def __call__(self, *args, **kwargs):
+        parameters = [p for group in self.optimizer.param_groups for p in group["params"] if p.requires_grad]
+        for parameter in parameters:
+            if parameter.grad is None:
+                parameter.grad = torch.zeros_like(parameter)
+        for bucket in get_buckets([p.grad for p in parameters], self.bucket_bytes):
+            flat = _flatten_dense_tensors(bucket)
+            dist.all_reduce(flat)
+            flat /= get_world_size()
+            for grad, averaged in zip(bucket, _unflatten_dense_tensors(flat, bucket)):
+                grad.copy_(averaged)
+        return self.step(self.optimizer, *args, **kwargs)
+
+
+def get_buckets(tensors, bucket_bytes):
+    # consecutive tensors of one dtype and device, up to bucket_bytes per bucket
+    buckets = []
+    for tensor in tensors:
+        size = tensor.numel() * tensor.element_size()
+        last = buckets[-1] if buckets else None
+        if (last is None or last["dtype"] != tensor.dtype or last["device"] != tensor.device
+                or last["bytes"] + size > bucket_bytes):
+            last = {"tensors": [], "bytes": 0, "dtype": tensor.dtype, "device": tensor.device}
+            buckets.append(last)
+        last["tensors"].append(tensor)
+        last["bytes"] += size
+    return [bucket["tensors"] for bucket in buckets]
+
+
+def average_gradients_before_step(model, optimizer):
+    # the DistributedDataParallel reduction for models trained by code that saves the whole module (nff's Trainer)
+    broadcast_parameters(model)
+    optimizer.step = AveragedGradientStep(optimizer)
+    return optimizer
+
+
+def all_reduce_sums(values):
+    # element-wise sums of a list of numbers over all ranks
+    if not is_distributed():
+        return values
+    totals = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(totals)
+    return totals.tolist()
+
+
+def broadcast_object(obj, src=0):
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
@@ -0,0 +1,76 @@
+import contextlib
+import torch
+
+
+### Mixed precision: the forward pass runs under torch.autocast, while the Normalizer, the losses and
+### their accumulation and the optimizer state stay in float32. "bf16" and "fp16" select the reduced
+### type on CUDA; on CPU, where autocast only supports bfloat16, both run in bfloat16.
+
+precisions = ("fp32", "bf16", "fp16")
+
+
+def get_autocast_dtype(precision, device):
+    if precision not in precisions:
+        raise ValueError("precision must be one of " + ", ".join(precisions))
+    if precision == "fp32":
+        return None
+    if device.type == "cpu" or precision == "bf16":
+        return torch.bfloat16
+    return torch.float16
+
+
+def autocast(precision, device):
+    dtype = get_autocast_dtype(precision, device)
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+def get_grad_scaler(precision, device):
+    # float16 gradients underflow without loss scaling; bfloat16 has the exponent range of float32
+    return torch.cuda.amp.GradScaler(enabled=get_autocast_dtype(precision, device) == torch.float16)
+
+
+class AutocastForward():
+    """
+    Replacement forward running the class forward under autocast and handing back float32 outputs, for
+    models trained or evaluated by code that calls the model itself (nff's Trainer and evaluate), so that
+    their losses and metrics stay in float32. The setting belongs to the run, not to the model: a pickled
+    model (e.g. an nff checkpoint) loads with a float32 forward.
+    """
+
+    def __init__(self, model, precision, device):
+        self.model = model
+        self.precision = precision
+        self.device = device
+
+    def __call__(self, *args, **kwargs):
+        with autocast(self.precision, self.device):
+            outputs = type(self.model).forward(self.model, *args, **kwargs)
+        return to_float32(outputs)
+
+    def __getstate__(self):
+        return {"model": self.model, "precision": "fp32", "device": torch.device("cpu")}
+
+
+def autocast_forward(model, precision, device):
+    if get_autocast_dtype(precision, device) is not None:
+        model.forward = AutocastForward(model, precision, device)
+    return model
+
+
+def remove_autocast_forward(model):
+    if isinstance(model.__dict__.get("forward"), AutocastForward):
+        del model.__dict__["forward"]
+    return model
+
+
+def to_float32(outputs):
+    # reduced-precision floating point tensors of a tensor, dict or list of outputs back to float32
+    if isinstance(outputs, torch.Tensor):
+        return outputs.float() if outputs.dtype in (torch.float16, torch.bfloat16) else outputs
+    if isinstance(outputs, dict):
+        return {key: to_float32(value) for key, value in outputs.items()}
+    if isinstance(outputs, (list, tuple)):
+        return type(outputs)(to_float32(value) for value in outputs)
+    return outputs
@@ -2,34 +2,41 @@ import os
 from models.PerovskiteOrderingGCNNs_painn.nff.train import Trainer, get_trainer, get_model, load_model, loss, hooks, metrics, evaluate
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from torch.optim import Adam
-from training.loss import contrastive_loss
-from training.evaluate import evaluate_model
+from training.loss import get_contrastive_loss
+from training.evaluate import evaluate_model, count_contastive_terms
+from processing.dataloader.pipeline import report_pipeline
+from training.model_training.precision import autocast, get_grad_scaler, autocast_forward, remove_autocast_forward
+from training.model_training.compilation import get_execution, compile_model
+from training.model_training.device import get_device, get_nff_device, to_device
+from training.model_training.distributed import is_distributed, is_main_process, wrap_model, average_gradients_before_step, all_reduce_sums, broadcast_object
 import torch
 from torch.autograd import Variable
 from tqdm import tqdm
 import time
+import tempfile
 
-def trainer(model,normalizer,model_type,train_loader,val_loader,hyperparameters,OUTDIR,gpu_num,train_eval_loader=None,contrastive_weight=1.0):
+def trainer(model,normalizer,model_type,train_loader,val_loader,hyperparameters,OUTDIR,gpu_num,train_eval_loader=None,contrastive_weight=1.0,contrastive_loss_mode="energies",precision="fp32",execution="eager"):
     
     hyperparameters["MaxEpochs"] = 100
     
     if not os.path.exists(OUTDIR):
         os.makedirs(OUTDIR)
 
+    contrastive_loss = get_contrastive_loss(contrastive_loss_mode)
     if "contrastive" in model_type:
         loss_fn = contrastive_loss 
     else:
         loss_fn = torch.nn.L1Loss()
     
     if model_type == "Painn":
-        best_model = train_painn(model,train_loader,val_loader,hyperparameters,OUTDIR,gpu_num)
+        best_model = train_painn(model,train_loader,val_loader,hyperparameters,OUTDIR,gpu_num,precision=precision)
     else:
-        best_model = train_CGCNN_e3nn(model,normalizer,model_type,loss_fn,contrastive_loss,train_loader,val_loader,hyperparameters,OUTDIR,gpu_num,train_eval_loader,contrastive_weight)
+        best_model = train_CGCNN_e3nn(model,normalizer,model_type,loss_fn,contrastive_loss,train_loader,val_loader,hyperparameters,OUTDIR,gpu_num,train_eval_loader,contrastive_weight,precision=precision,execution=execution)
 
     return best_model, loss_fn
 
 
-def train_painn(model,train_loader,val_loader,hyperparameters,OUTDIR,gpu_num):
+def train_painn(model,train_loader,val_loader,hyperparameters,OUTDIR,gpu_num,precision="fp32"):
 
     prop_names = model.output_keys
     loss_fn = loss.build_mae_loss(loss_coef = {prop: 1.0 for prop in prop_names})
@@ -38,8 +45,12 @@ def train_painn(model,train_loader,val_loader,hyperparameters,OUTDIR,gpu_num):
     #loss_fn = loss.build_mse_loss(loss_coef = {prop: 1.0 for prop in prop_names})
     #train_metrics = [metrics.MeanSquaredError(prop) for prop in prop_names]
 
+    device = get_device(gpu_num)
     trainable_params = filter(lambda p: p.requires_grad, model.parameters())
     optimizer = Adam(trainable_params, lr=10**hyperparameters["log_lr"])
+    if is_distributed():
+        model.to(device)
+        average_gradients_before_step(model, optimizer)
     num_epochs = hyperparameters["MaxEpochs"]
     
     train_hooks = [
@@ -63,8 +74,15 @@ def train_painn(model,train_loader,val_loader,hyperparameters,OUTDIR,gpu_num):
             stop_after_min=True)
     ]
     
+    # only rank 0 writes to OUTDIR; the checkpoints of the other ranks, which hold the same model, are discarded
+    if is_main_process():
+        model_path = OUTDIR
+    else:
+        scratch_dir = tempfile.TemporaryDirectory()
+        model_path = scratch_dir.name
+
     T = Trainer(
-        model_path=OUTDIR, 
+        model_path=model_path, 
         model=model, 
         loss_fn=loss_fn, 
         optimizer=optimizer, 
@@ -75,18 +93,27 @@ def train_painn(model,train_loader,val_loader,hyperparameters,OUTDIR,gpu_num):
         mini_batches=1
     )
     
-    T.train(device=gpu_num, n_epochs=num_epochs)
-
-    return T.get_best_model()
-
-def train_CGCNN_e3nn(model,normalizer,model_type,loss_fn,contrastive_loss_fn,train_loader,val_loader,hyperparameters,OUTDIR,gpu_num,train_eval_loader,contrastive_weight):
+    if precision == "fp16":
+        raise ValueError("The nff Trainer does not scale losses, so PaiNN supports only fp32 and bf16")
+    # only the forward passes run in reduced precision; the nff losses, metrics, hooks and optimizer state stay in float32
+    autocast_forward(model, precision, device)
+    try:
+        T.train(device=get_nff_device(device), n_epochs=num_epochs)
+    finally:
+        remove_autocast_forward(model)
+
+    return remove_autocast_forward(T.get_best_model())
+
+def train_CGCNN_e3nn(model,normalizer,model_type,loss_fn,contrastive_loss_fn,train_loader,val_loader,hyperparameters,OUTDIR,gpu_num,train_eval_loader,contrastive_weight,precision="fp32",execution="eager"):
 ### Adapted from https://github.com/ninarina12/phononDoS_tutorial/blob/main/utils/utils_model.py
-    device_name = "cuda:" + str(gpu_num)
-    device = torch.device(device_name)
-    torch.cuda.set_device(device)
+    device = get_device(gpu_num)
 
     best_validation_error = 99999999
     model.to(device)
+    compile_model(model, get_execution(hyperparameters, execution), model_type)
+    # the forward passes of training go through the DistributedDataParallel wrapper, evaluation uses the model itself
+    distributed = is_distributed()
+    train_model = wrap_model(model, device) if distributed else model
 
 
     optimizer = torch.optim.Adam(model.parameters(), lr=10**hyperparameters["log_lr"])
@@ -97,6 +124,7 @@ def train_CGCNN_e3nn(model,normalizer,model_type,loss_fn,contrastive_loss_fn,tra
             factor=0.5, 
             min_lr=1e-7, 
         )
+    scaler = get_grad_scaler(precision, device)
 
     results = {}
     history = []
@@ -104,45 +132,61 @@ def train_CGCNN_e3nn(model,normalizer,model_type,loss_fn,contrastive_loss_fn,tra
     for epoch in range(max_epochs):
         model.train()
         start_time = time.time()
+        num_structures = 0
+        contrastive_terms = 0
         
-        for j, d in tqdm(enumerate(train_loader), total=len(train_loader)):
-
-            if model_type == "CGCNN":
-                input_struct = d[0]
-                target = d[1]
-                input_var = (Variable(input_struct[0].cuda(non_blocking=True)),
-                             Variable(input_struct[1].cuda(non_blocking=True)),
-                             input_struct[2].cuda(non_blocking=True),
-                             [crys_idx.cuda(non_blocking=True) for crys_idx in input_struct[3]])
-                output = model(*input_var).view(-1)
-                target = Variable(target.cuda(non_blocking=True))
-
-            else:
-                d.to(device)
-                output = model(d)
+        for j, d in tqdm(enumerate(train_loader), total=len(train_loader), disable=not is_main_process()):
+
+            # only the forward pass runs in reduced precision; the output is denormalised and compared in float32
+            with autocast(precision, device):
+                if model_type == "CGCNN":
+                    input_struct = d[0]
+                    target = d[1]
+                    input_var = (Variable(to_device(input_struct[0], device)),
+                                 Variable(to_device(input_struct[1], device)),
+                                 to_device(input_struct[2], device),
+                                 [to_device(crys_idx, device) for crys_idx in input_struct[3]])
+                    output = train_model(*input_var).view(-1)
+                    target = Variable(to_device(target, device))
+
+                else:
+                    d.to(device)
+                    output = train_model(d)
+            output = output.float()
+            num_structures += target.shape[0] if model_type == "CGCNN" else d.target.shape[0]
 
 
             if model_type == "CGCNN":
                 loss = loss_fn(normalizer.denorm(output).view(target.shape), target)
             elif model_type == "e3nn_contrastive":
-                loss, direct_loss, contrastive_loss = loss_fn(normalizer.denorm(output), d.target, d.comp, contrastive_weight)
+                loss, direct_loss, contrastive_loss = loss_fn(normalizer.denorm(output), d.target, d.group_ptr, contrastive_weight)
+                contrastive_terms += count_contastive_terms(d.group_ptr)
             else:
                 loss = loss_fn(normalizer.denorm(output), d.target)
 
             optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
         end_time = time.time()
         wall = end_time - start_time    
+        num_structures, contrastive_terms = all_reduce_sums([num_structures, contrastive_terms])
+        throughput = num_structures / wall
+        if is_main_process():
+            report_pipeline(train_loader)
+            if model_type == "e3nn_contrastive":
+                # measured the same way for fixed-size and composition-group batches, so the two loaders compare directly
+                print("Contrastive loss: " + "{:.0f}".format(contrastive_terms / wall) + " pairwise terms per second")
     
         model.eval()
 
         if "e3nn" in model_type and train_eval_loader != None:
-            predictions, targets, train_avg_loss = evaluate_model(model, normalizer, model_type, train_eval_loader, contrastive_loss_fn, gpu_num,is_contrastive=True,contrastive_weight=contrastive_weight)
-            predictions, targets, valid_avg_loss = evaluate_model(model, normalizer, model_type, val_loader, contrastive_loss_fn, gpu_num,is_contrastive=True,contrastive_weight=contrastive_weight)
+            predictions, targets, train_avg_loss = evaluate_model(model, normalizer, model_type, train_eval_loader, contrastive_loss_fn, gpu_num,is_contrastive=True,contrastive_weight=contrastive_weight,precision=precision,distributed=distributed)
+            predictions, targets, valid_avg_loss = evaluate_model(model, normalizer, model_type, val_loader, contrastive_loss_fn, gpu_num,is_contrastive=True,contrastive_weight=contrastive_weight,precision=precision,distributed=distributed)
 
-            results = record_keep(history,results,epoch,wall,optimizer,valid_avg_loss,train_avg_loss,model,"contrastive",contrastive_weight=contrastive_weight)
+            if is_main_process():
+                results = record_keep(history,results,epoch,wall,optimizer,valid_avg_loss,train_avg_loss,model,"contrastive",contrastive_weight=contrastive_weight,throughput=throughput)
             
             if "contrastive" in model_type:
                 validation_loss = valid_avg_loss[0]
@@ -150,24 +194,30 @@ def train_CGCNN_e3nn(model,normalizer,model_type,loss_fn,contrastive_loss_fn,tra
                 validation_loss = valid_avg_loss[1]
 
         else:
-            predictions, targets, train_avg_loss = evaluate_model(model, normalizer, model_type, train_loader, loss_fn, gpu_num)
-            predictions, targets, valid_avg_loss = evaluate_model(model, normalizer, model_type, val_loader, loss_fn, gpu_num)
+            predictions, targets, train_avg_loss = evaluate_model(model, normalizer, model_type, train_loader, loss_fn, gpu_num, precision=precision, distributed=distributed)
+            predictions, targets, valid_avg_loss = evaluate_model(model, normalizer, model_type, val_loader, loss_fn, gpu_num, precision=precision, distributed=distributed)
         
-            results = record_keep(history,results,epoch,wall,optimizer,valid_avg_loss,train_avg_loss,model,"standard")
+            if is_main_process():
+                results = record_keep(history,results,epoch,wall,optimizer,valid_avg_loss,train_avg_loss,model,"standard",throughput=throughput)
             validation_loss = valid_avg_loss[0]
 
+        # the validation losses are reduced over all ranks, so every rank takes the same decisions
         if (epoch == 0) or (validation_loss < best_validation_error):
             best_validation_error = validation_loss
-            with open(OUTDIR + '/best_model.torch', 'wb') as f:
-                torch.save(results, f)
+            if is_main_process():
+                with open(OUTDIR + '/best_model.torch', 'wb') as f:
+                    torch.save(results, f)
 
         if scheduler is not None:
             scheduler.step(validation_loss)
 
-    with open(OUTDIR + '/final_model.torch', 'wb') as f:
-        torch.save(results, f)
-
-    model_state = torch.load(OUTDIR + '/best_model.torch', map_location=torch.device('cpu'))['state']
+    model_state = None
+    if is_main_process():
+        with open(OUTDIR + '/final_model.torch', 'wb') as f:
+            torch.save(results, f)
+        model_state = torch.load(OUTDIR + '/best_model.torch', map_location=torch.device('cpu'))['state']
+    # OUTDIR need not be shared between nodes, so the best state is sent to the other ranks
+    model_state = broadcast_object(model_state)
     model.load_state_dict(model_state)
     model.to(device)
     return model
@@ -175,12 +225,13 @@ def train_CGCNN_e3nn(model,normalizer,model_type,loss_fn,contrastive_loss_fn,tra
 
 
 
-def record_keep(history,results,epoch,wall,optimizer,valid_avg_loss,train_avg_loss,model,eval_type,contrastive_weight=None):
+def record_keep(history,results,epoch,wall,optimizer,valid_avg_loss,train_avg_loss,model,eval_type,contrastive_weight=None,throughput=None):
     if "contrastive" in eval_type:
 
         history.append({
             'step': epoch,
             'wall': wall,
+            'structures_per_second': throughput,
             'learning_rate': optimizer.param_groups[0]['lr'],
             'contrastive_weight':contrastive_weight,
             'valid': {
@@ -213,6 +264,7 @@ def record_keep(history,results,epoch,wall,optimizer,valid_avg_loss,train_avg_lo
         history.append({
             'step': epoch,
             'wall': wall,
+            'structures_per_second': throughput,
             'learning_rate': optimizer.param_groups[0]['lr'],
             'valid': {
                 'loss': valid_avg_loss[0],
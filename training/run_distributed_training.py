@@ -0,0 +1,162 @@
+import os
+import json
+import argparse
+import torch
+import numpy as np
+import pandas as pd
+import random
+from processing.utils import filter_data_by_properties,select_structures,load_dataset
+from processing.interpolation.Interpolation import *
+from processing.dataloader.dataloader import get_dataloader, get_eval_dataloader
+from processing.dataloader.distributed import distribute_loader, shard_eval_loader
+from processing.create_model.create_model import create_model
+from training.hyperparameters.default import get_default_cgcnn_hyperparameters, get_default_e3nn_hyperparameters, get_default_painn_hyperparameters
+from training.model_training.trainer import trainer
+from training.model_training.device import configure_cpu
+from training.model_training.distributed import init_distributed, cleanup_distributed, is_main_process, get_local_rank, get_local_cores
+from training.evaluate import evaluate_model
+
+
+### Data-parallel training of one model, one process per rank. Launch with torchrun, e.g. on one node
+###     torchrun --nproc_per_node 8 -m training.run_distributed_training --model e3nn --outdir ...
+### or on several nodes with --nnodes, --node_rank and --master_addr. On the CPU every process is
+### pinned to its own block of the node's cores.
+
+
+def run_distributed_training(struct_type,model_type,hyperparameters,outdir,use_cuda=False,training_fraction=1.0,data_name="data/",target_prop="dft_e_hull",interpolation=False,contrastive_weight=1.0,training_seed=0,loader_options=None,contrastive_loss_mode="energies",precision="fp32",execution="eager",cpu_threads=None):
+    rank, world_size = init_distributed()
+    local_rank = get_local_rank()
+    if use_cuda:
+        gpu_num = local_rank
+    else:
+        gpu_num = -1
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+        configure_cpu(cpu_threads, cores=get_local_cores(local_rank, local_world_size))
+
+    # every rank loads and processes the same data with the same seeds
+    if data_name == "data/":
+        training_data = load_dataset(data_name + 'training_set.json', struct_type=struct_type)
+        training_data = training_data.sample(frac=training_fraction,replace=False,random_state=training_seed)
+        validation_data = load_dataset(data_name + 'validation_set.json', struct_type=struct_type)
+        edge_data = load_dataset(data_name + 'edge_dataset.json', struct_type=struct_type)
+        if not interpolation:
+            training_data = pd.concat((training_data,edge_data))
+    else:
+        print("Specified Data Directory Does Not Exist!")
+
+    torch.manual_seed(0)
+    random.seed(0)
+    np.random.seed(0)
+
+    processed_data = []
+    for dataset in [training_data, validation_data]:
+        dataset = filter_data_by_properties(dataset,target_prop)
+        dataset = select_structures(dataset,struct_type)
+        if interpolation:
+            dataset = apply_interpolation(dataset,target_prop)
+        processed_data.append(dataset)
+    train_data, validation_data = processed_data
+
+    per_site = "per_site" in target_prop
+    train_loader = get_dataloader(train_data,target_prop,model_type,hyperparameters["batch_size"],interpolation,per_site=per_site,loader_options=loader_options,pipeline=True)
+    train_eval_loader = None
+
+    if "e3nn" in model_type and "pretrain" not in data_name and not per_site:
+        train_eval_loader = get_dataloader(train_data,target_prop,"e3nn_contrastive",1,interpolation,per_site=per_site,loader_options=loader_options)
+        val_loader = get_dataloader(validation_data,target_prop,"e3nn_contrastive",1,interpolation,per_site=per_site,loader_options=loader_options)
+        train_eval_loader = shard_eval_loader(get_eval_dataloader(train_eval_loader,"e3nn_contrastive",loader_options),rank,world_size)
+        val_loader = shard_eval_loader(get_eval_dataloader(val_loader,"e3nn_contrastive",loader_options),rank,world_size)
+    else:
+        val_loader = get_dataloader(validation_data,target_prop,model_type,1,interpolation,per_site=per_site,loader_options=loader_options)
+        val_loader = get_eval_dataloader(val_loader,model_type,loader_options)
+        # nff's Trainer validates on its own, so every PaiNN rank keeps the whole validation set
+        if model_type != "Painn":
+            val_loader = shard_eval_loader(val_loader,rank,world_size)
+
+    # the normalizer and feature lengths come from the whole training set, before it is sharded
+    model, normalizer = create_model(model_type, train_loader, interpolation, target_prop, hyperparameters, per_site=per_site)
+    train_loader = distribute_loader(train_loader, rank, world_size, seed=training_seed)
+
+    best_model,loss_fn = trainer(model,normalizer,model_type,train_loader,val_loader,hyperparameters,outdir,gpu_num,train_eval_loader=train_eval_loader,contrastive_weight=contrastive_weight,contrastive_loss_mode=contrastive_loss_mode,precision=precision,execution=execution)
+
+    is_contrastive = "contrastive" in model_type
+    _, _, best_loss = evaluate_model(best_model, normalizer, model_type, val_loader, loss_fn, gpu_num, is_contrastive=is_contrastive, contrastive_weight=contrastive_weight, distributed=model_type != "Painn")
+
+    if is_main_process():
+        with open(os.path.join(outdir, "hyperparameters.json"), "w") as f:
+            json.dump(hyperparameters, f)
+        print("Best validation loss: " + str(best_loss if model_type == "Painn" else best_loss[0]))
+
+    cleanup_distributed()
+    return best_loss
+
+
+def get_default_hyperparameters(model_type):
+    if model_type == "Painn":
+        return get_default_painn_hyperparameters()
+    elif model_type == "CGCNN":
+        return get_default_cgcnn_hyperparameters()
+    return get_default_e3nn_hyperparameters()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data-parallel training of perovskite ordering GCNNs (launch with torchrun)')
+    parser.add_argument('--data_name', default = "data/", type=str, metavar='name',
+                        help="name of data directory (default: data/)")
+    parser.add_argument('--prop', default = "dft_e_hull", type=str, metavar='name',
+                        help="target property (default: dft_e_hull)")
+    parser.add_argument('--struct_type', default = 'unrelaxed', type=str, metavar='struct_type',
+                        help="using which structure representation (default: unrelaxed)")
+    parser.add_argument('--interpolation', default = 'no', type=str, metavar='yes/no',
+                        help="use interpolation (default: no)")
+    parser.add_argument('--model', default = "CGCNN", type=str, metavar='model',
+                        help="the neural network to use (default: CGCNN)")
+    parser.add_argument('--contrastive_weight', default = 1.0, type=float, metavar='loss_parameters',
+                        help="the weighting applied to the contrastive loss term (default: 1.0)")
+    parser.add_argument('--training_fraction', default = 1.0, type=float, metavar='training_set',
+                        help="fraction of the total training set used (default: 1.0)")
+    parser.add_argument('--training_seed', default = 0, type=int, metavar='training_set',
+                        help="the random seed for selecting fraction of training set and shuffling its shards (default 0)")
+    parser.add_argument('--hyperparameters', default = None, type=str, metavar='path',
+                        help="JSON file of hyperparameters, e.g. the hyperparameters.json of a saved model (default: the model's defaults)")
+    parser.add_argument('--outdir', default = "./saved_models/distributed", type=str, metavar='path',
+                        help="directory rank 0 writes the models to (default: ./saved_models/distributed)")
+    parser.add_argument('--cuda', action='store_true',
+                        help="train on the GPU of each process's local rank instead of the CPU")
+    parser.add_argument('--cpu_threads', default = None, type=int, metavar='threads',
+                        help="intra-op threads per process on the CPU (default: one per core of the process's block)")
+    parser.add_argument('--graph_cache_dir', default = None, type=str, metavar='path',
+                        help="directory of the on-disk e3nn graph cache shared by the ranks (default: no caching)")
+    parser.add_argument('--packed_store_dir', default = None, type=str, metavar='path',
+                        help="directory of memory-mapped packed e3nn datasets shared by the ranks (default: graphs in memory)")
+    parser.add_argument('--loader_workers', default = 0, type=int, metavar='workers',
+                        help="worker processes collating batches per rank (default: 0)")
+    parser.add_argument('--eval_batch_size', default = None, type=int, metavar='size',
+                        help="collate evaluation loaders once into batches of this size (default: re-collate every epoch)")
+    parser.add_argument('--contrastive_loss', default = "energies", type=str, choices=["energies", "probs", "sorted"],
+                        help="pairwise ordering terms of the contrastive loss (default: energies)")
+    parser.add_argument('--precision', default = "fp32", type=str, choices=["fp32", "bf16", "fp16"],
+                        help="autocast the forward pass to bfloat16 or float16 (default: fp32)")
+    parser.add_argument('--execution', default = "eager", type=str, choices=["eager", "compile", "trace"],
+                        help="run models eagerly, through torch.compile (PyTorch 2.0+) or as TorchScript traces (CGCNN) (default: eager)")
+    args = parser.parse_args()
+
+    if args.hyperparameters is None:
+        hyperparameters = get_default_hyperparameters(args.model)
+    else:
+        with open(args.hyperparameters) as f:
+            hyperparameters = json.load(f)
+
+    if args.interpolation == 'yes':
+        interpolation = True
+    elif args.interpolation == 'no':
+        interpolation = False
+    else:
+        raise ValueError('interpolation needs to be yes or no')
+
+    loader_options = {"graph_cache_dir": args.graph_cache_dir, "packed_store_dir": args.packed_store_dir,
+                      "loader_workers": args.loader_workers, "eval_batch_size": args.eval_batch_size}
+    os.makedirs(args.outdir, exist_ok=True)
+
+    run_distributed_training(args.struct_type,args.model,hyperparameters,args.outdir,args.cuda,args.training_fraction,args.data_name,args.prop,interpolation,
+                             args.contrastive_weight,args.training_seed,loader_options,args.contrastive_loss,args.precision,args.execution,args.cpu_threads)
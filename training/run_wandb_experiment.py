@@ -9,24 +9,25 @@ import random
 import shutil
 import os
 import wandb
-from processing.utils import filter_data_by_properties,select_structures
+from processing.utils import filter_data_by_properties,select_structures,load_dataset
 from processing.interpolation.Interpolation import *
-from processing.dataloader.dataloader import get_dataloader
+from processing.dataloader.dataloader import get_dataloader, get_eval_dataloader
 from processing.create_model.create_model import create_model
 from training.hyperparameters.wandb_parameters import *
 from training.model_training.trainer import *
 from training.wandb_utils import build_wandb_name
 from training.evaluate import *
+from training.model_training.device import get_device, is_cpu, configure_cpu, parse_cores
 
 
-def run_wandb_experiment(struct_type,model_type,gpu_num,experiment_id=None,parallel_band=1,obs_budget=50,training_fraction=1.0,data_name="data/",target_prop="dft_e_hull",interpolation=False,contrastive_weight=1.0,training_seed=0,nickname=""):
+def run_wandb_experiment(struct_type,model_type,gpu_num,experiment_id=None,parallel_band=1,obs_budget=50,training_fraction=1.0,data_name="data/",target_prop="dft_e_hull",interpolation=False,contrastive_weight=1.0,training_seed=0,nickname="",loader_options=None,contrastive_loss_mode="energies",precision="fp32",execution="eager"):
     """Run wandb hyperparameter optimization experiment"""
     
     if data_name == "data/":
-        training_data = pd.read_json(data_name + 'training_set.json')
+        training_data = load_dataset(data_name + 'training_set.json', struct_type=struct_type)
         training_data = training_data.sample(frac=training_fraction,replace=False,random_state=training_seed)
-        validation_data = pd.read_json(data_name + 'validation_set.json')
-        edge_data = pd.read_json(data_name + 'edge_dataset.json')
+        validation_data = load_dataset(data_name + 'validation_set.json', struct_type=struct_type)
+        edge_data = load_dataset(data_name + 'edge_dataset.json', struct_type=struct_type)
         if not interpolation:
             training_data = pd.concat((training_data,edge_data))
     else:
@@ -82,7 +83,7 @@ def run_wandb_experiment(struct_type,model_type,gpu_num,experiment_id=None,paral
         hyperparameters = convert_hyperparameters(hyperparameters)
         
         # Train model
-        val_loss = wandb_evaluate_model(data_name,hyperparameters,processed_data,target_prop,interpolation,struct_type,model_type,contrastive_weight,training_fraction,training_seed,sweep_id,obs_budget,gpu_num,nickname)
+        val_loss = wandb_evaluate_model(data_name,hyperparameters,processed_data,target_prop,interpolation,struct_type,model_type,contrastive_weight,training_fraction,training_seed,sweep_id,obs_budget,gpu_num,nickname,loader_options,contrastive_loss_mode,precision,execution)
         
         # Log final validation loss
         wandb.log({"val_mae": val_loss})
@@ -129,11 +130,11 @@ def run_wandb_experiment(struct_type,model_type,gpu_num,experiment_id=None,paral
     print(f"Completed wandb sweep with {obs_budget} observations")
 
 
-def wandb_evaluate_model(data_name,hyperparameters,processed_data,target_prop,interpolation,struct_type,model_type,contrastive_weight,training_fraction,training_seed,experiment_id,observation_count,gpu_num,nickname):
+def wandb_evaluate_model(data_name,hyperparameters,processed_data,target_prop,interpolation,struct_type,model_type,contrastive_weight,training_fraction,training_seed,experiment_id,observation_count,gpu_num,nickname,loader_options=None,contrastive_loss_mode="energies",precision="fp32",execution="eager"):
     """Evaluate model for wandb experiment"""
 
     # Wandb equivalent (active)
-    device = "cuda:" + str(gpu_num)
+    device = get_device(gpu_num)
     
     train_data = processed_data[0]
     validation_data = processed_data[1]
@@ -151,14 +152,17 @@ def wandb_evaluate_model(data_name,hyperparameters,processed_data,target_prop,in
     # Convert hyperparameters to expected format
     hyperparameters = convert_hyperparameters(hyperparameters)
 
-    train_loader = get_dataloader(train_data,target_prop,model_type,hyperparameters["batch_size"],interpolation,per_site=per_site)
+    train_loader = get_dataloader(train_data,target_prop,model_type,hyperparameters["batch_size"],interpolation,per_site=per_site,loader_options=loader_options,pipeline=True)
     train_eval_loader = None
 
     if "e3nn" in model_type and "pretrain" not in data_name and "per_site" not in target_prop:
-        train_eval_loader = get_dataloader(train_data,target_prop,"e3nn_contrastive",1,interpolation,per_site=per_site)
-        val_loader = get_dataloader(validation_data,target_prop,"e3nn_contrastive",1,interpolation,per_site=per_site)
+        train_eval_loader = get_dataloader(train_data,target_prop,"e3nn_contrastive",1,interpolation,per_site=per_site,loader_options=loader_options)
+        val_loader = get_dataloader(validation_data,target_prop,"e3nn_contrastive",1,interpolation,per_site=per_site,loader_options=loader_options)
+        train_eval_loader = get_eval_dataloader(train_eval_loader,"e3nn_contrastive",loader_options)
+        val_loader = get_eval_dataloader(val_loader,"e3nn_contrastive",loader_options)
     else:
-        val_loader = get_dataloader(validation_data,target_prop,model_type,1,interpolation,per_site=per_site)
+        val_loader = get_dataloader(validation_data,target_prop,model_type,1,interpolation,per_site=per_site,loader_options=loader_options)
+        val_loader = get_eval_dataloader(val_loader,model_type,loader_options)
     
     # Pass hyperparameters as positional argument
     model, normalizer = create_model(model_type, train_loader, interpolation, target_prop, hyperparameters, per_site=per_site)
@@ -175,7 +179,7 @@ def wandb_evaluate_model(data_name,hyperparameters,processed_data,target_prop,in
         shutil.rmtree(model_tmp_dir)
     os.makedirs(model_tmp_dir) 
 
-    best_model,loss_fn = trainer(model,normalizer,model_type,train_loader,val_loader,hyperparameters,model_tmp_dir,gpu_num,train_eval_loader=train_eval_loader,contrastive_weight=contrastive_weight)
+    best_model,loss_fn = trainer(model,normalizer,model_type,train_loader,val_loader,hyperparameters,model_tmp_dir,gpu_num,train_eval_loader=train_eval_loader,contrastive_weight=contrastive_weight,contrastive_loss_mode=contrastive_loss_mode,precision=precision,execution=execution)
     
     is_contrastive = False
     if "contrastive" in model_type:
@@ -245,11 +249,55 @@ if __name__ == '__main__':
     parser.add_argument('--training_seed', default = 0, type=int, metavar='training_set',
                         help="the random seed for selecting fraction of training set (default 0)")
     parser.add_argument('--gpu', default = 0, type=int, metavar='device',
-                        help="the gpu to use (default: 0)")
+                        help="the gpu to use, or -1 to run on the CPU (default: 0)")
     parser.add_argument('--nickname', default = "", type=str, metavar='device',
                         help="nickname for temporary folder")
     parser.add_argument('--budget', default = 50, type=int, metavar='wandb_props',
                         help="budget of wandb sweep (default: 50)")
+    parser.add_argument('--graph_cache_dir', default = None, type=str, metavar='path',
+                        help="directory for caching featurised e3nn graphs across runs (default: no cache)")
+    parser.add_argument('--featurize_workers', default = 0, type=int, metavar='workers',
+                        help="number of processes used to build e3nn graphs (default: 0, serial)")
+    parser.add_argument('--packed_store_dir', default = None, type=str, metavar='path',
+                        help="directory of memory-mapped e3nn datasets shared between sweep processes (default: in memory)")
+    parser.add_argument('--reuse_templates', action='store_true',
+                        help="compute neighbor lists once per supercell template (default: per structure)")
+    parser.add_argument('--painn_dataset_dir', default = None, type=str, metavar='path',
+                        help="directory for saving PaiNN datasets with their neighbor lists across trials (default: not saved)")
+    parser.add_argument('--cgcnn_store_dir', default = None, type=str, metavar='path',
+                        help="directory for precomputed CGCNN inputs shared by all trials (default: not stored)")
+    parser.add_argument('--compact_graphs', action='store_true',
+                        help="store e3nn graphs in the compact schema (default: full schema)")
+    parser.add_argument('--batch_budget', default = None, type=int, metavar='size',
+                        help="fill e3nn and PaiNN batches up to this many atoms or edges instead of batch_size (default: batch_size)")
+    parser.add_argument('--batch_budget_unit', default = "nodes", type=str, choices=["nodes", "edges"],
+                        help="what the batch budget counts (default: nodes)")
+    parser.add_argument('--contrastive_group_size', default = 6, type=int, metavar='size',
+                        help="structures per contrastive group, 0 for whole compositions (default: 6)")
+    parser.add_argument('--contrastive_atom_budget', default = None, type=int, metavar='atoms',
+                        help="pack whole contrastive groups into batches up to this many atoms (default: batch_size groups)")
+    parser.add_argument('--contrastive_segments', default = "composition", type=str, choices=["composition", "group"],
+                        help="contrastive loss over runs of equal composition in a batch, or over each contrastive group on its own (default: composition)")
+    parser.add_argument('--loader_workers', default = 0, type=int, metavar='workers',
+                        help="worker processes collating batches ahead of training (default: 0, in the training loop)")
+    parser.add_argument('--prefetch_factor', default = 2, type=int, metavar='batches',
+                        help="batches prefetched per loader worker (default: 2)")
+    parser.add_argument('--pin_memory', action='store_true',
+                        help="collate batches into pinned host memory (default: pageable memory)")
+    parser.add_argument('--eval_batch_size', default = None, type=int, metavar='size',
+                        help="collate evaluation loaders once into batches of this size (default: re-collated every epoch)")
+    parser.add_argument('--contrastive_loss', default = "energies", type=str, choices=["energies", "probs", "sorted"],
+                        help="pairwise ordering terms of the contrastive loss; sorted computes energies in O(n log n) for large groups (default: energies)")
+    parser.add_argument('--precision', default = "fp32", type=str, choices=["fp32", "bf16", "fp16"],
+                        help="autocast the forward pass to bfloat16 or float16 (bfloat16 on CPU, fp16 not for PaiNN) (default: fp32)")
+    parser.add_argument('--execution', default = "eager", type=str, choices=["eager", "compile", "trace"],
+                        help="run models eagerly, through torch.compile (PyTorch 2.0+) or as TorchScript traces (CGCNN) (default: eager)")
+    parser.add_argument('--cpu_threads', default = None, type=int, metavar='threads',
+                        help="intra-op threads when running on the CPU (default: one per core)")
+    parser.add_argument('--cpu_interop_threads', default = None, type=int, metavar='threads',
+                        help="inter-op threads when running on the CPU (default: PyTorch's)")
+    parser.add_argument('--cpu_cores', default = None, type=str, metavar='list',
+                        help="cores to pin the process to when running on the CPU, e.g. 0-15 or 0,2,4 (default: all)")
     args = parser.parse_args()
 
     data_name = args.data_name
@@ -262,6 +310,17 @@ if __name__ == '__main__':
     training_fraction = args.training_fraction
     training_seed = args.training_seed
     obs_budget = args.budget
+    if is_cpu(gpu_num):
+        print(configure_cpu(args.cpu_threads, args.cpu_interop_threads, parse_cores(args.cpu_cores)))
+    loader_options = {"graph_cache_dir": args.graph_cache_dir, "featurize_workers": args.featurize_workers,
+                      "packed_store_dir": args.packed_store_dir, "reuse_templates": args.reuse_templates,
+                      "compact_graphs": args.compact_graphs, "painn_dataset_dir": args.painn_dataset_dir,
+                      "cgcnn_store_dir": args.cgcnn_store_dir, "batch_budget": args.batch_budget,
+                      "batch_budget_unit": args.batch_budget_unit, "contrastive_atom_budget": args.contrastive_atom_budget,
+                      "contrastive_group_size": args.contrastive_group_size if args.contrastive_group_size > 0 else None,
+                      "contrastive_segments": args.contrastive_segments,
+                      "loader_workers": args.loader_workers, "prefetch_factor": args.prefetch_factor, "pin_memory": args.pin_memory,
+                      "eval_batch_size": args.eval_batch_size}
     
     if struct_type not in ["unrelaxed", "relaxed", "spud", "M3Gnet_relaxed"]:
         raise ValueError('struct type is not available')
@@ -273,4 +332,4 @@ if __name__ == '__main__':
     else:
         raise ValueError('interpolation needs to be yes or no')    
     
-    run_wandb_experiment(struct_type,model_type,gpu_num,None,1,obs_budget,training_fraction,data_name,target_prop,interpolation,contrastive_weight,training_seed,nickname) 
\ No newline at end of file
+    run_wandb_experiment(struct_type,model_type,gpu_num,None,1,obs_budget,training_fraction,data_name,target_prop,interpolation,contrastive_weight,training_seed,nickname,loader_options,args.contrastive_loss,args.precision,args.execution) 
\ No newline at end of file